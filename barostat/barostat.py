@@ -2,7 +2,7 @@ import numpy as np
 import functools
 import jax
 import jax.numpy as jnp
-from timemachine.integrator import langevin_coefficients
+from timemachine.integrator import langevin_coefficients, langevin_noise
 
 from jax.config import config; config.update("jax_enable_x64", True)
 
@@ -105,8 +105,7 @@ def setup_system():
         vol_xt,
         vol_vt,
         lj_params,
-        xt_noise_buf,
-        vol_noise_buf):
+        seed):
 
         p_ints = []
 
@@ -140,11 +139,12 @@ def setup_system():
                 plt.savefig('barostat_frames/'+str(step))
                 plt.clf()
 
-            # vol_noise = vol_noise_buf[step]
+            # vol_noise = langevin_noise(seed + 1, step, 1, 1)[0, 0]
             # vol_vt = 0.5*vol_vt - 0.01*(p_int - p_ext) + vol_noise
             # vol_xt = vol_xt + vol_vt*1.5e-3
 
-            noise = xt_noise_buf[step]
+            # regenerated from (seed, step, atom) instead of a stored [num_steps, N, D] buffer
+            noise = langevin_noise(seed, step, *x_t.shape)
             v_t = ca*v_t + cb*force + cc*noise
             x_t = x_t + v_t*dt
 
@@ -170,17 +170,13 @@ def setup_system():
     vol_xt = volume
     vol_vt = np.zeros_like(vol_xt)
 
-    xt_noise_buffer = np.random.randn(num_steps, *conf.shape)
-    vol_noise_buffer = np.random.randn(num_steps)
-
     x_final = integrate_once_through(
         x0,
         v0,
         vol_xt,
         vol_vt,
         lj_params,
-        xt_noise_buffer,
-        vol_noise_buffer
+        np.random.randint(np.iinfo(np.int32).max)
     )
 
     assert 0
@@ -190,18 +186,14 @@ def setup_system():
         print(epoch, lj_params)
 
 
-        xt_noise_buffer = np.random.randn(num_steps, *conf.shape)
-        vol_noise_buffer = np.random.randn(num_steps)
-
+        seed = np.random.randint(np.iinfo(np.int32).max)
 
         primals = (
             x0,
             v0, 
             vol_xt,
             vol_vt,
-            lj_params,
-            xt_noise_buffer,
-            vol_noise_buffer
+            lj_params
         )
 
 
@@ -212,12 +204,10 @@ def setup_system():
             np.zeros_like(vol_xt),
             np.zeros_like(vol_vt),
             # np.zeros_like(lj_params),
-            np.array([1.0, 0.0]),
-            np.zeros_like(xt_noise_buffer),
-            np.zeros_like(vol_noise_buffer)
+            np.array([1.0, 0.0])
         )
 
-        x_primals_out, x_tangents_out = jax.jvp(integrate_once_through, primals, tangents)
+        x_primals_out, x_tangents_out = jax.jvp(functools.partial(integrate_once_through, seed=seed), primals, tangents)
         
         sig_grad = np.clip(x_tangents_out, -0.01, 0.01)
 
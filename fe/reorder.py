@@ -0,0 +1,163 @@
+import numpy as np
+
+
+def hilbert_index(conf, bits=10):
+    """
+    Position of each point along a 3D Hilbert curve, using Skilling's transpose
+    algorithm ("Programming the Hilbert curve", AIP Conf. Proc. 707, 2004).
+
+    Parameters
+    ----------
+    conf: np.array [N, 3]
+        coordinates, quantized onto a 2^bits grid spanning their bounding box.
+
+    bits: int
+        bits per dimension, the curve has 2^(3*bits) cells.
+
+    Returns
+    -------
+    np.array [N] of np.int64
+        Hilbert index of each point.
+
+    """
+    D = conf.shape[1]
+    assert D*bits < 63
+
+    lo = np.amin(conf, axis=0)
+    width = np.amax(np.amax(conf, axis=0) - lo)
+    scale = (2**bits - 1)/width if width > 0 else 0.0
+    X = np.floor((conf - lo)*scale).astype(np.int64).T.copy() # [D, N]
+
+    M = 1 << (bits - 1)
+
+    # inverse undo excess work
+    Q = M
+    while Q > 1:
+        P = Q - 1
+        for i in range(D):
+            hi = (X[i] & Q) != 0
+            if i == 0:
+                X[0] = np.where(hi, X[0] ^ P, X[0])
+            else:
+                t = (X[0] ^ X[i]) & P
+                X[0], X[i] = np.where(hi, X[0] ^ P, X[0] ^ t), np.where(hi, X[i], X[i] ^ t)
+        Q >>= 1
+
+    # gray encode
+    for i in range(1, D):
+        X[i] ^= X[i-1]
+    t = np.zeros_like(X[0])
+    Q = M
+    while Q > 1:
+        t = np.where((X[D-1] & Q) != 0, t ^ (Q - 1), t)
+        Q >>= 1
+    X ^= t
+
+    # interleave the transposed bits, most significant first
+    h = np.zeros_like(X[0])
+    for b in range(bits - 1, -1, -1):
+        for i in range(D):
+            h = (h << 1) | ((X[i] >> b) & 1)
+
+    return h
+
+
+def hilbert_permutation(conf, bits=10):
+    """
+    Permutation that sorts the atoms along a Hilbert curve, so that atoms close in
+    space are close in memory.
+
+    Returns
+    -------
+    np.array [N] of np.int32
+        perm, where the i-th atom of the reordered system is atom perm[i].
+
+    """
+    return np.argsort(hilbert_index(np.asarray(conf)[:, :3], bits), kind="stable").astype(np.int32)
+
+
+class Reordering():
+
+    def __init__(self, perm):
+        """
+        An atom permutation together with its inverse.
+
+        Parameters
+        ----------
+        perm: np.array [N]
+            the i-th atom of the reordered system is atom perm[i] of the original.
+
+        """
+        self.perm = np.asarray(perm, dtype=np.int32)
+        self.inv_perm = np.argsort(self.perm).astype(np.int32)
+
+    def permute_atoms(self, x, axis=0):
+        """
+        Per atom array in the original order -> reordered.
+        """
+        return np.take(np.asarray(x), self.perm, axis=axis)
+
+    def restore_atoms(self, x, axis=0):
+        """
+        Per atom array in the reordered order -> original, eg. frames [F, N, 3] with axis=1.
+        """
+        return np.take(np.asarray(x), self.inv_perm, axis=axis)
+
+    def remap_idxs(self, idxs):
+        """
+        Atom indices of the original system -> atom indices of the reordered system.
+        """
+        return self.inv_perm[np.asarray(idxs, dtype=np.int32)].astype(np.int32)
+
+    def restore_vjp_fn(self, vjp_fn):
+        """
+        Wrap a handler vjp_fn of per atom parameters so that it accepts adjoints in the
+        reordered order.
+        """
+        def wrapped_fn(adjoint):
+            return vjp_fn(self.restore_atoms(adjoint))
+
+        return wrapped_fn
+
+
+def reorder_gradient(reordering, name, args):
+    """
+    Permute the arguments of a single (name, args) entry of the final_gradients
+    returned by setup_system.create_system().
+    """
+    r = reordering
+    if name in ('HarmonicBond', 'HarmonicAngle', 'PeriodicTorsion'):
+        idxs, params = args
+        return name, (r.remap_idxs(idxs), params)
+    elif name == 'Nonbonded':
+        charge_params, lj_params, exclusion_idxs, charge_scales, lj_scales, plane_idxs, offset_idxs, cutoff = args
+        return name, (
+            r.permute_atoms(charge_params),
+            r.permute_atoms(lj_params),
+            r.remap_idxs(exclusion_idxs),
+            charge_scales,
+            lj_scales,
+            r.permute_atoms(plane_idxs),
+            r.permute_atoms(offset_idxs),
+            cutoff
+        )
+    elif name == 'GBSA':
+        charge_params, gb_params, plane_idxs, offset_idxs = args[:4]
+        return name, (
+            r.permute_atoms(charge_params),
+            r.permute_atoms(gb_params),
+            r.permute_atoms(plane_idxs),
+            r.permute_atoms(offset_idxs),
+            *args[4:]
+        )
+    elif name == 'CentroidRestraint':
+        group_a_idxs, group_b_idxs, masses = args[:3]
+        return name, (
+            r.remap_idxs(group_a_idxs),
+            r.remap_idxs(group_b_idxs),
+            r.permute_atoms(masses),
+            *args[3:]
+        )
+    else:
+        raise Exception("Unknown Gradient", name)
+
@@ -3,20 +3,28 @@ from timemachine.integrator import langevin_coefficients
 
 class System():
 
-    def __init__(self, x0, v0, gradients, integrator):
+    def __init__(self, x0, v0, gradients, integrator, memory_budget=None, du_dl_stats=None, minimizer=None):
         # fully contained class that allows simulations to be run forward
         # and backward
         self.x0 = x0
         self.v0 = v0
         self.gradients = gradients
         self.integrator = integrator
+        # bytes of snapshots kept for the backward pass, None stores every frame.
+        self.memory_budget = memory_budget
+        # kwargs of DuDlStatistics, if set inference runs only return du_dl summaries.
+        self.du_dl_stats = du_dl_stats
+        # kwargs of timemachine.minimizer.minimize(), if set x0 is minimized before the run.
+        self.minimizer = minimizer
 
 
 class Integrator():
 
-    def __init__(self, steps, dt, temperature, friction, masses, lamb, seed):
-
-        minimization_steps = 2000
+    def __init__(self, steps, dt, temperature, friction, masses, lamb, seed, minimization_steps=2000, respa_interval=1):
+        # the first minimization_steps ramp dt up from zero to relax x0, this can
+        # be set to zero when x0 is minimized beforehand, see System.minimizer.
+        # nonbonded terms are evaluated every respa_interval steps, only supported
+        # by the reference engine, see integrator.respa_intervals().
 
         ca, cbs, ccs = langevin_coefficients(
             temperature,
@@ -36,4 +44,5 @@ class Integrator():
         self.cbs = -cbs
         self.ccs = ccs
         self.lambs = np.zeros(steps) + lamb
-        self.seed = seed
\ No newline at end of file
+        self.seed = seed
+        self.respa_interval = respa_interval
\ No newline at end of file
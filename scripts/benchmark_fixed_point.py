@@ -0,0 +1,59 @@
+# Timing of the nonbonded du_dx in dense float64 against fixed point accumulation in float32
+# over the neighbor list pairs, see timemachine/potentials/fixed_point.py
+#
+# python scripts/benchmark_fixed_point.py
+import time
+import functools
+
+from jax.config import config; config.update("jax_enable_x64", True)
+import jax
+import numpy as np
+
+from timemachine.potentials import nonbonded, neighborlist
+
+
+def water_box(num_atoms, density=100.0):
+    # random coordinates at roughly the atom density of water, in atoms/nm^3
+    width = (num_atoms/density)**(1/3)
+    return np.random.rand(num_atoms, 3)*width
+
+
+def time_fn(fn, repeats=10):
+    jax.block_until_ready(fn())
+    start = time.perf_counter()
+    for _ in range(repeats):
+        jax.block_until_ready(fn())
+    return (time.perf_counter() - start)/repeats
+
+
+def main():
+    np.random.seed(2020)
+    cutoff = 1.0
+    for N in [500, 2000, 8000]:
+        x = water_box(N)
+        E = N//3
+        nrg_fn = functools.partial(
+            nonbonded.nonbonded,
+            charge_params=(np.random.rand(N) - 0.5)*np.sqrt(138.935456),
+            lj_params=np.stack([np.random.rand(N)/10 + 0.2, np.random.rand(N)], axis=1),
+            exclusion_idxs=np.random.choice(N, size=(E, 2)).astype(np.int32),
+            charge_scales=np.ones(E),
+            lj_scales=np.ones(E),
+            cutoff=cutoff,
+            lambda_plane_idxs=np.zeros(N, dtype=np.int32),
+            lambda_offset_idxs=np.zeros(N, dtype=np.int32)
+        )
+        nblist = neighborlist.build_neighbor_list(x, cutoff)
+
+        dense_fn = jax.jit(jax.grad(lambda x: nrg_fn(x, 0.0)))
+        nblist_fn = jax.jit(jax.grad(lambda x: nrg_fn(x, 0.0, nblist=nblist)))
+        fixed_fn = jax.jit(jax.grad(lambda x: nrg_fn(x, 0.0, nblist=nblist, precision=np.float32)))
+
+        print("N", N,
+            "dense float64", time_fn(lambda: dense_fn(x)),
+            "nblist float64", time_fn(lambda: nblist_fn(x)),
+            "nblist fixed point float32", time_fn(lambda: fixed_fn(x)))
+
+
+if __name__ == "__main__":
+    main()
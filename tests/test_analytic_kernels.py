@@ -0,0 +1,74 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from common import GradientTest
+
+from timemachine.potentials import nonbonded
+
+
+def lj_ref(dr, sig, eps):
+    d = jnp.sqrt(jnp.sum(dr*dr, axis=-1))
+    sig6 = (sig/d)**6
+    return 4*eps*(sig6-1.0)*sig6
+
+
+def coulomb_ref(dr, qij):
+    return qij/jnp.sqrt(jnp.sum(dr*dr, axis=-1))
+
+
+class TestAnalyticKernels(GradientTest):
+
+    def test_kernels(self):
+        np.random.seed(2035)
+
+        P = 50
+        dr = np.random.randn(P, 4)*0.3
+        sig = np.random.rand(P)/5 + 0.1
+        eps = np.random.rand(P)
+        qij = np.random.randn(P)
+
+        keep = np.random.rand(P) > 0.3
+        # masked out pairs may be coincident
+        dr[np.where(~keep)[0][:5]] = 0
+
+        def test_lj(dr, sig, eps):
+            return jnp.sum(nonbonded.lennard_jones_kernel(dr, sig, eps, keep))
+
+        def ref_lj(dr, sig, eps):
+            return jnp.sum(lj_ref(dr[keep], sig[keep], eps[keep]))
+
+        def test_es(dr, q):
+            return jnp.sum(nonbonded.coulomb_kernel(dr, q, keep))
+
+        def ref_es(dr, q):
+            return jnp.sum(coulomb_ref(dr[keep], q[keep]))
+
+        for test_fn, ref_fn, args in [(test_lj, ref_lj, (dr, sig, eps)), (test_es, ref_es, (dr, qij))]:
+            argnums = tuple(range(len(args)))
+            np.testing.assert_allclose(test_fn(*args), ref_fn(*args), rtol=1e-12)
+
+            test_grads = jax.grad(test_fn, argnums)(*args)
+            ref_grads = jax.grad(ref_fn, argnums)(*args)
+            for r, t in zip(ref_grads, test_grads):
+                assert np.all(np.isfinite(t))
+                np.testing.assert_allclose(r, t, rtol=1e-10, atol=1e-10)
+
+            # second order derivatives, eg. hessian vector products
+            tangent = np.random.randn(*dr.shape)
+            test_hvp = jax.jvp(lambda x: jax.grad(test_fn)(x, *args[1:]), (dr,), (tangent,))[1]
+            ref_hvp = jax.jvp(lambda x: jax.grad(ref_fn)(x, *args[1:]), (dr,), (tangent,))[1]
+            np.testing.assert_allclose(ref_hvp, test_hvp, rtol=1e-9, atol=1e-9)
+
+            # mixed coordinate/parameter derivatives used by the trainer
+            test_mixed = jax.jacfwd(jax.grad(test_fn, 0), 1)(*args)
+            ref_mixed = jax.jacfwd(jax.grad(ref_fn, 0), 1)(*args)
+            np.testing.assert_allclose(ref_mixed, test_mixed, rtol=1e-9, atol=1e-9)
+
+
+if __name__ == "__main__":
+    unittest.main()
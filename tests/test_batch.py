@@ -0,0 +1,136 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.constants import BOLTZ
+from timemachine.potentials import bonded, nonbonded, batch
+
+
+class TestBatch(GradientTest):
+
+    def setup_system(self, N):
+        E = N//5
+        B = N//2
+
+        bond_idxs = np.random.choice(np.arange(N), size=(B, 2), replace=False).astype(np.int32)
+        bond_params = np.stack([np.random.rand(B)*100, np.random.rand(B)/5 + 0.1], axis=1)
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+
+        bond_fn = functools.partial(bonded.harmonic_bond, params=bond_params, box=None, bond_idxs=bond_idxs)
+        nb_fn = functools.partial(
+            nonbonded.nonbonded,
+            charge_params=charge_params,
+            lj_params=lj_params,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=np.random.rand(E),
+            lj_scales=np.random.rand(E),
+            cutoff=1.0,
+            lambda_plane_idxs=np.random.randint(0, 2, size=N, dtype=np.int32),
+            lambda_offset_idxs=np.random.randint(0, 2, size=N, dtype=np.int32)
+        )
+        return [bond_fn, nb_fn]
+
+    def test_evaluate_trajectory(self):
+        np.random.seed(2028)
+
+        x0 = self.get_water_coords(3)[:90]
+        N = x0.shape[0]
+        T = 7
+        frames = x0 + np.random.randn(T, N, 3)*0.01
+        lambs = np.random.rand(T)
+
+        energy_fns = self.setup_system(N)
+
+        def ref_fn(x, lamb):
+            return sum(fn(x, lamb) for fn in energy_fns)
+
+        ref_du_dx, ref_du_dl, ref_nrg = [], [], []
+        for x, lamb in zip(frames, lambs):
+            nrg, (du_dx, du_dl) = jax.value_and_grad(ref_fn, argnums=(0, 1))(x, lamb)
+            ref_nrg.append(nrg)
+            ref_du_dx.append(du_dx)
+            ref_du_dl.append(du_dl)
+
+        # a single chunk, chunks that do not divide the number of frames, and a memory budget
+        for kwargs in [{}, {"chunk_size": 3}, {"memory_budget": 1}]:
+            du_dx, du_dl, nrg = batch.evaluate_trajectory(energy_fns, frames, lambs, True, True, **kwargs)
+            np.testing.assert_allclose(nrg, ref_nrg, rtol=1e-10)
+            np.testing.assert_allclose(du_dx, ref_du_dx, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(du_dl, ref_du_dl, rtol=1e-8, atol=1e-8)
+
+        du_dx, du_dl, nrg = batch.evaluate_trajectory(energy_fns, frames, 0.3, chunk_size=4)
+        assert du_dx is None and du_dl is None
+        np.testing.assert_allclose(nrg, [ref_fn(x, 0.3) for x in frames], rtol=1e-10)
+
+    def test_u_kn_matrix(self):
+        np.random.seed(2029)
+
+        x0 = self.get_water_coords(3)[:75]
+        N = x0.shape[0]
+        T = 5
+        E = N//5
+        frames = x0 + np.random.randn(T, N, 3)*0.01
+
+        # a few alchemical atoms with offsets in {0, 1} and exclusions that cross groups
+        lambda_offset_idxs = np.zeros(N, dtype=np.int32)
+        lambda_offset_idxs[-9:] = 1
+        lambda_plane_idxs = np.zeros(N, dtype=np.int32)
+        lambda_plane_idxs[:3] = 1
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        exclusion_idxs[0] = [N-1, 0]
+
+        nonbonded_kwargs = dict(
+            charge_params=(np.random.rand(N) - 0.5)*np.sqrt(138.935456),
+            lj_params=np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1),
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=np.random.rand(E),
+            lj_scales=np.random.rand(E),
+            cutoff=1.0,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs
+        )
+
+        B = 10
+        bond_idxs = np.random.choice(np.arange(N), size=(B, 2), replace=False).astype(np.int32)
+        bond_params = np.stack([np.random.rand(B)*100, np.random.rand(B)/5 + 0.1], axis=1)
+        bond_fn = functools.partial(bonded.harmonic_bond, params=bond_params, box=None, bond_idxs=bond_idxs)
+
+        # a lambda dependent term that is not part of the nonbonded potential
+        def restraint_fn(conf, lamb):
+            return lamb*conf[-9:, 0].sum()
+
+        lambda_schedule = np.linspace(0, 1.2, 6)
+        temperature = 300.0
+
+        # the options of nonbonded() have to carry over to the coupled pairs
+        for options in [{}, {"rf_dielectric": 78.5}, {"switch_distance": 0.8}, {"rf_dielectric": 78.5, "switch_distance": 0.8}]:
+            kwargs = dict(nonbonded_kwargs, **options)
+            nb_fn = functools.partial(nonbonded.nonbonded, **kwargs)
+            ref_u_kn = np.zeros((len(lambda_schedule), T))
+            for k, lamb in enumerate(lambda_schedule):
+                for n, x in enumerate(frames):
+                    ref_u_kn[k, n] = (nb_fn(x, lamb) + bond_fn(x, lamb) + restraint_fn(x, lamb))/(BOLTZ*temperature)
+
+            for chunk_size in [None, 2]:
+                test_u_kn = batch.u_kn_matrix(
+                    frames,
+                    lambda_schedule,
+                    temperature,
+                    kwargs,
+                    static_fns=[bond_fn],
+                    lambda_fns=[restraint_fn],
+                    chunk_size=chunk_size
+                )
+                assert test_u_kn.shape == ref_u_kn.shape
+                np.testing.assert_allclose(test_u_kn, ref_u_kn, rtol=1e-9)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+from timemachine import checkpointing
+
+
+def min_recompute(num_steps, num_snapshots, cache):
+    # brute force over every split, see CheckpointSchedule for the conventions
+    n, s = num_steps, num_snapshots
+    if n == 1:
+        return 0
+    if s >= n - 1:
+        return n - 1
+    if s == 0:
+        return n*(n - 1)//2
+    if (n, s) not in cache:
+        cache[(n, s)] = min(m + min_recompute(m, s, cache) + min_recompute(n - m, s - 1, cache) for m in range(1, n))
+    return cache[(n, s)]
+
+
+class TestCheckpointing(unittest.TestCase):
+
+    def replay(self, schedule):
+        """
+        Execute a schedule on step indices, checking that every reverse has its state
+        available, and return the order of the reverses and the number of advanced steps.
+        """
+        held = set([0] + schedule.forward_snapshots)
+        current = None
+        reversed_steps = []
+        num_advanced = 0
+        for action in schedule.actions:
+            if action[0] == "advance":
+                assert action[1] in held
+                if action[2] not in held:
+                    num_advanced += action[2] - action[1]
+                current = action[2]
+            elif action[0] == "store":
+                assert current == action[1]
+                held.add(action[1])
+            elif action[0] == "free":
+                held.remove(action[1])
+            else:
+                assert action[1] in held or current == action[1]
+                reversed_steps.append(action[1])
+            assert len(held) - 1 <= schedule.num_snapshots
+        return reversed_steps, num_advanced
+
+    def test_schedule(self):
+        cache = {}
+        for num_steps in range(1, 70):
+            for num_snapshots in range(0, 8):
+                schedule = checkpointing.CheckpointSchedule(num_steps, num_snapshots)
+                reversed_steps, num_advanced = self.replay(schedule)
+                assert reversed_steps == list(range(num_steps - 1, -1, -1))
+                assert num_advanced == schedule.recomputed_steps
+                assert schedule.peak_snapshots <= num_snapshots
+                # counting the advances covered by the forward pass, the schedule is optimal
+                total = sum(a[2] - a[1] for a in schedule.actions if a[0] == "advance")
+                assert total == min_recompute(num_steps, num_snapshots, cache)
+
+    def test_schedule_for_budget(self):
+        snapshot_bytes = 2*20000*3*8
+        schedule = checkpointing.schedule_for_budget(25000, 50*snapshot_bytes + 1, snapshot_bytes)
+        assert schedule.num_snapshots == 50
+        summary = schedule.summary()
+        assert summary["peak_snapshots"] == 50
+        assert 0 < summary["recompute_ratio"] < 3
+
+        # enough memory for every frame
+        schedule = checkpointing.schedule_for_budget(100, 10**9, snapshot_bytes)
+        assert schedule.num_snapshots == 99
+        assert schedule.recomputed_steps == 0
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+import unittest
+import numpy as np
+
+from timemachine.observables.du_dl import DuDlStatistics
+
+
+class TestDuDlStatistics(unittest.TestCase):
+
+    def test_matches_dense(self):
+        np.random.seed(2020)
+
+        F = 3
+        T = 1037
+        burn_in = 101
+        block_size = 50
+        decimation = 7
+
+        du_dls = np.random.randn(F, T)*np.array([[1.0], [10.0], [0.0]]) + np.array([[5.0], [-200.0], [0.0]])
+
+        # uneven chunks, including single steps and chunks that straddle the burn in
+        stats = DuDlStatistics(F, burn_in=burn_in, block_size=block_size, decimation=decimation)
+        start = 0
+        while start < T:
+            end = min(T, start + np.random.randint(1, 90))
+            if end - start == 1:
+                stats.update(du_dls[:, start])
+            else:
+                stats.update(du_dls[:, start:end])
+            start = end
+
+        summary = stats.summary()
+        equil = du_dls[:, burn_in:]
+        num_blocks = equil.shape[1]//block_size
+
+        assert summary["num_steps"] == T
+        assert summary["count"] == T - burn_in
+        np.testing.assert_allclose(summary["sums"], np.sum(equil, axis=1))
+        np.testing.assert_allclose(summary["means"], np.mean(equil, axis=1))
+        np.testing.assert_allclose(summary["variances"], np.var(equil, axis=1, ddof=1), atol=1e-12)
+        np.testing.assert_allclose(
+            summary["block_averages"],
+            np.mean(equil[:, :num_blocks*block_size].reshape(F, num_blocks, block_size), axis=2)
+        )
+        np.testing.assert_array_equal(summary["decimated"], equil[:, ::decimation])
+
+    def test_burn_in_only(self):
+        stats = DuDlStatistics(2, burn_in=10, block_size=4)
+        stats.update(np.ones((2, 10)))
+        summary = stats.summary()
+        assert summary["count"] == 0
+        assert summary["block_averages"].shape == (2, 0)
+        assert summary["decimated"] is None
+        np.testing.assert_array_equal(summary["variances"], np.zeros(2))
+
+
+if __name__ == "__main__":
+    unittest.main()
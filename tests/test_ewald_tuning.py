@@ -0,0 +1,88 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.potentials import nonbonded, ewald_tuning
+
+
+class TestEwaldTuning(GradientTest):
+
+    def test_tune_ewald(self):
+        np.random.seed(2027)
+
+        box = np.array([
+            [2.4, 0.0, 0.0],
+            [0.0, 2.5, 0.0],
+            [0.3, 0.4, 2.6]
+        ])
+        N = 64
+        x = np.matmul(np.random.rand(N, 3), box)
+        charges = np.random.rand(N) - 0.5
+        charges -= np.mean(charges)
+
+        tolerance = 5e-4
+        ewald_tuning.clear_cache()
+        params, error, seconds = ewald_tuning.tune_ewald(box, charges, tolerance, cutoffs=[0.8, 1.1], repeats=1)
+
+        assert error <= tolerance
+        assert seconds > 0
+        assert params["method"] in ("ewald", "pme")
+        assert params["cutoff"] <= 1.1
+
+        # cached per box, number of atoms and tuning arguments
+        tuned = ewald_tuning.tune_ewald(box, charges, tolerance, cutoffs=[0.8, 1.1], repeats=1)
+        assert tuned[0] is params
+        assert len(ewald_tuning._tuning_cache) == 1
+
+        # but not per conformation or number of timing repeats
+        tuned = ewald_tuning.tune_ewald(box, charges, tolerance, conf=x, cutoffs=[0.8, 1.1], repeats=3)
+        assert tuned[0] is params
+        assert len(ewald_tuning._tuning_cache) == 1
+
+        # narrower limits are not answered from the cache
+        narrow_params, _, _ = ewald_tuning.tune_ewald(box, charges, tolerance, cutoffs=[0.8], methods=("ewald",), repeats=1)
+        assert narrow_params["cutoff"] == 0.8
+        assert narrow_params["method"] == "ewald"
+        assert len(ewald_tuning._tuning_cache) == 2
+
+        scale_matrix = np.ones((N, N)) - np.eye(N)
+        ref_fn = functools.partial(
+            nonbonded.electrostatics,
+            box=box,
+            param_idxs=np.arange(N),
+            scale_matrix=scale_matrix,
+            cutoff=1.2,
+            alpha=3.5,
+            kmax=16
+        )
+        test_fn = functools.partial(
+            nonbonded.electrostatics,
+            box=box,
+            param_idxs=np.arange(N),
+            scale_matrix=scale_matrix,
+            **params
+        )
+
+        ref_du_dx = jax.grad(ref_fn)(x, charges)
+        test_du_dx = jax.grad(test_fn)(x, charges)
+
+        rms_force = np.sqrt(np.mean(ref_du_dx**2))
+        rms_error = np.sqrt(np.mean((ref_du_dx - test_du_dx)**2))
+        assert rms_error/rms_force < 10*tolerance
+
+    def test_no_candidates(self):
+        box = np.eye(3)*2.0
+        charges = np.array([1.0, -1.0])
+        with self.assertRaises(ValueError):
+            ewald_tuning.tune_ewald(box, charges, cutoffs=[1.5])
+        with self.assertRaises(ValueError):
+            ewald_tuning.tune_ewald(box, charges, 1e-8, cutoffs=[0.5], methods=("ewald",), max_kmax=4)
+
+
+if __name__ == "__main__":
+    unittest.main()
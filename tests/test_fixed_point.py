@@ -0,0 +1,171 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.lib import reference
+from timemachine.potentials import bonded, nonbonded, fixed_point, neighborlist
+
+
+class TestFixedPoint(GradientTest):
+
+    def test_bonded_fixed_point(self):
+        np.random.seed(2036)
+
+        x = self.get_water_coords(3)[:60]
+        N = x.shape[0]
+        T = 40
+
+        torsion_idxs = np.array([np.random.choice(N, size=4, replace=False) for _ in range(T)], dtype=np.int32)
+        torsion_params = np.stack([np.random.rand(T)*10, np.random.rand(T)*np.pi, np.random.randint(1, 4, size=T)], axis=1).astype(np.float64)
+
+        ref_nrg, ref_dx = jax.value_and_grad(bonded.periodic_torsion)(x, 0.0, torsion_params, None, torsion_idxs)
+
+        dx_64, nrg_64 = fixed_point.bonded_gradients(bonded.periodic_torsion, x, 0.0, torsion_params, None, torsion_idxs, np.float64, False)
+        np.testing.assert_allclose(nrg_64, ref_nrg, rtol=1e-10)
+        np.testing.assert_allclose(dx_64, ref_dx, rtol=1e-8, atol=1e-8)
+
+        dx_32, nrg_32 = fixed_point.bonded_gradients(bonded.periodic_torsion, x, 0.0, torsion_params, None, torsion_idxs)
+        np.testing.assert_allclose(nrg_32, ref_nrg, rtol=1e-5)
+        np.testing.assert_allclose(dx_32, ref_dx, rtol=5e-4, atol=5e-4)
+
+        # the order of the terms does not change a single bit
+        perm = np.random.permutation(T)
+        dx_perm, nrg_perm = fixed_point.bonded_gradients(bonded.periodic_torsion, x, 0.0, torsion_params[perm], None, torsion_idxs[perm])
+        np.testing.assert_array_equal(dx_32, dx_perm)
+        np.testing.assert_array_equal(nrg_32, nrg_perm)
+
+    def test_nonbonded_fixed_point(self):
+        np.random.seed(2037)
+
+        x = self.get_water_coords(3)[:90]
+        N = x.shape[0]
+        E = N//5
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10 + 0.1, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        charge_scales = np.random.rand(E)
+        lj_scales = np.random.rand(E)
+        lambda_plane_idxs = np.random.randint(0, 2, size=N, dtype=np.int32)
+        lambda_offset_idxs = np.random.randint(0, 2, size=N, dtype=np.int32)
+        cutoff = 1.0
+        lamb = 0.3
+
+        ref_nrg, (ref_dx, ref_dl) = jax.value_and_grad(nonbonded.nonbonded, argnums=(0, 1))(
+            x, lamb, charge_params, lj_params, exclusion_idxs, charge_scales, lj_scales, cutoff, lambda_plane_idxs, lambda_offset_idxs)
+
+        pair_idxs, pair_charge_scales, pair_lj_scales = fixed_point.nonbonded_pair_list(x, cutoff, exclusion_idxs, charge_scales, lj_scales)
+        # only the pairs within the cutoff are listed
+        assert pair_idxs.shape[0] - E < N*(N-1)//2
+
+        test_fn = functools.partial(
+            fixed_point.nonbonded_gradients,
+            lamb=lamb,
+            charge_params=charge_params,
+            lj_params=lj_params,
+            cutoff=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs
+        )
+
+        dx_64, dl_64, nrg_64 = test_fn(x, pair_idxs=pair_idxs, charge_scales=pair_charge_scales, lj_scales=pair_lj_scales, precision=np.float64)
+        np.testing.assert_allclose(nrg_64, ref_nrg, rtol=1e-9)
+        np.testing.assert_allclose(dx_64, ref_dx, rtol=1e-7, atol=1e-7)
+        np.testing.assert_allclose(dl_64, ref_dl, rtol=1e-7, atol=1e-7)
+
+        dx_32, dl_32, nrg_32 = test_fn(x, pair_idxs=pair_idxs, charge_scales=pair_charge_scales, lj_scales=pair_lj_scales)
+        force_scale = np.amax(np.abs(ref_dx))
+        np.testing.assert_allclose(nrg_32, ref_nrg, rtol=1e-4)
+        np.testing.assert_allclose(dx_32/force_scale, ref_dx/force_scale, atol=1e-4)
+
+        perm = np.random.permutation(pair_idxs.shape[0])
+        dx_perm, dl_perm, nrg_perm = test_fn(x, pair_idxs=pair_idxs[perm], charge_scales=pair_charge_scales[perm], lj_scales=pair_lj_scales[perm])
+        np.testing.assert_array_equal(dx_32, dx_perm)
+        np.testing.assert_array_equal(dl_32, dl_perm)
+        np.testing.assert_array_equal(nrg_32, nrg_perm)
+
+        # the fixed point path of nonbonded() gives the same bits through autodiff, and the
+        # second order derivatives are taken in floating point
+        nrg_fn = functools.partial(
+            nonbonded.nonbonded,
+            charge_params=charge_params,
+            lj_params=lj_params,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=charge_scales,
+            lj_scales=lj_scales,
+            cutoff=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs
+        )
+        nblist = neighborlist.build_neighbor_list(x, cutoff)
+        fp_nrg, (fp_dx, fp_dl) = jax.value_and_grad(nrg_fn, argnums=(0, 1))(x, lamb, nblist=nblist, precision=np.float32)
+        np.testing.assert_array_equal(fp_dx, dx_32)
+        np.testing.assert_array_equal(fp_nrg, nrg_32)
+        np.testing.assert_allclose(fp_dl, dl_32, rtol=1e-12)
+
+        dense_nrg, dense_dx = jax.value_and_grad(nrg_fn)(x, lamb, precision=np.float32)
+        np.testing.assert_array_equal(dense_nrg, nrg_32)
+        np.testing.assert_array_equal(dense_dx, dx_32)
+
+        tangent = np.random.randn(*x.shape)
+        ref_hvp = jax.jvp(jax.grad(nrg_fn), (x, lamb), (tangent, 0.0))[1]
+        test_hvp = jax.jvp(jax.grad(lambda x, l: nrg_fn(x, l, nblist=nblist, precision=np.float32)), (x, lamb), (tangent, 0.0))[1]
+        hvp_scale = np.amax(np.abs(ref_hvp))
+        np.testing.assert_allclose(test_hvp/hvp_scale, ref_hvp/hvp_scale, atol=1e-4)
+
+        # the nonbonded options carry over to the pair list, which omits the reaction field self energy
+        for options in [{"switch_distance": 0.8}, {"rf_dielectric": 78.5, "switch_distance": 0.8}]:
+            ref_nrg, (ref_dx, ref_dl) = jax.value_and_grad(nrg_fn, argnums=(0, 1))(x, lamb, **options)
+            if "rf_dielectric" in options:
+                ref_nrg -= nonbonded.reaction_field_self_energy(charge_params, cutoff, options["rf_dielectric"])
+            dx_64, dl_64, nrg_64 = test_fn(x, pair_idxs=pair_idxs, charge_scales=pair_charge_scales, lj_scales=pair_lj_scales,
+                precision=np.float64, **options)
+            np.testing.assert_allclose(nrg_64, ref_nrg, rtol=1e-9)
+            np.testing.assert_allclose(dx_64, ref_dx, rtol=1e-7, atol=1e-7)
+            np.testing.assert_allclose(dl_64, ref_dl, rtol=1e-7, atol=1e-7)
+
+    def test_reference_fixed_point(self):
+        np.random.seed(2038)
+
+        x = self.get_water_coords(3)[:30]
+        N = x.shape[0]
+        B = N//2
+
+        bond_idxs = np.random.choice(np.arange(N), size=(B, 2), replace=False).astype(np.int32)
+        bond_params = np.stack([np.random.rand(B)*1000, np.random.rand(B)/5 + 0.1], axis=1)
+
+        ref_nrg, ref_dx = jax.value_and_grad(bonded.harmonic_bond)(x, 0.0, bond_params, None, bond_idxs)
+        test_dx, test_nrg = fixed_point.bonded_gradients(bonded.harmonic_bond, x, 0.0, bond_params, None, bond_idxs)
+
+        # single precision reference gradients accumulate in fixed point
+        for precision, atol in [(np.float64, 1e-8), (np.float32, 5e-4)]:
+            du_dx, du_dl, nrg = reference.HarmonicBond(bond_idxs, bond_params, precision).execute_lambda(x, 0.0)
+            np.testing.assert_allclose(du_dx, ref_dx, rtol=atol, atol=atol)
+            np.testing.assert_allclose(nrg, ref_nrg, rtol=1e-5)
+
+        np.testing.assert_array_equal(du_dx, test_dx)
+        np.testing.assert_array_equal(nrg, test_nrg)
+
+        # single precision nonbonded pairs come from a neighbor list built on the host
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10 + 0.1, np.random.rand(N)], axis=1)
+        plane_idxs = np.zeros(N, dtype=np.int32)
+        offset_idxs = np.zeros(N, dtype=np.int32)
+        nonbonded_args = (charge_params, lj_params, bond_idxs, np.ones(B)*0.5, np.ones(B)*0.5, plane_idxs, offset_idxs, 0.5)
+
+        ref_dx, _, ref_nrg = reference.Nonbonded(*nonbonded_args, precision=np.float64).execute_lambda(x, 0.0)
+        nonbonded_fn = reference.Nonbonded(*nonbonded_args, precision=np.float32)
+        du_dx, _, nrg = nonbonded_fn.execute_lambda(x, 0.0)
+        self.assertEqual(nonbonded_fn.neighbor_list.num_builds, 1)
+        dx_scale = np.amax(np.abs(ref_dx))
+        np.testing.assert_allclose(du_dx/dx_scale, ref_dx/dx_scale, atol=1e-5)
+        np.testing.assert_allclose(nrg, ref_nrg, rtol=1e-5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.potentials import bonded, nonbonded, gbsa, fused
+
+
+class TestFused(GradientTest):
+
+    def test_nonbonded_gbsa(self):
+        np.random.seed(2032)
+
+        x = self.get_water_coords(3)[:180]
+        N = x.shape[0]
+        E = N//5
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+        gb_params = np.stack([(1.5*np.random.rand(N) + 1.0)/10, np.random.rand(N)/3 + 0.75], axis=1)
+
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        charge_scales = np.random.rand(E)
+        lj_scales = np.random.rand(E)
+        lambda_plane_idxs = np.random.randint(0, 2, size=N, dtype=np.int32)
+        lambda_offset_idxs = np.random.randint(0, 2, size=N, dtype=np.int32)
+        cutoff = 0.9
+
+        alpha, beta, gamma = 0.35, 0.7, 0.9
+
+        nb_fn = functools.partial(
+            nonbonded.nonbonded,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=charge_scales,
+            lj_scales=lj_scales,
+            cutoff=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs
+        )
+        gb_fn = functools.partial(
+            gbsa.gbsa_obc,
+            alpha=alpha,
+            beta=beta,
+            gamma=gamma,
+            cutoff_radii=cutoff,
+            cutoff_force=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs
+        )
+
+        kwargs = dict(
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=charge_scales,
+            lj_scales=lj_scales,
+            cutoff=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs,
+            alpha=alpha,
+            beta=beta,
+            gamma=gamma
+        )
+
+        for lamb in [0.0, 0.6]:
+            results = fused.nonbonded_gbsa_derivatives(x, lamb, charge_params, lj_params, gb_params, **kwargs)
+
+            nb_nrg, (nb_dx, nb_dl, nb_dq, nb_dlj) = jax.value_and_grad(nb_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, lj_params)
+            gb_nrg, (gb_dx, gb_dl, gb_dq, gb_dgb) = jax.value_and_grad(gb_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, gb_params)
+
+            lj, es, gb = results["LennardJones"], results["Electrostatics"], results["GBSA"]
+
+            np.testing.assert_allclose(lj["energy"] + es["energy"], nb_nrg, rtol=1e-10)
+            np.testing.assert_allclose(lj["du_dx"] + es["du_dx"], nb_dx, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(lj["du_dl"] + es["du_dl"], nb_dl, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(es["du_dcharge"], nb_dq, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(lj["du_dlj"], nb_dlj, rtol=1e-8, atol=1e-8)
+            np.testing.assert_array_equal(lj["du_dcharge"], 0)
+
+            np.testing.assert_allclose(gb["energy"], gb_nrg, rtol=1e-10)
+            np.testing.assert_allclose(gb["du_dx"], gb_dx, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(gb["du_dl"], gb_dl, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(gb["du_dcharge"], gb_dq, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(gb["du_dgb"], gb_dgb, rtol=1e-8, atol=1e-8)
+
+    def test_fused_bonded(self):
+        np.random.seed(2039)
+
+        x = self.get_water_coords(3)[:30]
+        N = x.shape[0]
+
+        bond_idxs = np.array([np.random.choice(N, size=2, replace=False) for _ in range(20)], dtype=np.int32)
+        bond_params = np.stack([np.random.rand(20)*100, np.random.rand(20)*0.2 + 0.05], axis=1)
+        angle_idxs = np.array([np.random.choice(N, size=3, replace=False) for _ in range(25)], dtype=np.int32)
+        angle_params = np.stack([np.random.rand(25)*50, np.random.rand(25)*np.pi], axis=1)
+
+        # propers repeated once per periodicity, followed by impropers
+        quads = np.array([np.random.choice(N, size=4, replace=False) for _ in range(12)], dtype=np.int32)
+        repeats = np.random.randint(1, 4, size=12)
+        torsion_idxs = np.concatenate([np.repeat(quads, repeats, axis=0), quads[:3]])
+        T = torsion_idxs.shape[0]
+        torsion_params = np.stack([np.random.rand(T)*10, np.random.rand(T)*np.pi, np.random.randint(1, 4, size=T)], axis=1).astype(np.float64)
+
+        fb = fused.FusedBonded(bond_idxs, angle_idxs, torsion_idxs)
+        assert fb.unique_torsion_idxs.shape[0] == 12
+
+        results = fb.derivatives(x, bond_params, angle_params, torsion_params)
+
+        refs = [
+            (bonded.harmonic_bond, bond_params, bond_idxs),
+            (bonded.harmonic_angle, angle_params, angle_idxs),
+            (bonded.periodic_torsion, torsion_params, torsion_idxs),
+        ]
+
+        for name, (fn, params, idxs) in zip(fused.BONDED_TERM_NAMES, refs):
+            ref_nrg, (ref_dx, ref_dp) = jax.value_and_grad(fn, argnums=(0, 2))(x, 0.0, params, None, idxs)
+            res = results[name]
+            assert res["energies"].shape == (idxs.shape[0],)
+            np.testing.assert_allclose(res["energy"], ref_nrg, rtol=1e-10)
+            np.testing.assert_allclose(np.sum(res["energies"]), ref_nrg, rtol=1e-10)
+            np.testing.assert_allclose(res["du_dx"], ref_dx, rtol=1e-8, atol=1e-8)
+            np.testing.assert_allclose(res["du_dp"], ref_dp, rtol=1e-8, atol=1e-8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+
+from common import GradientTest
+
+from timemachine.potentials import gbsa
+from timemachine.potentials.gbsa_incremental import IncrementalGBSA
+
+
+class TestIncrementalGBSA(GradientTest):
+
+    def test_incremental_gbsa(self):
+        np.random.seed(2034)
+
+        x = self.get_water_coords(3)[:300]
+        N = x.shape[0]
+        ligand_idxs = np.arange(N - 12, N)
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        gb_params = np.stack([(1.5*np.random.rand(N) + 1.0)/10, np.random.rand(N)/3 + 0.75], axis=1)
+        lambda_offset_idxs = np.zeros(N, dtype=np.int32)
+        lambda_offset_idxs[ligand_idxs] = 1
+
+        for cutoff in [0.6, 100.0]:
+            kwargs = dict(
+                alpha=0.35,
+                beta=0.7,
+                gamma=0.9,
+                cutoff_radii=cutoff,
+                cutoff_force=cutoff,
+                lambda_plane_idxs=np.zeros(N, dtype=np.int32),
+                lambda_offset_idxs=lambda_offset_idxs
+            )
+
+            ref_fn = functools.partial(gbsa.gbsa_obc, charge_params=charge_params, gb_params=gb_params, **kwargs)
+            test_gbsa = IncrementalGBSA(charge_params, gb_params, **kwargs)
+
+            x_t = np.copy(x)
+            for step, lamb in enumerate([0.0, 0.0, 0.0, 0.5, 0.5]):
+                if step > 0:
+                    x_t[ligand_idxs] += np.random.randn(len(ligand_idxs), 3)*0.05
+                np.testing.assert_allclose(test_gbsa.energy(x_t, lamb), ref_fn(x_t, lamb), rtol=1e-10)
+
+            # host jitter below the threshold is ignored
+            test_gbsa.threshold = 1e-3
+            x_jitter = np.copy(x_t)
+            x_jitter[:-12] += np.random.uniform(-1e-4, 1e-4, size=(N - 12, 3))
+            x_jitter[ligand_idxs] += 0.05
+            x_expected = np.copy(x_t)
+            x_expected[ligand_idxs] = x_jitter[ligand_idxs]
+            np.testing.assert_allclose(test_gbsa.energy(x_jitter, 0.5), ref_fn(x_expected, 0.5), rtol=1e-10)
+
+    def test_unbounded_cutoff(self):
+        np.random.seed(2035)
+
+        x = self.get_water_coords(3)[:300]
+        N = x.shape[0]
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        gb_params = np.stack([(1.5*np.random.rand(N) + 1.0)/10, np.random.rand(N)/3 + 0.75], axis=1)
+        # same cutoff as setup_system.create_system()
+        kwargs = dict(
+            alpha=0.35,
+            beta=0.7,
+            gamma=0.9,
+            cutoff_radii=100000.0,
+            cutoff_force=100000.0,
+            lambda_plane_idxs=np.zeros(N, dtype=np.int32),
+            lambda_offset_idxs=np.zeros(N, dtype=np.int32)
+        )
+        ref_fn = functools.partial(gbsa.gbsa_obc, charge_params=charge_params, gb_params=gb_params, **kwargs)
+
+        x_t = np.copy(x)
+        x_t[-1] += 0.01
+
+        # every Born radius changes, so the exact update recomputes the pair energy in full
+        exact_gbsa = IncrementalGBSA(charge_params, gb_params, **kwargs)
+        exact_gbsa.energy(x, 0.0)
+        np.testing.assert_allclose(exact_gbsa.energy(x_t, 0.0), ref_fn(x_t, 0.0), rtol=1e-10)
+        assert exact_gbsa.last_update == "incremental_full_pairs"
+
+        # far away radii barely change and keep their cached values
+        test_gbsa = IncrementalGBSA(charge_params, gb_params, born_tolerance=1e-3, **kwargs)
+        test_gbsa.energy(x, 0.0)
+        assert test_gbsa.last_update == "full"
+        np.testing.assert_allclose(test_gbsa.energy(x_t, 0.0), ref_fn(x_t, 0.0), rtol=1e-3)
+        assert test_gbsa.last_update == "incremental"
+
+
+if __name__ == "__main__":
+    unittest.main()
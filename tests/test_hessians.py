@@ -0,0 +1,137 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.potentials import bonded, nonbonded, hessians
+
+
+class TestHessians(GradientTest):
+
+    def setup_water(self, N):
+        np.random.seed(2045)
+        x = self.get_water_coords(3)[:N]
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10 + 0.1, np.random.rand(N)], axis=1)
+        bond_idxs = np.array([[i, i+1] for i in range(0, N-1, 3)] + [[i, i+2] for i in range(0, N-2, 3)], dtype=np.int32)
+        bond_params = np.stack([np.random.rand(len(bond_idxs))*1000, np.random.rand(len(bond_idxs))*0.05 + 0.09], axis=1)
+        return x, charge_params, lj_params, bond_idxs, bond_params
+
+    def test_hvp(self):
+        x, charge_params, lj_params, bond_idxs, bond_params = self.setup_water(30)
+        N = x.shape[0]
+        exclusion_idxs = bond_idxs
+        E = exclusion_idxs.shape[0]
+
+        energy_fn = functools.partial(
+            nonbonded.nonbonded,
+            lamb=0.2,
+            charge_params=charge_params,
+            lj_params=lj_params,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=np.ones(E),
+            lj_scales=np.ones(E),
+            cutoff=1.0,
+            lambda_plane_idxs=np.zeros(N, dtype=np.int32),
+            lambda_offset_idxs=np.ones(N, dtype=np.int32)
+        )
+
+        H = np.asarray(jax.hessian(energy_fn)(x)).reshape(N*3, N*3)
+        hvp = hessians.hvp_fn(energy_fn, x)
+
+        for _ in range(3):
+            v = np.random.randn(N, 3)
+            expected = (H @ v.reshape(-1)).reshape(N, 3)
+            np.testing.assert_allclose(hvp(v), expected, rtol=1e-8, atol=1e-6)
+            np.testing.assert_allclose(hessians.hvp(energy_fn, x, v), expected, rtol=1e-8, atol=1e-6)
+
+    def test_bonded_blocks(self):
+        x, _, _, _, _ = self.setup_water(30)
+        N = x.shape[0]
+
+        angle_idxs = np.array([np.random.choice(N, size=3, replace=False) for _ in range(15)], dtype=np.int32)
+        angle_params = np.stack([np.random.rand(15)*50, np.random.rand(15)*np.pi], axis=1)
+        torsion_idxs = np.array([np.random.choice(N, size=4, replace=False) for _ in range(15)], dtype=np.int32)
+        torsion_params = np.stack([np.random.rand(15)*10, np.random.rand(15)*np.pi, np.random.randint(1, 4, size=15)], axis=1).astype(np.float64)
+
+        for potential, params, idxs in [
+            (bonded.harmonic_angle, angle_params, angle_idxs),
+            (bonded.periodic_torsion, torsion_params, torsion_idxs)]:
+
+            def energy_fn(conf):
+                return potential(conf, 0.0, params, None, idxs)
+
+            H = np.asarray(jax.hessian(energy_fn)(x))
+
+            rows, cols, blocks = hessians.bonded_hessian_blocks(potential, x, 0.0, params, None, idxs)
+            np.testing.assert_allclose(hessians.block_sparse_to_dense(rows, cols, blocks, N), H, rtol=1e-8, atol=1e-8)
+
+            v = np.random.randn(N, 3)
+            np.testing.assert_allclose(
+                hessians.block_sparse_matvec(rows, cols, blocks, v),
+                hessians.hvp(energy_fn, x, v),
+                rtol=1e-8,
+                atol=1e-8
+            )
+
+    def test_lowest_modes(self):
+        x, _, _, bond_idxs, bond_params = self.setup_water(30)
+        N = x.shape[0]
+        masses = np.random.rand(N) + 1
+
+        energy_fn = functools.partial(bonded.harmonic_bond, lamb=0.0, params=bond_params, box=None, bond_idxs=bond_idxs)
+
+        H = np.asarray(jax.hessian(energy_fn)(x)).reshape(N*3, N*3)
+        m = np.repeat(masses, 3)
+        ref_evals = np.linalg.eigvalsh(H/np.sqrt(np.outer(m, m)))
+
+        matvec = hessians.mass_weighted_matvec(hessians.hvp_fn(energy_fn, x), masses)
+        evals, evecs = hessians.lowest_modes(matvec, x.shape, 5, num_iters=N*3)
+
+        np.testing.assert_allclose(evals, ref_evals[:5], atol=1e-6)
+        for e, v in zip(evals, evecs):
+            np.testing.assert_allclose(matvec(v), e*v, atol=1e-5)
+
+    def test_total_derivative(self):
+        x, charge_params, lj_params, bond_idxs, bond_params = self.setup_water(15)
+        N = x.shape[0]
+
+        def energy_fn(conf, params):
+            return bonded.harmonic_bond(conf, 0.0, params.reshape(bond_params.shape), None, bond_idxs)
+
+        params = bond_params.reshape(-1)
+        P = params.shape[0]
+        dxdp = np.random.randn(P, N, 3)
+
+        H = np.asarray(jax.hessian(energy_fn)(x, params))
+        mixed = np.asarray(jax.jacfwd(jax.grad(energy_fn), argnums=1)(x, params)) # [N, 3, P]
+        expected = np.einsum('ijkl,mkl->mij', H, dxdp) + np.transpose(mixed, (2, 0, 1))
+
+        np.testing.assert_allclose(hessians.total_derivative(energy_fn, x, params, dxdp), expected, rtol=1e-8, atol=1e-8)
+
+    def test_implicit_derivative(self):
+        x, charge_params, lj_params, bond_idxs, bond_params = self.setup_water(15)
+        N = x.shape[0]
+        x_ref = x + np.random.randn(N, 3)*0.01
+
+        # a restraint removes the zero modes
+        def energy_fn(conf, params):
+            restraint = 50.0*np.sum((conf - x_ref)**2)
+            return bonded.harmonic_bond(conf, 0.0, params.reshape(bond_params.shape), None, bond_idxs) + restraint
+
+        params = bond_params.reshape(-1)
+        dp = np.random.randn(params.shape[0])
+
+        dx = hessians.implicit_derivative(energy_fn, x, params, dp)
+
+        H = np.asarray(jax.hessian(energy_fn)(x, params)).reshape(N*3, N*3)
+        rhs = -jax.jvp(lambda p: jax.grad(energy_fn)(x, p), (params,), (dp,))[1]
+        np.testing.assert_allclose(H @ np.asarray(dx).reshape(-1), np.asarray(rhs).reshape(-1), rtol=1e-6, atol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+import os
+import tempfile
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from common import GradientTest
+
+from timemachine.potentials import host_grid
+from timemachine.potentials.host_guest import HostGuestNonbonded
+
+
+class TestHostGrid(GradientTest):
+
+    def setup_host_guest(self):
+        np.random.seed(2042)
+
+        x = self.get_water_coords(3)
+        N_H = 300
+        host_conf = x[:N_H]
+        # a small guest in the middle of the host, away from the host atoms
+        center = np.mean(host_conf, axis=0)
+        guest_conf = center + np.random.randn(4, 3)*0.05
+        N = N_H + guest_conf.shape[0]
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        # two distinct guest sigmas
+        lj_params = np.stack([np.random.rand(N)/10 + 0.1, np.random.rand(N)], axis=1)
+        lj_params[N_H:, 0] = [0.15, 0.15, 0.12, 0.12]
+
+        # keep the guest out of clashes
+        d = np.linalg.norm(np.expand_dims(guest_conf, 1) - np.expand_dims(host_conf, 0), axis=-1)
+        keep = np.all(d > 0.25, axis=0)
+        host_conf = host_conf[keep]
+        charge_params = np.concatenate([charge_params[:N_H][keep], charge_params[N_H:]])
+        lj_params = np.concatenate([lj_params[:N_H][keep], lj_params[N_H:]])
+
+        return host_conf, guest_conf, charge_params, lj_params
+
+    def test_interpolation(self):
+        host_conf, guest_conf, charge_params, lj_params = self.setup_host_guest()
+        N_H = host_conf.shape[0]
+        N = charge_params.shape[0]
+        cutoff = 1.0
+        spacing = 0.01
+
+        origin, shape = host_grid.pocket_bounds(guest_conf, np.arange(4), spacing, margin=0.1)
+        guest_lj = lj_params[N_H:]
+        es_grid, lj_grids = host_grid.tabulate_host_potentials(
+            host_conf, charge_params[:N_H], lj_params[:N_H], np.unique(guest_lj[:, 0]), origin, spacing, shape, cutoff)
+        assert lj_grids.shape == (2,) + shape
+
+        exclusion_idxs = np.array([[N_H, N_H+1], [N_H+1, N_H+2]], dtype=np.int32)
+        kwargs = dict(
+            host_conf=host_conf,
+            charge_params=charge_params,
+            lj_params=lj_params,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=np.array([1.0, 0.5]),
+            lj_scales=np.array([1.0, 0.5]),
+            cutoff=cutoff,
+            lambda_plane_idxs=np.zeros(N, dtype=np.int32),
+            lambda_offset_idxs=np.zeros(N, dtype=np.int32),
+            num_host_atoms=N_H
+        )
+
+        ref = HostGuestNonbonded(**kwargs)
+        ref_nrg, ref_dx = jax.value_and_grad(ref.interaction_energy)(guest_conf, 0.0)
+
+        for order, rtol in [(1, 5e-3), (3, 5e-4)]:
+            grid = host_grid.HostGrid(origin, spacing, es_grid, lj_grids, np.unique(guest_lj[:, 0]), order=order)
+
+            # the grid values are reproduced exactly at the grid points
+            points = host_grid.grid_points(origin, spacing, shape)[1:3, 2, 1:4].reshape(-1, 3)
+            sigma_idxs = np.zeros(points.shape[0], dtype=np.int32)
+            np.testing.assert_allclose(
+                host_grid.interpolate(lj_grids, sigma_idxs, grid.origin, spacing, points, order),
+                lj_grids[0, 1:3, 2, 1:4].reshape(-1),
+                rtol=1e-10
+            )
+
+            test = HostGuestNonbonded(host_grid=grid, **kwargs)
+            test_nrg, test_dx = jax.jit(jax.value_and_grad(test.interaction_energy))(guest_conf, 0.0)
+
+            np.testing.assert_allclose(test_nrg, ref_nrg, rtol=rtol)
+            force_scale = np.amax(np.abs(ref_dx))
+            np.testing.assert_allclose(test_dx/force_scale, ref_dx/force_scale, atol=50*rtol)
+
+    def test_grid_validity(self):
+        host_conf, guest_conf, charge_params, lj_params = self.setup_host_guest()
+        N_H = host_conf.shape[0]
+        N = charge_params.shape[0]
+        cutoff = 1.0
+        spacing = 0.02
+
+        origin, shape = host_grid.pocket_bounds(guest_conf, np.arange(4), spacing, margin=0.1)
+        sigmas = np.unique(lj_params[N_H:, 0])
+        es_grid, lj_grids = host_grid.tabulate_host_potentials(
+            host_conf, charge_params[:N_H], lj_params[:N_H], sigmas, origin, spacing, shape, cutoff)
+        grid = host_grid.HostGrid(origin, spacing, es_grid, lj_grids, sigmas)
+
+        kwargs = dict(
+            host_conf=host_conf,
+            charge_params=charge_params,
+            lj_params=lj_params,
+            exclusion_idxs=np.zeros((0, 2), dtype=np.int32),
+            charge_scales=np.zeros(0),
+            lj_scales=np.zeros(0),
+            cutoff=cutoff,
+            lambda_plane_idxs=np.zeros(N, dtype=np.int32),
+            lambda_offset_idxs=np.zeros(N, dtype=np.int32),
+            num_host_atoms=N_H
+        )
+        ref = HostGuestNonbonded(**kwargs)
+        test = HostGuestNonbonded(host_grid=grid, **kwargs)
+
+        # a guest atom that leaves the grid falls back to the explicit sum
+        outside = guest_conf.copy()
+        outside[0] += 0.5
+        assert grid.contains(guest_conf)
+        assert not grid.contains(outside)
+        ref_nrg, ref_dx = jax.value_and_grad(ref.interaction_energy)(outside, 0.0)
+        test_nrg, test_dx = jax.jit(jax.value_and_grad(test.interaction_energy))(outside, 0.0)
+        np.testing.assert_allclose(test_nrg, ref_nrg, rtol=1e-8)
+        np.testing.assert_allclose(test_dx, ref_dx, rtol=1e-8, atol=1e-8)
+
+        # the guest w has to match the w of the grid
+        plane_idxs = np.zeros(N, dtype=np.int32)
+        plane_idxs[N_H:] = 1
+        with self.assertRaises(ValueError):
+            HostGuestNonbonded(host_grid=grid, **dict(kwargs, lambda_plane_idxs=plane_idxs))
+
+        offset_idxs = np.zeros(N, dtype=np.int32)
+        offset_idxs[N_H:] = 1
+        decoupled = HostGuestNonbonded(host_grid=grid, **dict(kwargs, lambda_offset_idxs=offset_idxs))
+        np.testing.assert_allclose(decoupled.interaction_energy(guest_conf, 0.0), test.interaction_energy(guest_conf, 0.0))
+        with self.assertRaises(ValueError):
+            decoupled.interaction_energy(guest_conf, 0.5)
+
+        # mixed w within the guest cannot use a single grid
+        offset_idxs[N_H] = 0
+        with self.assertRaises(AssertionError):
+            HostGuestNonbonded(host_grid=grid, **dict(kwargs, lambda_offset_idxs=offset_idxs))
+
+    def test_disk_cache(self):
+        host_conf, guest_conf, charge_params, lj_params = self.setup_host_guest()
+        N_H = host_conf.shape[0]
+        spacing = 0.05
+        origin, shape = host_grid.pocket_bounds(guest_conf, np.arange(4), spacing)
+        sigmas = lj_params[N_H:, 0]
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            pdb_path = os.path.join(cache_dir, "host.pdb")
+            with open(pdb_path, "w") as fh:
+                fh.write("HETATM\n")
+
+            args = (cache_dir, pdb_path, "ff", host_conf, charge_params[:N_H], lj_params[:N_H], sigmas, origin, spacing, shape, 1.0)
+
+            grid = host_grid.load_or_build_host_grid(*args)
+            assert len(os.listdir(cache_dir)) == 2
+            cached = host_grid.load_or_build_host_grid(*args)
+            assert len(os.listdir(cache_dir)) == 2
+            np.testing.assert_array_equal(grid.lj_grids, cached.lj_grids)
+            np.testing.assert_array_equal(grid.es_grid, cached.es_grid)
+
+            # a different forcefield hash is a different grid
+            host_grid.load_or_build_host_grid(cache_dir, pdb_path, "ff2", *args[3:])
+            assert len(os.listdir(cache_dir)) == 3
+
+            # so is a different clipping value
+            clipped = host_grid.load_or_build_host_grid(*args, max_value=10.0)
+            assert len(os.listdir(cache_dir)) == 4
+            assert np.amax(np.abs(clipped.es_grid)) <= 10.0
+
+            nrg = grid.energy(guest_conf, charge_params[N_H:], lj_params[N_H:])
+            np.testing.assert_allclose(nrg, cached.energy(guest_conf, charge_params[N_H:], lj_params[N_H:]))
+
+
+if __name__ == "__main__":
+    unittest.main()
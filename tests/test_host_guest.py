@@ -0,0 +1,87 @@
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from common import GradientTest
+
+from timemachine.potentials import nonbonded
+from timemachine.potentials.host_guest import HostGuestNonbonded
+
+
+class TestHostGuest(GradientTest):
+
+    def test_host_guest_nonbonded(self):
+        np.random.seed(2041)
+
+        x = self.get_water_coords(3)[:90]
+        N = x.shape[0]
+        N_H = 75
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10 + 0.1, np.random.rand(N)], axis=1)
+
+        # host-host, host-guest and guest-guest exclusions
+        E = 30
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        assert np.any(np.all(exclusion_idxs < N_H, axis=1))
+        assert np.any(np.any(exclusion_idxs >= N_H, axis=1))
+        charge_scales = np.random.rand(E)
+        lj_scales = np.random.rand(E)
+
+        lambda_plane_idxs = np.zeros(N, dtype=np.int32)
+        lambda_offset_idxs = np.zeros(N, dtype=np.int32)
+        lambda_offset_idxs[N_H:] = 1
+
+        for cutoff, switch_distance in [(100000.0, None), (0.9, None), (0.9, 0.7)]:
+
+            hg = HostGuestNonbonded(
+                x[:N_H],
+                charge_params,
+                lj_params,
+                exclusion_idxs,
+                charge_scales,
+                lj_scales,
+                cutoff,
+                lambda_plane_idxs,
+                lambda_offset_idxs,
+                N_H,
+                switch_distance=switch_distance
+            )
+
+            def ref_fn(guest_conf, lamb):
+                conf = jnp.concatenate([x[:N_H], guest_conf])
+                return nonbonded.nonbonded(
+                    conf,
+                    lamb,
+                    charge_params,
+                    lj_params,
+                    exclusion_idxs,
+                    charge_scales,
+                    lj_scales,
+                    cutoff,
+                    lambda_plane_idxs,
+                    lambda_offset_idxs,
+                    switch_distance=switch_distance
+                )
+
+            interaction_grad = jax.jit(jax.value_and_grad(hg.interaction_energy, argnums=(0, 1)))
+
+            for lamb in [0.0, 0.3]:
+                for _ in range(2):
+                    guest_conf = x[N_H:] + np.random.randn(N-N_H, 3)*0.01
+
+                    ref_nrg, (ref_dx, ref_dl) = jax.value_and_grad(ref_fn, argnums=(0, 1))(guest_conf, lamb)
+                    np.testing.assert_allclose(hg.energy(guest_conf, lamb), ref_nrg, rtol=1e-10)
+
+                    test_nrg, (test_dx, test_dl) = interaction_grad(guest_conf, lamb)
+                    np.testing.assert_allclose(test_nrg + hg.host_energy(lamb), ref_nrg, rtol=1e-10)
+                    np.testing.assert_allclose(test_dx, ref_dx, rtol=1e-8, atol=1e-8)
+                    # the host does not depend on lambda here
+                    np.testing.assert_allclose(test_dl, ref_dl, rtol=1e-8, atol=1e-8)
+
+
+if __name__ == "__main__":
+    unittest.main()
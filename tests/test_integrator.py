@@ -0,0 +1,42 @@
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from timemachine.integrator import langevin_noise
+
+
+class TestLangevinNoise(unittest.TestCase):
+
+    def test_regenerate(self):
+        seed = 2049
+        N = 50
+        T = 20
+
+        noise = np.stack([langevin_noise(seed, step, N) for step in range(T)])
+        assert noise.shape == (T, N, 3)
+        assert noise.dtype == np.float64
+
+        # any step can be regenerated on its own, inside a jit or a scan, bit for bit
+        np.testing.assert_array_equal(langevin_noise(seed, 13, N), noise[13])
+        jit_fn = jax.jit(lambda step: langevin_noise(seed, step, N))
+        np.testing.assert_array_equal(jit_fn(7), noise[7])
+        _, scan_noise = jax.lax.scan(lambda c, step: (c, langevin_noise(seed, step, N)), 0, np.arange(T))
+        np.testing.assert_array_equal(scan_noise, noise)
+
+        # keyed per atom, so the first atoms do not depend on the number of atoms
+        np.testing.assert_array_equal(langevin_noise(seed, 3, 10), noise[3][:10])
+
+        # different steps and seeds are uncorrelated
+        assert np.abs(np.corrcoef(noise[0].reshape(-1), noise[1].reshape(-1))[0, 1]) < 0.3
+        assert np.any(langevin_noise(seed + 1, 0, N) != noise[0])
+
+    def test_moments(self):
+        noise = np.asarray(langevin_noise(2050, 0, 20000))
+        np.testing.assert_allclose(np.mean(noise), 0.0, atol=0.02)
+        np.testing.assert_allclose(np.std(noise), 1.0, atol=0.02)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+
+from timemachine import minimizer
+from timemachine.lib import reference
+
+
+class TestMinimizer(unittest.TestCase):
+
+    def test_quadratic(self):
+        np.random.seed(2020)
+
+        N = 10
+        x_min = np.random.rand(N, 3)
+        k = np.random.rand(N, 3)*100 + 1
+
+        def energy_fn(x):
+            return np.sum(0.5*k*(x - x_min)**2), k*(x - x_min)
+
+        x0 = x_min + np.random.randn(N, 3)*0.1
+        tolerance = 1e-3
+        for method in ["fire", "lbfgs"]:
+            x, summary = minimizer.minimize(energy_fn, x0, method=method, tolerance=tolerance)
+            assert summary["converged"]
+            assert summary["max_force"] <= tolerance
+            # each component of the force is k*(x - x_min) and at most the tolerance
+            np.testing.assert_allclose(x, x_min, rtol=0, atol=tolerance/np.amin(k))
+
+        with self.assertRaises(Exception):
+            minimizer.minimize(energy_fn, x0, method="sd")
+
+    def test_reference_gradients(self):
+        np.random.seed(2021)
+
+        # eight flexible waters on a perturbed grid, the O-H and H-H bonds keep each
+        # molecule together and are excluded from the nonbonded terms
+        W = 8
+        N = 3*W
+        water = np.array([[0.0, 0.0, 0.0], [0.09572, 0.0, 0.0], [-0.02400, 0.09266, 0.0]])
+        grid = np.stack(np.meshgrid(*[np.arange(2)]*3, indexing='ij'), axis=-1).reshape(W, 3)*0.31
+        x0 = (np.expand_dims(grid, 1) + water).reshape(N, 3) + np.random.randn(N, 3)*0.01
+
+        O_idxs = np.arange(W)*3
+        bond_idxs = np.concatenate([
+            np.stack([O_idxs, O_idxs + 1], axis=1),
+            np.stack([O_idxs, O_idxs + 2], axis=1),
+            np.stack([O_idxs + 1, O_idxs + 2], axis=1)
+        ]).astype(np.int32)
+        B = bond_idxs.shape[0]
+        bond_params = np.array([[462750.4, 0.09572]]*(2*W) + [[462750.4, 0.15139]]*W)
+
+        charge_params = np.tile([-0.834, 0.417, 0.417], W)*np.sqrt(138.935456)
+        lj_params = np.tile([[0.315061, 0.636386], [0.04, 0.192464], [0.04, 0.192464]], (W, 1))
+        exclusion_idxs = bond_idxs
+        plane_idxs = np.zeros(N, dtype=np.int32)
+        offset_idxs = np.zeros(N, dtype=np.int32)
+
+        gradients = [
+            reference.HarmonicBond(bond_idxs, bond_params, precision=np.float64),
+            reference.Nonbonded(charge_params, lj_params, exclusion_idxs, np.ones(B), np.ones(B), plane_idxs, offset_idxs, 1.0, precision=np.float64)
+        ]
+        energy_fn = minimizer.gradients_energy_fn(gradients, 0.0)
+        nrg0, du_dx0 = energy_fn(x0)
+
+        for method in ["fire", "lbfgs"]:
+            x, summary = minimizer.minimize(energy_fn, x0, method=method, tolerance=1.0, max_iterations=20000)
+            assert summary["converged"]
+            assert summary["energy"] < nrg0
+            nrg, du_dx = energy_fn(x)
+            assert minimizer.max_force(du_dx) <= 1.0
+            np.testing.assert_allclose(nrg, summary["energy"])
+
+
+if __name__ == "__main__":
+    unittest.main()
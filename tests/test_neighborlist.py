@@ -0,0 +1,251 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.potentials import nonbonded, neighborlist, gbsa
+
+
+class TestNeighborList(GradientTest):
+
+    def test_neighbor_list(self):
+        np.random.seed(2020)
+
+        x = self.get_water_coords(3)[:800]
+        N = x.shape[0]
+
+        for cutoff in [0.3, 0.8]:
+            nblist = neighborlist.build_neighbor_list(x, cutoff)
+            assert nblist.shape[0] == N
+
+            dij = np.linalg.norm(np.expand_dims(x, 0) - np.expand_dims(x, 1), axis=-1)
+            ref_pairs = set()
+            for i, j in zip(*np.where(dij <= cutoff)):
+                if j > i:
+                    ref_pairs.add((i, j))
+
+            test_pairs = set()
+            for i, nbrs in enumerate(np.asarray(nblist)):
+                for j in nbrs:
+                    if j < N:
+                        test_pairs.add((i, j))
+
+            assert ref_pairs == test_pairs
+
+        with self.assertRaises(ValueError):
+            neighborlist.build_neighbor_list(x, 0.8, max_neighbors=2)
+
+    def test_nonbonded_nblist(self):
+        np.random.seed(2021)
+
+        x = self.get_water_coords(3)[:600]
+        N = x.shape[0]
+        E = N//5
+
+        charge_params = (np.random.rand(N).astype(np.float64) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        charge_scales = np.random.rand(E)
+        lj_scales = np.random.rand(E)
+
+        lambda_plane_idxs = np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+        lambda_offset_idxs = np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+
+        cutoff = 0.8
+
+        nblist = neighborlist.build_neighbor_list(x, cutoff)
+
+        ref_fn = functools.partial(
+            nonbonded.nonbonded,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=charge_scales,
+            lj_scales=lj_scales,
+            cutoff=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs
+        )
+
+        test_fn = jax.jit(functools.partial(ref_fn, nblist=nblist))
+
+        for lamb in [0.0, 0.1, 0.5]:
+            ref_nrg, ref_grads = jax.value_and_grad(ref_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, lj_params)
+            test_nrg, test_grads = jax.value_and_grad(test_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, lj_params)
+
+            np.testing.assert_allclose(ref_nrg, test_nrg, rtol=1e-10)
+            for r, t in zip(ref_grads, test_grads):
+                np.testing.assert_allclose(r, t, rtol=1e-8, atol=1e-8)
+
+    def test_group_lennard_jones_nblist(self):
+        np.random.seed(2022)
+
+        x = self.get_water_coords(3)[:600]
+        N = x.shape[0]
+        E = N//5
+
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        lj_scales = np.random.rand(E)
+
+        lambda_plane_idxs = np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+        lambda_offset_idxs = np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+        lambda_group_idxs = np.random.randint(low=0, high=3, size=N, dtype=np.int32)
+
+        cutoff = 0.6
+        nblist = neighborlist.build_neighbor_list(x, cutoff)
+
+        ref_fn = functools.partial(
+            nonbonded.group_lennard_jones,
+            exclusion_idxs=exclusion_idxs,
+            lj_scales=lj_scales,
+            cutoff=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs,
+            lambda_group_idxs=lambda_group_idxs
+        )
+
+        for lamb in [0.0, 0.2]:
+            ref_nrg, ref_dx = jax.value_and_grad(ref_fn)(x, lamb, lj_params)
+            test_nrg, test_dx = jax.value_and_grad(ref_fn)(x, lamb, lj_params, nblist=nblist)
+            np.testing.assert_allclose(ref_nrg, test_nrg, rtol=1e-10)
+            np.testing.assert_allclose(ref_dx, test_dx, rtol=1e-8, atol=1e-8)
+
+    def test_gbsa_nblist(self):
+        np.random.seed(2033)
+
+        x = self.get_water_coords(3)[:500]
+        N = x.shape[0]
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        gb_params = np.stack([(1.5*np.random.rand(N) + 1.0)/10, np.random.rand(N)/3 + 0.75], axis=1)
+
+        cutoff = 0.7
+
+        ref_fn = functools.partial(
+            gbsa.gbsa_obc,
+            alpha=0.35,
+            beta=0.7,
+            gamma=0.9,
+            cutoff_radii=cutoff,
+            cutoff_force=cutoff,
+            lambda_plane_idxs=np.random.randint(low=0, high=2, size=N, dtype=np.int32),
+            lambda_offset_idxs=np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+        )
+
+        nblist = neighborlist.build_neighbor_list(x, cutoff)
+        test_fn = jax.jit(functools.partial(ref_fn, nblist=nblist))
+
+        for lamb in [0.0, 0.2]:
+            ref_nrg, ref_grads = jax.value_and_grad(ref_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, gb_params)
+            test_nrg, test_grads = jax.value_and_grad(test_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, gb_params)
+
+            np.testing.assert_allclose(ref_nrg, test_nrg, rtol=1e-10)
+            for r, t in zip(ref_grads, test_grads):
+                np.testing.assert_allclose(r, t, rtol=1e-8, atol=1e-8)
+
+    def test_periodic_neighbor_list(self):
+        np.random.seed(2023)
+
+        # triclinic box in reduced form
+        box = np.array([
+            [3.0, 0.0, 0.0],
+            [0.9, 2.8, 0.0],
+            [-1.0, 0.7, 2.6]
+        ])
+
+        N = 500
+        x = np.matmul(np.random.rand(N, 3), box)
+        cutoff = 1.0
+
+        nblist = neighborlist.build_neighbor_list(x, cutoff, box=box)
+
+        images = []
+        for a in range(-1, 2):
+            for b in range(-1, 2):
+                for c in range(-1, 2):
+                    images.append(a*box[0] + b*box[1] + c*box[2])
+        images = np.array(images)
+
+        ref_pairs = set()
+        for i in range(N):
+            dij = np.linalg.norm(x + np.expand_dims(images, 1) - x[i], axis=-1)
+            dij = np.amin(dij, axis=0)
+            for j in np.where(dij <= cutoff)[0]:
+                if j > i:
+                    ref_pairs.add((i, j))
+
+        test_pairs = set()
+        for i, nbrs in enumerate(np.asarray(nblist)):
+            for j in nbrs:
+                if j < N:
+                    test_pairs.add((i, j))
+
+        assert ref_pairs == test_pairs
+
+        with self.assertRaises(ValueError):
+            neighborlist.build_neighbor_list(x, 1.5, box=box)
+
+    def test_periodic_nonbonded(self):
+        np.random.seed(2024)
+
+        box = np.array([
+            [3.0, 0.0, 0.0],
+            [0.9, 2.8, 0.0],
+            [-1.0, 0.7, 2.6]
+        ])
+
+        # place atoms on a jittered lattice to avoid overlaps
+        grid = np.stack(np.meshgrid(*[np.arange(8)/8]*3, indexing='ij'), axis=-1).reshape(-1, 3)
+        x = np.matmul(grid + np.random.rand(*grid.shape)/50, box)
+        N = x.shape[0]
+        E = N//5
+
+        charge_params = (np.random.rand(N).astype(np.float64) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        charge_scales = np.random.rand(E)
+        lj_scales = np.random.rand(E)
+
+        lambda_plane_idxs = np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+        lambda_offset_idxs = np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+
+        cutoff = 1.0
+
+        ref_fn = functools.partial(
+            nonbonded.nonbonded,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=charge_scales,
+            lj_scales=lj_scales,
+            cutoff=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs,
+            box=box
+        )
+
+        nblist = neighborlist.build_neighbor_list(x, cutoff, box=box)
+        test_fn = functools.partial(ref_fn, nblist=nblist)
+
+        # shifting atoms by lattice vectors should not change anything
+        x_shifted = np.copy(x)
+        x_shifted[3] += box[1] - box[2]
+        x_shifted[11] -= box[0]
+
+        for lamb in [0.0, 0.3]:
+            ref_nrg, ref_grads = jax.value_and_grad(ref_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, lj_params)
+            test_nrg, test_grads = jax.value_and_grad(test_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, lj_params)
+
+            np.testing.assert_allclose(ref_nrg, test_nrg, rtol=1e-10)
+            for r, t in zip(ref_grads, test_grads):
+                np.testing.assert_allclose(r, t, rtol=1e-8, atol=1e-8)
+
+            shifted_nrg, shifted_grads = jax.value_and_grad(ref_fn, argnums=(0, 1, 2, 3))(x_shifted, lamb, charge_params, lj_params)
+            np.testing.assert_allclose(ref_nrg, shifted_nrg, rtol=1e-10)
+            for r, t in zip(ref_grads, shifted_grads):
+                np.testing.assert_allclose(r, t, rtol=1e-8, atol=1e-8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.potentials import nonbonded, pme
+
+
+class TestPME(GradientTest):
+
+    def get_periodic_system(self, N):
+        box = np.array([
+            [2.5, 0.0, 0.0],
+            [0.6, 2.4, 0.0],
+            [-0.7, 0.5, 2.3]
+        ])
+        x = np.matmul(np.random.rand(N, 3), box)
+        charges = np.random.rand(N) - 0.5
+        charges -= np.mean(charges)
+        return x, box, charges
+
+    def test_bspline_weights(self):
+        w = np.random.rand(100)
+        for order in [2, 4, 5, 6]:
+            theta = np.asarray(pme.bspline_weights(w, order))
+            np.testing.assert_allclose(np.sum(theta, axis=-1), 1.0, rtol=1e-12)
+            assert np.all(theta >= 0)
+
+    def test_reciprocal_energy(self):
+        np.random.seed(2025)
+
+        x, box, charges = self.get_periodic_system(60)
+        alpha = 3.0
+
+        ref_fn = functools.partial(nonbonded.reciprocal_energy, alpha=alpha, kmax=12)
+        test_fn = functools.partial(pme.pme_reciprocal_energy, alpha=alpha, grid_size=(40, 40, 40), order=6)
+
+        ref_nrg, (ref_dx, ref_dq) = jax.value_and_grad(ref_fn, argnums=(0, 2))(x, box, charges)
+        test_nrg, (test_dx, test_dq) = jax.jit(jax.value_and_grad(test_fn, argnums=(0, 2)))(x, box, charges)
+
+        np.testing.assert_allclose(ref_nrg, test_nrg, rtol=1e-5)
+        np.testing.assert_allclose(ref_dx, test_dx, rtol=1e-3, atol=1e-3)
+        np.testing.assert_allclose(ref_dq, test_dq, rtol=1e-4, atol=1e-4)
+
+    def test_electrostatics_pme(self):
+        np.random.seed(2026)
+
+        x, box, charges = self.get_periodic_system(80)
+        N = x.shape[0]
+        param_idxs = np.arange(N)
+
+        scale_matrix = np.ones((N, N)) - np.eye(N)
+        for i, j in np.random.randint(0, N, size=(20, 2)):
+            if i != j:
+                scale_matrix[i, j] = scale_matrix[j, i] = 0.5
+
+        ref_fn = functools.partial(
+            nonbonded.electrostatics,
+            box=box,
+            param_idxs=param_idxs,
+            scale_matrix=scale_matrix,
+            cutoff=1.0,
+            alpha=3.2,
+            kmax=12
+        )
+        test_fn = functools.partial(ref_fn, method="pme", pme_grid=40, pme_order=6)
+
+        ref_nrg, (ref_dx, ref_dp) = jax.value_and_grad(ref_fn, argnums=(0, 1))(x, charges)
+        test_nrg, (test_dx, test_dp) = jax.value_and_grad(test_fn, argnums=(0, 1))(x, charges)
+
+        np.testing.assert_allclose(ref_nrg, test_nrg, rtol=1e-5)
+        np.testing.assert_allclose(ref_dx, test_dx, rtol=1e-3, atol=1e-3)
+        np.testing.assert_allclose(ref_dp, test_dp, rtol=1e-4, atol=1e-4)
+
+        with self.assertRaises(ValueError):
+            ref_fn(x, charges, method="p3m")
+
+
+if __name__ == "__main__":
+    unittest.main()
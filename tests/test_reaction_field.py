@@ -0,0 +1,148 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+from simtk import openmm as mm
+from simtk import unit
+
+from common import GradientTest
+
+from timemachine.potentials import nonbonded, neighborlist
+from timemachine.potentials.jax_utils import convert_to_4d
+
+
+class TestReactionField(GradientTest):
+
+    def test_reaction_field(self):
+        np.random.seed(2043)
+
+        x = self.get_water_coords(3)[:150]
+        N = x.shape[0]
+        E = N//5
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        charge_scales = np.random.rand(E)
+        lj_scales = np.random.rand(E)
+
+        lambda_plane_idxs = np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+        lambda_offset_idxs = np.random.randint(low=0, high=2, size=N, dtype=np.int32)
+
+        cutoff = 0.8
+        rf_dielectric = 78.3
+        k_rf, c_rf = nonbonded.reaction_field_constants(cutoff, rf_dielectric)
+
+        # the pair energy vanishes at the cutoff
+        np.testing.assert_allclose(1/cutoff + k_rf*cutoff**2 - c_rf, 0, atol=1e-12)
+
+        ref_fn = functools.partial(
+            nonbonded.nongroup_electrostatics,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=charge_scales,
+            cutoff=cutoff,
+            lambda_plane_idxs=lambda_plane_idxs,
+            lambda_offset_idxs=lambda_offset_idxs,
+            rf_dielectric=rf_dielectric
+        )
+
+        nblist = neighborlist.build_neighbor_list(x, cutoff)
+        nblist_fn = jax.jit(functools.partial(ref_fn, nblist=nblist))
+
+        for lamb in [0.0, 0.4]:
+            # explicit double loop over pairs, exclusions only scale the Coulomb term
+            x4 = np.asarray(convert_to_4d(x, lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff))
+            scale = np.ones((N, N))
+            for (i, j), s in zip(exclusion_idxs, charge_scales):
+                scale[i, j] -= s
+                scale[j, i] -= s
+            expected = -c_rf*np.sum(charge_params**2)/2
+            for i in range(N):
+                dij = np.linalg.norm(x4[i+1:] - x4[i], axis=-1)
+                qij = charge_params[i]*charge_params[i+1:]
+                eij = qij*(scale[i, i+1:]/dij + k_rf*dij**2 - c_rf)
+                expected += np.sum(np.where(dij <= cutoff, eij, 0))
+
+            ref_nrg, ref_grads = jax.value_and_grad(ref_fn, argnums=(0, 1, 2))(x, lamb, charge_params)
+            np.testing.assert_allclose(ref_nrg, expected, rtol=1e-10)
+
+            test_nrg, test_grads = jax.value_and_grad(nblist_fn, argnums=(0, 1, 2))(x, lamb, charge_params)
+            np.testing.assert_allclose(test_nrg, ref_nrg, rtol=1e-10)
+            for r, t in zip(ref_grads, test_grads):
+                np.testing.assert_allclose(t, r, rtol=1e-8, atol=1e-8)
+                assert np.all(np.isfinite(r))
+
+            # nonbonded() picks up the same electrostatics
+            lj_nrg = nonbonded.nonbonded(x, lamb, np.zeros(N), lj_params, exclusion_idxs, charge_scales, lj_scales,
+                cutoff, lambda_plane_idxs, lambda_offset_idxs)
+            nb_nrg = nonbonded.nonbonded(x, lamb, charge_params, lj_params, exclusion_idxs, charge_scales, lj_scales,
+                cutoff, lambda_plane_idxs, lambda_offset_idxs, rf_dielectric=rf_dielectric)
+            np.testing.assert_allclose(nb_nrg, lj_nrg + ref_nrg, rtol=1e-10)
+
+    def test_reaction_field_openmm(self):
+        np.random.seed(2044)
+
+        N = 64
+        x = np.random.rand(N, 3)*2.0
+        charges = np.random.rand(N) - 0.5
+        cutoff = 0.9
+        rf_dielectric = 78.5
+        k_rf, c_rf = nonbonded.reaction_field_constants(cutoff, rf_dielectric)
+
+        # exclusions within the cutoff, as in GROMACS excluded pairs must not be further apart
+        dij = np.linalg.norm(np.expand_dims(x, 1) - np.expand_dims(x, 0), axis=-1)
+        close_idxs = np.argwhere(np.triu(dij < cutoff, k=1))
+        exclusion_idxs = close_idxs[np.random.choice(len(close_idxs), size=N//2, replace=False)].astype(np.int32)
+        charge_scales = np.random.choice([1.0, 0.5, 0.8333], size=N//2)
+
+        # OpenMM's CutoffNonPeriodic drops excluded pairs entirely and has no self energy, so
+        # the reaction field terms of the excluded pairs are added with a CustomBondForce and
+        # the self energy is added below.
+        system = mm.System()
+        force = mm.NonbondedForce()
+        force.setNonbondedMethod(mm.NonbondedForce.CutoffNonPeriodic)
+        force.setCutoffDistance(cutoff)
+        force.setReactionFieldDielectric(rf_dielectric)
+        for q in charges:
+            system.addParticle(1.0)
+            force.addParticle(q, 0.1, 0.0)
+        exclusion_force = mm.CustomBondForce("qij*(k_rf*r^2 - c_rf)")
+        exclusion_force.addGlobalParameter("k_rf", k_rf)
+        exclusion_force.addGlobalParameter("c_rf", c_rf)
+        exclusion_force.addPerBondParameter("qij")
+        ONE_4PI_EPS0 = 138.935456
+        for (i, j), s in zip(exclusion_idxs, charge_scales):
+            force.addException(int(i), int(j), (1 - s)*charges[i]*charges[j], 0.1, 0.0)
+            exclusion_force.addBond(int(i), int(j), [ONE_4PI_EPS0*charges[i]*charges[j]])
+        system.addForce(force)
+        system.addForce(exclusion_force)
+
+        context = mm.Context(system, mm.VerletIntegrator(0.001), mm.Platform.getPlatformByName("Reference"))
+        context.setPositions(x)
+        state = context.getState(getEnergy=True, getForces=True)
+        omm_nrg = state.getPotentialEnergy().value_in_unit(unit.kilojoule_per_mole)
+        omm_nrg -= c_rf*ONE_4PI_EPS0*np.sum(charges**2)/2
+        omm_forces = state.getForces(asNumpy=True).value_in_unit(unit.kilojoule_per_mole/unit.nanometer)
+
+        charge_params = charges*np.sqrt(ONE_4PI_EPS0)
+        lambda_idxs = np.zeros(N, dtype=np.int32)
+        nrg_fn = functools.partial(nonbonded.nonbonded, lamb=0.0, charge_params=charge_params, lj_params=np.zeros((N, 2)),
+            exclusion_idxs=exclusion_idxs, charge_scales=charge_scales, lj_scales=np.zeros(N//2), cutoff=cutoff,
+            lambda_plane_idxs=lambda_idxs, lambda_offset_idxs=lambda_idxs, rf_dielectric=rf_dielectric)
+
+        nblist = neighborlist.build_neighbor_list(x, cutoff)
+        for kwargs in [{}, {"nblist": nblist}]:
+            test_nrg, test_dx = jax.value_and_grad(lambda x: nrg_fn(x, **kwargs))(x)
+            np.testing.assert_allclose(test_nrg, omm_nrg, rtol=1e-8)
+            np.testing.assert_allclose(-test_dx, omm_forces, rtol=1e-6, atol=1e-6)
+
+        # the single precision fixed point pairs agree to float32 accuracy
+        fp_nrg, fp_dx = jax.value_and_grad(lambda x: nrg_fn(x, nblist=nblist, precision=np.float32))(x)
+        np.testing.assert_allclose(fp_nrg, omm_nrg, rtol=1e-5)
+        np.testing.assert_allclose(-fp_dx, omm_forces, rtol=1e-4, atol=1e-3)
+
+
+if __name__ == "__main__":
+    unittest.main()
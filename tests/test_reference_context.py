@@ -0,0 +1,277 @@
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+import jax.numpy as jnp
+
+from timemachine import integrator
+from timemachine.lib import reference
+from timemachine.observables.du_dl import DuDlStatistics
+from timemachine.potentials import bonded, nonbonded
+
+
+class TestReferenceContext(unittest.TestCase):
+
+    def setup_system(self, N):
+        E = N//3
+        B = N//2
+        D = 3
+
+        x0 = np.random.rand(N, D)*2
+        bond_idxs = np.random.choice(np.arange(N), size=(B, 2), replace=False).astype(np.int32)
+        bond_params = np.stack([np.random.rand(B)*10, np.random.rand(B)/5 + 0.1], axis=1)
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        charge_scales = np.random.rand(E)
+        lj_scales = np.random.rand(E)
+        plane_idxs = np.random.randint(0, 2, size=N, dtype=np.int32)
+        offset_idxs = np.random.randint(0, 2, size=N, dtype=np.int32)
+        cutoff = 100.0
+
+        final_gradients = [
+            ("HarmonicBond", (bond_idxs, bond_params)),
+            ("Nonbonded", (charge_params, lj_params, exclusion_idxs, charge_scales, lj_scales, plane_idxs, offset_idxs, cutoff))
+        ]
+
+        def ref_nrg_fn(x, lamb, bp, q, lj):
+            return [
+                bonded.harmonic_bond(x, lamb, bp, None, bond_idxs),
+                nonbonded.nonbonded(x, lamb, q, lj, exclusion_idxs, charge_scales, lj_scales, cutoff, plane_idxs, offset_idxs)
+            ]
+
+        return x0, final_gradients, (bond_params, charge_params, lj_params), ref_nrg_fn
+
+    def test_reverse_mode(self):
+        np.random.seed(2046)
+
+        N = 8
+        num_steps = 6
+        x0, final_gradients, ref_params, ref_nrg_fn = self.setup_system(N)
+
+        v0 = np.random.rand(N, 3)
+        lambda_schedule = np.random.rand(num_steps)
+        cas = np.random.rand(num_steps)
+        cbs = -np.random.rand(N)/10
+        ccs = np.zeros(N)
+        dts = np.random.rand(num_steps)*0.01
+        x_t_adjoint = np.random.rand(N, 3)
+
+        def integrate_once_through(x_t, v_t, bp, q, lj):
+            total_fn = lambda x, l: jnp.sum(jnp.stack(ref_nrg_fn(x, l, bp, q, lj)))
+            du_dl_fn = jax.jacfwd(lambda x, l: jnp.stack(ref_nrg_fn(x, l, bp, q, lj)), argnums=1)
+            all_du_dls = []
+            for step in range(num_steps):
+                lamb = lambda_schedule[step]
+                all_du_dls.append(du_dl_fn(x_t, lamb))
+                v_t = cas[step]*v_t + np.expand_dims(cbs, -1)*jax.grad(total_fn)(x_t, lamb)
+                x_t = x_t + v_t*dts[step]
+            all_du_dls = jnp.stack(all_du_dls, axis=1)
+            return jnp.sum(all_du_dls*all_du_dls) + jnp.sum(x_t*x_t_adjoint), (all_du_dls, x_t)
+
+        (ref_loss, (ref_du_dls, ref_x_T)), ref_grads = jax.value_and_grad(
+            integrate_once_through, argnums=(0, 2, 3, 4), has_aux=True)(x0, v0, *ref_params)
+
+        gradients = [getattr(reference, name)(*args, precision=np.float64) for name, args in final_gradients]
+        stepper = reference.AlchemicalStepper_f64(gradients, lambda_schedule)
+        ctxt = reference.ReversibleContext_f64(stepper, x0, v0, cas, cbs, ccs, dts, 1234)
+        ctxt.forward_mode()
+
+        test_du_dls = stepper.get_du_dl()
+        assert test_du_dls.shape == (2, num_steps)
+        np.testing.assert_allclose(test_du_dls, ref_du_dls, rtol=1e-10)
+        np.testing.assert_allclose(ctxt.get_last_coords(), ref_x_T, rtol=1e-10)
+        assert ctxt.get_all_coords().shape == (num_steps + 1, N, 3)
+        np.testing.assert_allclose(
+            stepper.get_energies(),
+            [sum(ref_nrg_fn(x, l, *ref_params)) for x, l in zip(ctxt.get_all_coords(), lambda_schedule)],
+            rtol=1e-10
+        )
+
+        stepper.set_du_dl_adjoint(2*test_du_dls)
+        ctxt.set_x_t_adjoint(x_t_adjoint)
+        ctxt.backward_mode()
+
+        ref_dx0, ref_dbp, ref_dq, ref_dlj = ref_grads
+        np.testing.assert_allclose(ctxt.get_x_t_adjoint(), ref_dx0, rtol=1e-8)
+        np.testing.assert_allclose(gradients[0].get_du_dp_tangents(), ref_dbp, rtol=1e-8)
+        np.testing.assert_allclose(gradients[1].get_du_dcharge_tangents(), ref_dq, rtol=1e-8)
+        np.testing.assert_allclose(gradients[1].get_du_dlj_tangents(), ref_dlj, rtol=1e-8)
+
+        with self.assertRaises(Exception):
+            stepper.set_du_dl_adjoint(np.zeros(num_steps))
+
+    def test_checkpointing(self):
+        np.random.seed(2048)
+
+        N = 8
+        num_steps = 23
+        x0, final_gradients, _, _ = self.setup_system(N)
+        v0 = np.random.rand(N, 3)
+        lambda_schedule = np.random.rand(num_steps)
+        cas = np.ones(num_steps)*0.9
+        cbs = -np.ones(N)*1e-3
+        ccs = np.ones(N)*0.1
+        dts = np.ones(num_steps)*1e-3
+        x_t_adjoint = np.random.rand(N, 3)
+
+        snapshot_bytes = 2*N*3*8
+        # the four frames after x0 count against the budget
+        frame_bytes = 4*N*3*8
+        results = []
+        for memory_budget in [None, frame_bytes, frame_bytes + 3*snapshot_bytes, 10**9]:
+            gradients = [getattr(reference, name)(*args, precision=np.float64) for name, args in final_gradients]
+            stepper = reference.AlchemicalStepper(gradients, lambda_schedule)
+            ctxt = reference.ReversibleContext(stepper, x0, v0, cas, cbs, ccs, dts, 2020, memory_budget=memory_budget, frame_interval=5)
+            ctxt.forward_mode()
+            du_dls = stepper.get_du_dl()
+            stepper.set_du_dl_adjoint(np.cos(du_dls))
+            ctxt.set_x_t_adjoint(x_t_adjoint)
+            ctxt.backward_mode()
+            results.append((
+                du_dls,
+                ctxt.get_frames(),
+                ctxt.get_x_t_adjoint(),
+                ctxt.get_v_t_adjoint(),
+                gradients[0].get_du_dp_tangents(),
+                gradients[1].get_du_dcharge_tangents(),
+                gradients[1].get_du_dlj_tangents()
+            ))
+
+            summary = ctxt.get_schedule_summary()
+            if memory_budget is None:
+                assert summary is None
+            else:
+                assert summary["peak_snapshots"] <= (memory_budget - frame_bytes)//snapshot_bytes
+
+        assert results[0][1].shape == (5, N, 3)
+
+        # without a frame_interval a checkpointed context only keeps x0, and frames that do
+        # not fit in the budget are refused
+        stepper = reference.AlchemicalStepper(gradients, lambda_schedule)
+        ctxt = reference.ReversibleContext(stepper, x0, v0, cas, cbs, ccs, dts, 2020, memory_budget=3*snapshot_bytes)
+        ctxt.forward_mode()
+        np.testing.assert_array_equal(ctxt.get_frames(), [x0])
+        with self.assertRaises(ValueError):
+            reference.ReversibleContext(stepper, x0, v0, cas, cbs, ccs, dts, 2020, memory_budget=3*snapshot_bytes, frame_interval=1)
+        for test in results[1:]:
+            for a, b in zip(results[0], test):
+                np.testing.assert_allclose(a, b, rtol=1e-10, atol=1e-12)
+
+    def test_noise(self):
+        np.random.seed(2047)
+
+        N = 8
+        num_steps = 5
+        x0, final_gradients, _, _ = self.setup_system(N)
+
+        def run(seed):
+            gradients = [getattr(reference, name)(*args, precision=np.float64) for name, args in final_gradients]
+            stepper = reference.AlchemicalStepper(gradients, np.zeros(num_steps))
+            ctxt = reference.ReversibleContext(
+                stepper, x0, np.zeros_like(x0), np.ones(num_steps)*0.9, -np.ones(N)*1e-3, np.ones(N)*0.1, np.ones(num_steps)*1e-3, seed)
+            ctxt.forward_mode()
+            return ctxt.get_all_coords()
+
+        np.testing.assert_array_equal(run(2020), run(2020))
+        assert np.any(run(2020) != run(2021))
+
+    def test_du_dl_statistics(self):
+        np.random.seed(2049)
+
+        N = 8
+        num_steps = 17
+        x0, final_gradients, _, _ = self.setup_system(N)
+        lambda_schedule = np.random.rand(num_steps)
+        ctxt_args = (x0, np.zeros_like(x0), np.ones(num_steps)*0.9, -np.ones(N)*1e-3, np.ones(N)*0.1, np.ones(num_steps)*1e-3, 2020)
+
+        gradients = [getattr(reference, name)(*args, precision=np.float64) for name, args in final_gradients]
+        stepper = reference.AlchemicalStepper(gradients, lambda_schedule)
+        ref_ctxt = reference.ReversibleContext(stepper, *ctxt_args, frame_interval=3)
+        ref_ctxt.forward_mode()
+        equil = stepper.get_du_dl()[:, 3:]
+        ref_energies = stepper.get_energies()
+
+        # streamed scans with one or several chunks, and per step (checkpointed) forward passes
+        for memory_budget, chunk_size in [(None, 1000), (None, 5), (5*N*3*8, 1000)]:
+            gradients = [getattr(reference, name)(*args, precision=np.float64) for name, args in final_gradients]
+            statistics = DuDlStatistics(len(gradients), burn_in=3, block_size=4, decimation=2)
+            stepper = reference.AlchemicalStepper(gradients, lambda_schedule, statistics=statistics)
+            ctxt = reference.ReversibleContext(stepper, *ctxt_args, memory_budget=memory_budget, frame_interval=3, chunk_size=chunk_size)
+            ctxt.forward_mode()
+
+            assert stepper.get_du_dl() is None
+            np.testing.assert_allclose(ctxt.get_frames(), ref_ctxt.get_frames(), rtol=1e-10)
+            np.testing.assert_allclose(stepper.get_energies(), ref_energies, rtol=1e-10)
+            if memory_budget is None:
+                with self.assertRaises(Exception):
+                    ctxt.get_all_coords()
+            summary = stepper.get_du_dl_statistics()
+            np.testing.assert_allclose(summary["means"], np.mean(equil, axis=1), rtol=1e-10)
+            np.testing.assert_allclose(summary["variances"], np.var(equil, axis=1, ddof=1), rtol=1e-8)
+            np.testing.assert_allclose(summary["block_averages"], np.mean(equil[:, :12].reshape(2, 3, 4), axis=2), rtol=1e-10)
+            np.testing.assert_allclose(summary["decimated"], equil[:, ::2], rtol=1e-10)
+
+    def test_respa(self):
+        np.random.seed(2050)
+
+        N = 8
+        k = 3
+        num_steps = 10
+        x0, final_gradients, ref_params, ref_nrg_fn = self.setup_system(N)
+
+        v0 = np.random.rand(N, 3)
+        lambda_schedule = np.random.rand(num_steps)
+        cas = np.random.rand(num_steps)
+        cbs = -np.random.rand(N)/10
+        ccs = np.zeros(N)
+        dts = np.random.rand(num_steps)*0.01
+        x_t_adjoint = np.random.rand(N, 3)
+
+        def integrate_once_through(x_t, v_t, bp, q, lj):
+            # bonded every step, nonbonded as an impulse every k steps with its du_dl held in between
+            bond_fn = lambda x, l: ref_nrg_fn(x, l, bp, q, lj)[0]
+            nb_fn = lambda x, l: ref_nrg_fn(x, l, bp, q, lj)[1]
+            all_du_dls = []
+            for step in range(num_steps):
+                lamb = lambda_schedule[step]
+                du_dx = jax.grad(bond_fn)(x_t, lamb)
+                if step % k == 0:
+                    nb_du_dl = jax.grad(nb_fn, argnums=1)(x_t, lamb)
+                    du_dx = du_dx + k*jax.grad(nb_fn)(x_t, lamb)
+                all_du_dls.append(jnp.stack([jax.grad(bond_fn, argnums=1)(x_t, lamb), nb_du_dl]))
+                v_t = cas[step]*v_t + np.expand_dims(cbs, -1)*du_dx
+                x_t = x_t + v_t*dts[step]
+            all_du_dls = jnp.stack(all_du_dls, axis=1)
+            return jnp.sum(all_du_dls*all_du_dls) + jnp.sum(x_t*x_t_adjoint), all_du_dls
+
+        (_, ref_du_dls), ref_grads = jax.value_and_grad(
+            integrate_once_through, argnums=(0, 2, 3, 4), has_aux=True)(x0, v0, *ref_params)
+        ref_dx0, ref_dbp, ref_dq, ref_dlj = ref_grads
+
+        intervals = integrator.respa_intervals([name for name, _ in final_gradients], k)
+        np.testing.assert_array_equal(intervals, [1, k])
+
+        for memory_budget in [None, 0]:
+            gradients = [getattr(reference, name)(*args, precision=np.float64) for name, args in final_gradients]
+            stepper = reference.AlchemicalStepper(gradients, lambda_schedule, intervals=intervals)
+            ctxt = reference.ReversibleContext(stepper, x0, v0, cas, cbs, ccs, dts, 1234, memory_budget=memory_budget)
+            ctxt.forward_mode()
+
+            test_du_dls = stepper.get_du_dl()
+            np.testing.assert_allclose(test_du_dls, ref_du_dls, rtol=1e-10)
+
+            stepper.set_du_dl_adjoint(2*test_du_dls)
+            ctxt.set_x_t_adjoint(x_t_adjoint)
+            ctxt.backward_mode()
+
+            np.testing.assert_allclose(ctxt.get_x_t_adjoint(), ref_dx0, rtol=1e-8)
+            np.testing.assert_allclose(gradients[0].get_du_dp_tangents(), ref_dbp, rtol=1e-8)
+            np.testing.assert_allclose(gradients[1].get_du_dcharge_tangents(), ref_dq, rtol=1e-8)
+            np.testing.assert_allclose(gradients[1].get_du_dlj_tangents(), ref_dlj, rtol=1e-8)
+
+
+if __name__ == "__main__":
+    unittest.main()
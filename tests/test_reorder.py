@@ -0,0 +1,99 @@
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from fe import reorder
+from timemachine.potentials import bonded, nonbonded
+
+
+class TestReorder(GradientTest):
+
+    def test_hilbert_index(self):
+        # every cell of the grid is visited exactly once, by unit steps
+        for bits in [1, 2, 4]:
+            n = 2**bits
+            grid = np.stack(np.meshgrid(*[np.arange(n)]*3, indexing='ij'), axis=-1).reshape(-1, 3).astype(np.float64)
+            h = reorder.hilbert_index(grid, bits)
+            np.testing.assert_array_equal(np.sort(h), np.arange(n**3))
+            path = grid[np.argsort(h)]
+            np.testing.assert_array_equal(np.sum(np.abs(np.diff(path, axis=0)), axis=-1), 1)
+
+    def test_reorder_gradients(self):
+        np.random.seed(2040)
+
+        x = self.get_water_coords(3)[:60]
+        N = x.shape[0]
+        np.random.shuffle(x)
+
+        bond_idxs = np.array([np.random.choice(N, size=2, replace=False) for _ in range(20)], dtype=np.int32)
+        bond_params = np.stack([np.random.rand(20)*100, np.random.rand(20)*0.2 + 0.05], axis=1)
+        torsion_idxs = np.array([np.random.choice(N, size=4, replace=False) for _ in range(10)], dtype=np.int32)
+        torsion_params = np.stack([np.random.rand(10), np.random.rand(10), np.random.randint(1, 4, size=10)], axis=1).astype(np.float64)
+
+        E = 15
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10 + 0.1, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+        plane_idxs = np.zeros(N, dtype=np.int32)
+        offset_idxs = np.zeros(N, dtype=np.int32)
+        offset_idxs[N//2:] = 1
+
+        masses = np.random.rand(N) + 1
+        group_a = np.arange(N//2, N, dtype=np.int32)
+        group_b = np.arange(5, dtype=np.int32)
+
+        final_gradients = [
+            ('HarmonicBond', (bond_idxs, bond_params)),
+            ('PeriodicTorsion', (torsion_idxs, torsion_params)),
+            ('Nonbonded', (charge_params, lj_params, exclusion_idxs, np.random.rand(E), np.random.rand(E), plane_idxs, offset_idxs, 1.0)),
+            ('CentroidRestraint', (group_a, group_b, masses, 30.0, 0.5, 1, 0)),
+        ]
+
+        def energy_fn(conf, lamb, gradients):
+            nrg = 0
+            for name, args in gradients:
+                if name == 'HarmonicBond':
+                    nrg += bonded.harmonic_bond(conf, lamb, args[1], None, args[0])
+                elif name == 'PeriodicTorsion':
+                    nrg += bonded.periodic_torsion(conf, lamb, args[1], None, args[0])
+                elif name == 'Nonbonded':
+                    q, lj, excl, cs, ls, plane, offset, cutoff = args
+                    nrg += nonbonded.nonbonded(conf, lamb, q, lj, excl, cs, ls, cutoff, plane, offset)
+                elif name == 'CentroidRestraint':
+                    a, b, m, kb, b0, flag, offset = args
+                    nrg += bonded.centroid_restraint(conf, lamb, m, flag, offset, a, b, kb, b0)
+            return nrg
+
+        perm = reorder.hilbert_permutation(x)
+        r = reorder.Reordering(perm)
+        np.testing.assert_array_equal(r.restore_atoms(r.permute_atoms(x)), x)
+
+        new_gradients = [reorder.reorder_gradient(r, name, args) for name, args in final_gradients]
+        new_x = r.permute_atoms(x)
+
+        for lamb in [0.0, 0.4]:
+            ref_nrg, (ref_dx, ref_dl) = jax.value_and_grad(energy_fn, argnums=(0, 1))(x, lamb, final_gradients)
+            test_nrg, (test_dx, test_dl) = jax.value_and_grad(energy_fn, argnums=(0, 1))(new_x, lamb, new_gradients)
+
+            np.testing.assert_allclose(test_nrg, ref_nrg, rtol=1e-10)
+            np.testing.assert_allclose(test_dl, ref_dl, rtol=1e-8)
+            np.testing.assert_allclose(r.restore_atoms(test_dx), ref_dx, rtol=1e-8, atol=1e-8)
+
+        # per atom parameter derivatives come back in the original order
+        def charge_energy(q, conf, gradients):
+            args = list(gradients[2][1])
+            args[0] = q
+            return energy_fn(conf, 0.0, [('Nonbonded', tuple(args))])
+
+        ref_dq = jax.grad(charge_energy)(charge_params, x, final_gradients)
+        test_dq = jax.grad(charge_energy)(r.permute_atoms(charge_params), new_x, new_gradients)
+        restore_fn = r.restore_vjp_fn(lambda adjoint: adjoint)
+        np.testing.assert_allclose(restore_fn(test_dq), ref_dq, rtol=1e-8, atol=1e-8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,80 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.potentials import nonbonded, gbsa, tiled
+
+
+class TestTiled(GradientTest):
+
+    def test_nonbonded_tiled(self):
+        np.random.seed(2030)
+
+        x = self.get_water_coords(3)[:250]
+        N = x.shape[0]
+        E = N//5
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+
+        kwargs = dict(
+            exclusion_idxs=np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32),
+            charge_scales=np.random.rand(E),
+            lj_scales=np.random.rand(E),
+            cutoff=0.9,
+            lambda_plane_idxs=np.random.randint(0, 2, size=N, dtype=np.int32),
+            lambda_offset_idxs=np.random.randint(0, 2, size=N, dtype=np.int32)
+        )
+
+        ref_fn = functools.partial(nonbonded.nonbonded, **kwargs)
+
+        for tile_size in [32, 100, 512]:
+            test_fn = jax.jit(functools.partial(tiled.nonbonded_tiled, tile_size=tile_size, **kwargs))
+            for lamb in [0.0, 0.4]:
+                ref_nrg, ref_grads = jax.value_and_grad(ref_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, lj_params)
+                test_nrg, test_grads = jax.value_and_grad(test_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, lj_params)
+                np.testing.assert_allclose(ref_nrg, test_nrg, rtol=1e-10)
+                for r, t in zip(ref_grads, test_grads):
+                    assert np.all(np.isfinite(t))
+                    np.testing.assert_allclose(r, t, rtol=1e-8, atol=1e-8)
+
+    def test_gbsa_tiled(self):
+        np.random.seed(2031)
+
+        x = self.get_water_coords(3)[:200]
+        N = x.shape[0]
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        radii = (1.5*np.random.rand(N) + 1.0)/10
+        scales = np.random.rand(N)/3 + 0.75
+        gb_params = np.stack([radii, scales], axis=1)
+
+        kwargs = dict(
+            alpha=0.35,
+            beta=0.7,
+            gamma=0.9,
+            cutoff_radii=0.8,
+            cutoff_force=0.8,
+            lambda_plane_idxs=np.random.randint(0, 2, size=N, dtype=np.int32),
+            lambda_offset_idxs=np.random.randint(0, 2, size=N, dtype=np.int32)
+        )
+
+        ref_fn = functools.partial(gbsa.gbsa_obc, **kwargs)
+        test_fn = jax.jit(functools.partial(tiled.gbsa_obc_tiled, tile_size=48, **kwargs))
+
+        for lamb in [0.0, 0.3]:
+            ref_nrg, ref_grads = jax.value_and_grad(ref_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, gb_params)
+            test_nrg, test_grads = jax.value_and_grad(test_fn, argnums=(0, 1, 2, 3))(x, lamb, charge_params, gb_params)
+            np.testing.assert_allclose(ref_nrg, test_nrg, rtol=1e-10)
+            for r, t in zip(ref_grads, test_grads):
+                assert np.all(np.isfinite(t))
+                np.testing.assert_allclose(r, t, rtol=1e-8, atol=1e-8)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+import functools
+import unittest
+from jax.config import config; config.update("jax_enable_x64", True)
+
+import numpy as np
+import jax
+
+from common import GradientTest
+
+from timemachine.potentials import nonbonded, neighborlist
+
+
+class TestVerletList(GradientTest):
+
+    def test_switch_fn(self):
+        cutoff = 1.0
+        switch_distance = 0.8
+        sw_fn = functools.partial(nonbonded.switch_fn, cutoff=cutoff, switch_distance=switch_distance)
+        d_sw = jax.grad(sw_fn)
+        dd_sw = jax.grad(d_sw)
+
+        np.testing.assert_allclose(sw_fn(0.5), 1.0)
+        np.testing.assert_allclose(sw_fn(0.8), 1.0)
+        np.testing.assert_allclose(sw_fn(1.0), 0.0, atol=1e-12)
+        np.testing.assert_allclose(sw_fn(1.2), 0.0)
+        np.testing.assert_allclose(sw_fn(0.9), 0.5)
+        for d in [0.8, 1.0]:
+            np.testing.assert_allclose(d_sw(d), 0.0, atol=1e-10)
+            np.testing.assert_allclose(dd_sw(d), 0.0, atol=1e-8)
+
+        # switched pair energies and forces vanish continuously at the cutoff
+        x = np.array([[0.0, 0.0, 0.0], [cutoff - 1e-7, 0.0, 0.0]])
+        lj_params = np.array([[0.3, 1.0], [0.3, 1.0]])
+        nrg_fn = functools.partial(nonbonded.lennard_jones, lj_params=lj_params, cutoff=cutoff, switch_distance=switch_distance)
+        nrg, dx = jax.value_and_grad(nrg_fn)(x)
+        np.testing.assert_allclose(nrg, 0.0, atol=1e-12)
+        np.testing.assert_allclose(dx, 0.0, atol=1e-10)
+
+    def test_verlet_list(self):
+        np.random.seed(2044)
+
+        x = self.get_water_coords(3)[:300]
+        N = x.shape[0]
+        E = N//5
+
+        charge_params = (np.random.rand(N) - 0.5)*np.sqrt(138.935456)
+        lj_params = np.stack([np.random.rand(N)/10, np.random.rand(N)], axis=1)
+        exclusion_idxs = np.random.choice(np.arange(N), size=(E, 2), replace=False).astype(np.int32)
+
+        cutoff = 0.7
+        skin = 0.1
+
+        ref_fn = functools.partial(
+            nonbonded.nonbonded,
+            lamb=0.0,
+            charge_params=charge_params,
+            lj_params=lj_params,
+            exclusion_idxs=exclusion_idxs,
+            charge_scales=np.random.rand(E),
+            lj_scales=np.random.rand(E),
+            cutoff=cutoff,
+            lambda_plane_idxs=np.zeros(N, dtype=np.int32),
+            lambda_offset_idxs=np.zeros(N, dtype=np.int32),
+            switch_distance=0.6
+        )
+        ref_grad = jax.jit(jax.grad(ref_fn))
+        test_grad = jax.jit(jax.grad(lambda x, nblist: ref_fn(x, nblist=nblist)))
+
+        nbl = neighborlist.VerletNeighborList(cutoff, skin)
+
+        num_steps = 20
+        for step in range(num_steps):
+            x = x + np.random.randn(N, 3)*0.01
+            nblist = nbl.update(x)
+            assert nbl.max_displacement(x) <= skin/2
+            np.testing.assert_allclose(test_grad(x, nblist), ref_grad(x), rtol=1e-8, atol=1e-8)
+
+        # the list was reused for most steps
+        assert 1 < nbl.num_builds < num_steps//2
+
+
+if __name__ == "__main__":
+    unittest.main()
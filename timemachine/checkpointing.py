@@ -0,0 +1,144 @@
+"""
+Binomial (revolve-style) checkpointing for the reverse pass over a trajectory.
+Instead of storing every frame, only a bounded number of snapshots are held and
+the frames in between are recomputed from the nearest snapshot when the adjoint
+pass reaches them. See Griewank and Walther, ACM TOMS 26 (2000).
+"""
+
+
+def binomial_steps(num_snapshots, num_reps):
+    """
+    C(s+r, s), the number of steps that can be reversed while holding num_snapshots
+    states, including the state at the start, if no step is advanced more than num_reps times.
+    """
+    s, r = num_snapshots, num_reps
+    beta = 1
+    for i in range(1, r + 1):
+        beta = beta*(s + i)//i
+    return beta
+
+
+class CheckpointSchedule():
+
+    def __init__(self, num_steps, num_snapshots):
+        """
+        Sequence of actions that reverse num_steps steps while holding at most
+        num_snapshots states in addition to the initial state.
+
+        The actions are tuples of:
+            ("advance", a, b): recompute the state at step b from the held state at step a
+            ("store", t): hold the state at step t, which was just computed
+            ("free", t): release the state at step t
+            ("reverse", t): run the adjoint of step t, which needs the state at step t
+
+        The stores issued before the first reverse form the forward_snapshots. These
+        can be recorded during the initial forward pass so that their advances cost nothing.
+
+        Parameters
+        ----------
+        num_steps: int
+            number of steps in the trajectory
+
+        num_snapshots: int
+            number of states that can be held in addition to the initial state
+
+        """
+        assert num_steps > 0
+        assert num_snapshots >= 0
+
+        self.num_steps = num_steps
+        self.num_snapshots = num_snapshots
+        self.actions = self._build_actions()
+
+        self.forward_snapshots = []
+        for action in self.actions:
+            if action[0] == "reverse":
+                break
+            if action[0] == "store":
+                self.forward_snapshots.append(action[1])
+
+        forward_targets = set(self.forward_snapshots)
+        self.recomputed_steps = 0
+        self.peak_snapshots = 0
+        held = 0
+        for action in self.actions:
+            if action[0] == "advance" and action[2] not in forward_targets:
+                self.recomputed_steps += action[2] - action[1]
+            elif action[0] == "store":
+                held += 1
+                self.peak_snapshots = max(self.peak_snapshots, held)
+            elif action[0] == "free":
+                held -= 1
+                # the forward snapshots are only recorded once
+                forward_targets.discard(action[1])
+
+    def _build_actions(self):
+        actions = []
+        # explicit stack instead of recursion, tasks are (start, end, num_snapshots) with the state at start held
+        stack = [("task", 0, self.num_steps, self.num_snapshots)]
+        while stack:
+            item = stack.pop()
+            if item[0] != "task":
+                actions.append(item)
+                continue
+
+            _, start, end, s = item
+            n = end - start
+
+            if n == 1:
+                actions.append(("reverse", start))
+            elif s >= n - 1:
+                # enough snapshots to hold every state of the segment
+                for t in range(start + 1, end):
+                    actions.append(("advance", t - 1, t))
+                    actions.append(("store", t))
+                for t in range(end - 1, start, -1):
+                    actions.append(("reverse", t))
+                    actions.append(("free", t))
+                actions.append(("reverse", start))
+            elif s == 0:
+                # recompute every step from the start of the segment
+                for t in range(end - 1, start, -1):
+                    actions.append(("advance", start, t))
+                    actions.append(("reverse", t))
+                actions.append(("reverse", start))
+            else:
+                # with the state at start and s snapshots, at most binomial_steps(s+1, r) steps can
+                # be reversed if no step is advanced more than r times. The cost is piecewise linear
+                # and convex in the segment length, so splitting is optimal when the first m steps
+                # (s snapshots) need r-1 repetitions and the remaining n-m (s-1 snapshots) need r.
+                r = 0
+                while binomial_steps(s + 1, r) < n:
+                    r += 1
+                m = max(1, n - binomial_steps(s, r))
+                if r >= 2:
+                    m = max(m, binomial_steps(s + 1, r - 2))
+                actions.append(("advance", start, start + m))
+                actions.append(("store", start + m))
+                stack.append(("task", start, start + m, s))
+                stack.append(("free", start + m))
+                stack.append(("task", start + m, end, s - 1))
+
+        return actions
+
+    def summary(self):
+        """
+        Memory and recompute tradeoff of this schedule.
+        """
+        return {
+            "num_steps": self.num_steps,
+            "num_snapshots": self.num_snapshots,
+            "peak_snapshots": self.peak_snapshots,
+            "recomputed_steps": self.recomputed_steps,
+            "recompute_ratio": self.recomputed_steps/self.num_steps,
+        }
+
+
+def schedule_for_budget(num_steps, memory_budget, snapshot_bytes):
+    """
+    Schedule with as many snapshots as fit in memory_budget bytes, where each snapshot
+    takes snapshot_bytes. Holding num_steps-1 snapshots stores every frame, so no more
+    than that are used.
+    """
+    num_snapshots = min(int(memory_budget//snapshot_bytes), num_steps - 1)
+    return CheckpointSchedule(num_steps, max(num_snapshots, 0))
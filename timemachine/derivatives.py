@@ -54,6 +54,8 @@ def list_jacobian(outputs, inputs):
 def compute_ghm(energy_op, x, params):
     """
     Computes gradients, hessians, mixed_partials in one go
+
+    Note: the hessian is dense, see potentials.hessians for matrix free alternatives.
     """
     grads = densify(tf.gradients(energy_op, x)[0])
     hess = densify(tf.hessians(energy_op, x)[0])
@@ -61,5 +63,6 @@ def compute_ghm(energy_op, x, params):
     return grads, hess, mp
 
 def total_derivative(hessian, dxdp, mixed_partials):
+    # dense, see potentials.hessians.total_derivative() for a matrix free equivalent
     return tf.einsum('ijkl,mkl->mij', hessian, tf.convert_to_tensor(dxdp)) + mixed_partials[0]
 
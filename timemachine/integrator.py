@@ -1,5 +1,7 @@
 from timemachine.constants import BOLTZ
 import numpy as np
+import jax
+import jax.numpy as jnp
 
 
 def langevin_coefficients(
@@ -87,4 +89,61 @@ def brownian_coefficients(
     ca = 0.0
     cb = fscale*invMasses
     cc = nscale*sqrtInvMasses
-    return ca, cb, cc
\ No newline at end of file
+    return ca, cb, cc
+
+def langevin_noise(seed, step, num_atoms, dim=3, dtype=jnp.float64):
+    """
+    Standard normal noise for a single step, computed from a counter based
+    (threefry) generator keyed by (seed, step, atom). Any step can be regenerated
+    on demand, eg. during a backward pass, so noise buffers never need to be
+    stored, and the noise is independent of how the steps are chunked.
+
+    Parameters
+    ----------
+    seed: int
+        seed of the simulation
+
+    step: int
+        index of the step, may be traced
+
+    num_atoms: int
+        number of atoms
+
+    dim: int
+        dimension of each atom
+
+    Returns
+    -------
+    jnp.array [num_atoms, dim]
+        noise of every atom at this step
+
+    """
+    step_key = jax.random.fold_in(jax.random.PRNGKey(seed), step)
+    atom_keys = jax.vmap(lambda a: jax.random.fold_in(step_key, a))(jnp.arange(num_atoms))
+    return jax.vmap(lambda k: jax.random.normal(k, (dim,), dtype=dtype))(atom_keys)
+
+
+def respa_intervals(gradient_names, slow_interval, slow_names=("Nonbonded", "Electrostatics", "LennardJones", "GBSA")):
+    """
+    Evaluation interval of each gradient for a multiple time step (RESPA) integrator,
+    see reference.AlchemicalStepper. The cheap bonded terms are evaluated every step
+    and the expensive nonbonded terms every slow_interval steps.
+
+    Parameters
+    ----------
+    gradient_names: list of str
+        name of each gradient, eg. the names in final_gradients
+
+    slow_interval: int
+        number of steps between evaluations of the slow gradients, typically 2 to 4
+
+    slow_names: tuple of str
+        names of the slow gradients
+
+    Returns
+    -------
+    np.array [F]
+        interval of each gradient
+
+    """
+    return np.array([slow_interval if name in slow_names else 1 for name in gradient_names], dtype=np.int32)
@@ -0,0 +1,716 @@
+"""
+CPU reference engine with the same interface as ops and custom_ops, built on the
+JAX reference potentials. The gradient constructors take the same arguments as
+their CUDA counterparts in ops, so a (name, args) entry of final_gradients can be
+dispatched to either module, and AlchemicalStepper_f64/ReversibleContext_f64 can
+be used wherever the custom_ops versions are.
+"""
+import numpy as onp
+import jax
+import jax.numpy as np
+
+from timemachine import checkpointing
+from timemachine.integrator import langevin_noise
+from timemachine.potentials import bonded, nonbonded, gbsa, neighborlist
+
+
+class ReferenceGradient():
+
+    def __init__(self, energy_fn, params, param_names, precision, fixed_point=False, neighbor_list=None):
+        """
+        Parameters
+        ----------
+        energy_fn: callable
+            U(conf, lamb, *params) with every non-differentiable argument bound
+
+        params: tuple of np.array
+            parameters that derivatives are computed with respect to
+
+        param_names: tuple of str
+            name of each parameter, eg. ("charge", "lj"). These determine the
+            get_du_dX_tangents() accessors.
+
+        precision: np.float32 or np.float64
+            precision the energy is evaluated in
+
+        fixed_point: bool
+            whether energy_fn evaluates its terms in precision and accumulates them in
+            fixed point itself, see _fixed_point(). conf is then passed in float64 so
+            that du_dx keeps every bit of the fixed point sum.
+
+        neighbor_list: neighborlist.VerletNeighborList or None
+            If not None, energy_fn also takes an nblist keyword, which execute_lambda()
+            updates on the host from each conf. Traced evaluations, eg. by the
+            AlchemicalStepper, leave it as None.
+
+        """
+        self.energy_fn = energy_fn
+        self.params = tuple(np.asarray(p, dtype=precision) for p in params)
+        self.param_names = param_names
+        self.precision = precision
+        self.fixed_point = fixed_point
+        self.neighbor_list = neighbor_list
+        self.du_dp_tangents = tuple(np.zeros_like(p) for p in self.params)
+        # traced once per conf shape rather than on every call
+        self._value_and_grad = jax.jit(jax.value_and_grad(self.energy, argnums=(0, 1)))
+
+    def energy(self, conf, lamb, params, nblist=None):
+        if not self.fixed_point:
+            conf = conf.astype(self.precision)
+        if nblist is None:
+            return self.energy_fn(conf, lamb, *params).astype(np.float64)
+        return self.energy_fn(conf, lamb, *params, nblist=nblist).astype(np.float64)
+
+    def execute_lambda(self, conf, lamb):
+        """
+        Returns (du_dx, du_dl, energy) at a single conformation.
+        """
+        conf = np.asarray(conf, dtype=np.float64)
+        lamb = np.asarray(lamb, dtype=np.float64)
+        nblist = None
+        if self.neighbor_list is not None:
+            nblist = self.neighbor_list.update(conf)
+        nrg, (du_dx, du_dl) = self._value_and_grad(conf, lamb, self.params, nblist)
+        return onp.asarray(du_dx), onp.asarray(du_dl), onp.asarray(nrg)
+
+    def set_du_dp_tangents(self, tangents):
+        self.du_dp_tangents = tuple(tangents)
+
+    def _get_tangent(self, name):
+        if name not in self.param_names:
+            raise Exception("Unknown parameter", name)
+        return onp.asarray(self.du_dp_tangents[self.param_names.index(name)])
+
+    def get_du_dp_tangents(self):
+        return self._get_tangent("p")
+
+    def get_du_dcharge_tangents(self):
+        return self._get_tangent("charge")
+
+    def get_du_dlj_tangents(self):
+        return self._get_tangent("lj")
+
+    def get_du_dgb_tangents(self):
+        return self._get_tangent("gb")
+
+
+# buffer of the fixed point neighbor lists in nm, see neighborlist.VerletNeighborList
+NEIGHBOR_LIST_SKIN = 0.1
+
+
+def _fixed_point(precision):
+    # like the CUDA kernels, single precision terms are accumulated in 64 bit fixed point
+    return precision if onp.dtype(precision) == onp.float32 else None
+
+
+def HarmonicBond(bond_idxs, params, precision):
+    fp_precision = _fixed_point(precision)
+    def energy_fn(conf, lamb, p):
+        return bonded.harmonic_bond(conf, lamb, p, None, bond_idxs, precision=fp_precision)
+    return ReferenceGradient(energy_fn, (params,), ("p",), precision, fp_precision is not None)
+
+
+def HarmonicAngle(angle_idxs, params, precision):
+    fp_precision = _fixed_point(precision)
+    def energy_fn(conf, lamb, p):
+        return bonded.harmonic_angle(conf, lamb, p, None, angle_idxs, precision=fp_precision)
+    return ReferenceGradient(energy_fn, (params,), ("p",), precision, fp_precision is not None)
+
+
+def PeriodicTorsion(torsion_idxs, params, precision):
+    fp_precision = _fixed_point(precision)
+    def energy_fn(conf, lamb, p):
+        return bonded.periodic_torsion(conf, lamb, p, None, torsion_idxs, precision=fp_precision)
+    return ReferenceGradient(energy_fn, (params,), ("p",), precision, fp_precision is not None)
+
+
+def Restraint(bond_idxs, params, lamb_flags, precision):
+    def energy_fn(conf, lamb, p):
+        return bonded.restraint(conf, lamb, p, lamb_flags, None, bond_idxs)
+    return ReferenceGradient(energy_fn, (params,), ("p",), precision)
+
+
+def CentroidRestraint(group_a_idxs, group_b_idxs, masses, kb, b0, lamb_flag, lamb_offset, precision):
+    def energy_fn(conf, lamb):
+        return bonded.centroid_restraint(conf, lamb, masses, lamb_flag, lamb_offset, group_a_idxs, group_b_idxs, kb, b0)
+    return ReferenceGradient(energy_fn, (), (), precision)
+
+
+def Nonbonded(
+    charge_params,
+    lj_params,
+    exclusion_idxs,
+    charge_scales,
+    lj_scales,
+    lambda_plane_idxs,
+    lambda_offset_idxs,
+    cutoff,
+    precision):
+
+    fp_precision = _fixed_point(precision)
+
+    def energy_fn(conf, lamb, q, lj, nblist=None):
+        return nonbonded.nonbonded(
+            conf,
+            lamb,
+            q,
+            lj,
+            exclusion_idxs,
+            charge_scales,
+            lj_scales,
+            cutoff,
+            lambda_plane_idxs,
+            lambda_offset_idxs,
+            nblist=nblist,
+            precision=fp_precision
+        )
+
+    # the fixed point pairs come from a neighbor list rather than every pair, see
+    # fixed_point.default_neighbor_list()
+    neighbor_list = None
+    if fp_precision is not None and cutoff is not None:
+        neighbor_list = neighborlist.VerletNeighborList(cutoff, NEIGHBOR_LIST_SKIN)
+
+    return ReferenceGradient(energy_fn, (charge_params, lj_params), ("charge", "lj"), precision, fp_precision is not None, neighbor_list)
+
+
+def Electrostatics(
+    charge_params,
+    exclusion_idxs,
+    charge_scales,
+    lambda_plane_idxs,
+    lambda_offset_idxs,
+    cutoff,
+    precision):
+
+    def energy_fn(conf, lamb, q):
+        return nonbonded.nongroup_electrostatics(
+            conf,
+            lamb,
+            q,
+            exclusion_idxs,
+            charge_scales,
+            cutoff,
+            lambda_plane_idxs,
+            lambda_offset_idxs
+        )
+
+    return ReferenceGradient(energy_fn, (charge_params,), ("charge",), precision)
+
+
+def LennardJones(
+    lj_params,
+    exclusion_idxs,
+    lj_scales,
+    lambda_plane_idxs,
+    lambda_offset_idxs,
+    lambda_group_idxs,
+    cutoff,
+    precision):
+
+    def energy_fn(conf, lamb, lj):
+        return nonbonded.group_lennard_jones(
+            conf,
+            lamb,
+            lj,
+            exclusion_idxs,
+            lj_scales,
+            cutoff,
+            lambda_plane_idxs,
+            lambda_offset_idxs,
+            lambda_group_idxs
+        )
+
+    return ReferenceGradient(energy_fn, (lj_params,), ("lj",), precision)
+
+
+def GBSA(
+    charge_params,
+    gb_params,
+    lambda_plane_idxs,
+    lambda_offset_idxs,
+    alpha,
+    beta,
+    gamma,
+    dielectric_offset,
+    surface_tension,
+    solute_dielectric,
+    solvent_dielectric,
+    probe_radius,
+    cutoff_radii,
+    cutoff_force,
+    precision):
+
+    def energy_fn(conf, lamb, q, gb):
+        return gbsa.gbsa_obc(
+            conf,
+            lamb,
+            q,
+            gb,
+            alpha,
+            beta,
+            gamma,
+            cutoff_radii,
+            cutoff_force,
+            lambda_plane_idxs,
+            lambda_offset_idxs,
+            dielectric_offset=dielectric_offset,
+            surface_tension=surface_tension,
+            solute_dielectric=solute_dielectric,
+            solvent_dielectric=solvent_dielectric,
+            probe_radius=probe_radius
+        )
+
+    return ReferenceGradient(energy_fn, (charge_params, gb_params), ("charge", "gb"), precision)
+
+
+class AlchemicalStepper():
+
+    def __init__(self, gradients, lambda_schedule, statistics=None, intervals=None):
+        """
+        Evaluates a list of ReferenceGradients along a lambda schedule, recording
+        the du/dl of each gradient and the total energy at every step.
+
+        If statistics, a du_dl.DuDlStatistics, is given then the du/dls are only
+        accumulated into it and get_du_dl() returns None.
+
+        If intervals, a list of ints [F], is given then the i-th gradient is only
+        evaluated every intervals[i] steps (multiple time stepping, see
+        integrator.respa_intervals()). Its du_dx is applied as an impulse scaled by
+        intervals[i], and its du/dl and energy are held over the steps in between.
+        """
+        self.gradients = list(gradients)
+        self.lambda_schedule = onp.asarray(lambda_schedule, dtype=onp.float64)
+        self.statistics = statistics
+        T = self.get_T()
+        F = self.get_F()
+        if intervals is None:
+            intervals = onp.ones(F, dtype=onp.int32)
+        self.intervals = onp.asarray(intervals, dtype=onp.int32)
+        assert self.intervals.shape == (F,)
+        assert onp.all(self.intervals >= 1)
+        if statistics is None:
+            self.du_dls = onp.zeros((F, T))
+        else:
+            assert statistics.num_forces == F
+            self.du_dls = None
+        self.energies = onp.zeros(T)
+        self.du_dl_adjoint = None
+
+    def get_T(self):
+        return len(self.lambda_schedule)
+
+    def get_F(self):
+        return len(self.gradients)
+
+    def get_params(self):
+        return [g.params for g in self.gradients]
+
+    def force_energies(self, conf, lamb, params, idxs=None):
+        if idxs is None:
+            idxs = range(self.get_F())
+        return np.stack([self.gradients[i].energy(conf, lamb, params[i]) for i in idxs])
+
+    def _group_step(self, conf, lamb, params, idxs):
+        def total_fn(x):
+            nrgs, du_dls = jax.jvp(lambda l: self.force_energies(x, l, params, idxs), (lamb,), (np.ones_like(lamb),))
+            return np.sum(nrgs), (du_dls, nrgs)
+
+        du_dx, (du_dls, nrgs) = jax.grad(total_fn, has_aux=True)(conf)
+        return du_dx, du_dls, nrgs
+
+    def forward_step(self, conf, lamb, params, step=0):
+        """
+        Returns du_dx summed over every gradient, the du_dl of each gradient [F]
+        and the energy of each gradient [F].
+
+        Gradients with an interval k > 1 only contribute when step is a multiple
+        of k, in which case their du_dx is scaled by k. On the other steps their
+        du_dl and energy are zero, see hold_inactive().
+        """
+        groups = {}
+        for i, k in enumerate(self.intervals):
+            groups.setdefault(int(k), []).append(i)
+
+        du_dx = np.zeros_like(conf)
+        group_idxs = []
+        group_du_dls = []
+        group_nrgs = []
+        for k, idxs in sorted(groups.items()):
+            if k == 1:
+                g_du_dx, g_du_dls, g_nrgs = self._group_step(conf, lamb, params, idxs)
+            else:
+                def active_fn(x, idxs=idxs, k=k):
+                    g_du_dx, g_du_dls, g_nrgs = self._group_step(x, lamb, params, idxs)
+                    return k*g_du_dx, g_du_dls, g_nrgs
+                def inactive_fn(x, active_fn=active_fn):
+                    return jax.tree_util.tree_map(lambda s: np.zeros(s.shape, s.dtype), jax.eval_shape(active_fn, x))
+                # the slow gradients are skipped entirely on the steps in between
+                g_du_dx, g_du_dls, g_nrgs = jax.lax.cond(step % k == 0, active_fn, inactive_fn, conf)
+            du_dx = du_dx + g_du_dx
+            group_idxs.extend(idxs)
+            group_du_dls.append(g_du_dls)
+            group_nrgs.append(g_nrgs)
+
+        # back into the order of the gradients
+        order = onp.argsort(group_idxs)
+        du_dls = np.concatenate(group_du_dls)[order]
+        nrgs = np.concatenate(group_nrgs)[order]
+        return du_dx, du_dls, nrgs
+
+    def _last_evaluated(self, num_steps):
+        # [T, F], the last step at or before each step that each gradient was evaluated at
+        steps = onp.expand_dims(onp.arange(num_steps), 1)
+        return steps - steps % self.intervals
+
+    def hold_inactive(self, values):
+        """
+        Fill the values [T, F] of each gradient on the steps it was not evaluated with
+        its value at the last step it was, the first step is always evaluated.
+        """
+        values = onp.asarray(values)
+        return onp.take_along_axis(values, self._last_evaluated(values.shape[0]), axis=0)
+
+    def fold_du_dl_adjoint(self, adjoint):
+        """
+        Adjoint of hold_inactive() for the du_dls, the adjoints [T, F] of the held
+        values are summed into the step that they were evaluated at.
+        """
+        T, F = adjoint.shape
+        folded = onp.zeros_like(adjoint)
+        onp.add.at(folded, (self._last_evaluated(T), onp.broadcast_to(onp.arange(F), (T, F))), adjoint)
+        return folded
+
+    def backward_step(self, conf, lamb, params, x_tangent, du_dl_adjoint, step=0):
+        """
+        Vector jacobian product of forward_step(): the adjoints of conf and params
+        given a tangent of du_dx and the adjoints of the du_dls.
+        """
+        def objective(x, p):
+            du_dx, du_dls, _ = self.forward_step(x, lamb, p, step)
+            return np.sum(du_dx*x_tangent) + np.sum(du_dls*du_dl_adjoint)
+
+        return jax.grad(objective, argnums=(0, 1))(conf, params)
+
+    def set_du_dl_adjoint(self, adjoint):
+        adjoint = onp.asarray(adjoint, dtype=onp.float64)
+        if adjoint.shape != (self.get_F(), self.get_T()):
+            raise Exception("adjoint size not the same as lambda schedule size")
+        self.du_dl_adjoint = adjoint
+
+    def set_du_dp_tangents(self, tangents):
+        for g, t in zip(self.gradients, tangents):
+            g.set_du_dp_tangents(t)
+
+    def get_du_dl(self):
+        return self.du_dls
+
+    def get_du_dl_statistics(self):
+        if self.statistics is None:
+            raise Exception("stepper was not constructed with du_dl statistics")
+        return self.statistics.summary()
+
+    def get_energies(self):
+        return self.energies
+
+
+class ReversibleContext():
+
+    def __init__(self, stepper, x0, v0, coeff_cas, coeff_cbs, coeff_ccs, dts, seed, memory_budget=None, frame_interval=None,
+        chunk_size=1000):
+        """
+        Langevin integrator driven by lax.scan. Each step computes
+
+            v_{t+1} = ca_t*v_t + cb*du_dx(x_t) + cc*noise_t
+            x_{t+1} = x_t + dt_t*v_{t+1}
+
+        identical to the update of the CUDA ReversibleContext. If the stepper has
+        intervals, du_dx is the multiple time step (RESPA) impulse of forward_step().
+
+        Parameters
+        ----------
+        stepper: AlchemicalStepper
+
+        x0, v0: np.array [N, 3]
+            initial coordinates and velocities
+
+        coeff_cas: np.array [T]
+            velocity scale of each step
+
+        coeff_cbs, coeff_ccs: np.array [N]
+            force and noise scale of each atom, see Integrator
+
+        dts: np.array [T]
+            step size of each step
+
+        seed: int
+            seed of the Langevin noise, see integrator.langevin_noise()
+
+        memory_budget: int or None
+            If None, every frame is stored for backward_mode(). Otherwise, the number of
+            bytes available for the frames kept for get_frames() and the (x, v) snapshots.
+            Frames in between snapshots are recomputed in backward_mode(), see
+            checkpointing.CheckpointSchedule and get_schedule_summary().
+
+        frame_interval: int or None
+            when checkpointing or streaming, only every frame_interval-th frame is kept for
+            get_frames(). If None, every frame is kept unless memory_budget is set, in which
+            case only x0 is.
+
+        chunk_size: int
+            If the stepper has du_dl statistics and memory_budget is None, forward_mode() scans
+            chunks of about this many steps and folds their du_dls into the statistics as it
+            goes, so neither the [T, F] du_dls nor every frame is held. backward_mode() is then
+            unavailable.
+
+        """
+        T = len(dts)
+        N = x0.shape[0]
+        assert x0.shape == v0.shape
+        assert len(coeff_cas) == T
+        assert len(coeff_cbs) == N
+        assert len(coeff_ccs) == N
+        assert stepper.get_T() == T
+
+        self.stepper = stepper
+        self.x0 = np.asarray(x0, dtype=np.float64)
+        self.v0 = np.asarray(v0, dtype=np.float64)
+        self.cas = np.asarray(coeff_cas, dtype=np.float64)
+        self.cbs = np.expand_dims(np.asarray(coeff_cbs, dtype=np.float64), -1)
+        self.ccs = np.expand_dims(np.asarray(coeff_ccs, dtype=np.float64), -1)
+        self.dts = np.asarray(dts, dtype=np.float64)
+        self.lambs = np.asarray(stepper.lambda_schedule)
+        self.seed = seed
+
+        self.schedule = None
+        if memory_budget is not None:
+            frame_bytes = self.x0.size*self.x0.dtype.itemsize
+            # the frames after x0 are held alongside the snapshots
+            if frame_interval is not None:
+                memory_budget -= (T//frame_interval)*frame_bytes
+                if memory_budget < 0:
+                    raise ValueError("Frames kept every " + str(frame_interval) + " steps exceed the memory_budget")
+            self.schedule = checkpointing.schedule_for_budget(T, memory_budget, 2*frame_bytes)
+        elif frame_interval is None:
+            frame_interval = 1
+        self.frame_interval = frame_interval
+        self.chunk_size = chunk_size
+
+        self.all_coords = None
+        self.frames = None
+        self.snapshots = None
+        self.x_t_adjoint = onp.zeros_like(x0)
+        self.v_t_adjoint = onp.zeros_like(x0)
+
+        self._forward_fn = jax.jit(self._forward_segment)
+        self._backward_fn = jax.jit(self._backward_segment)
+        self._forward_step_fn = jax.jit(self._forward_step)
+        self._backward_step_fn = jax.jit(self._backward_step)
+
+    def T(self):
+        return len(self.dts)
+
+    def _step_xs(self, start, end):
+        steps = np.arange(self.T(), dtype=np.int32)
+        return (self.cas[start:end], self.dts[start:end], self.lambs[start:end], steps[start:end])
+
+    def _forward_step(self, carry, step_xs, params):
+        x_t, v_t = carry
+        ca, dt, lamb, step = step_xs
+        du_dx, du_dls, nrgs = self.stepper.forward_step(x_t, lamb, params, step)
+        # regenerated from (seed, step, atom) whenever a step is recomputed
+        noise = langevin_noise(self.seed, step, x_t.shape[0], x_t.shape[1], dtype=x_t.dtype)
+        v_t = ca*v_t + self.cbs*du_dx + self.ccs*noise
+        x_t = x_t + v_t*dt
+        return (x_t, v_t), (x_t, du_dls, nrgs)
+
+    def _backward_step(self, carry, step_xs, params):
+        x_adjoint, v_adjoint, p_adjoint = carry
+        x_t, ca, dt, lamb, step, du_dl_adjoint = step_xs
+        v_adjoint = v_adjoint + dt*x_adjoint
+        x_tangent = self.cbs*v_adjoint
+        x_jvp, p_jvp = self.stepper.backward_step(x_t, lamb, params, x_tangent, du_dl_adjoint, step)
+        x_adjoint = x_adjoint + x_jvp
+        v_adjoint = ca*v_adjoint
+        p_adjoint = jax.tree_util.tree_map(lambda a, b: a + b, p_adjoint, p_jvp)
+        return (x_adjoint, v_adjoint, p_adjoint), None
+
+    def _forward_segment(self, x_t, v_t, params, xs):
+        """
+        Integrate over the steps in xs, returning the final (x, v) and the coordinates,
+        du_dls and energies of every step.
+        """
+        return jax.lax.scan(lambda c, step_xs: self._forward_step(c, step_xs, params), (x_t, v_t), xs)
+
+    def _backward_segment(self, x_adjoint, v_adjoint, p_adjoint, params, coords, xs, du_dl_adjoints):
+        """
+        Propagate the adjoints from the end of a segment to its start. coords are the
+        coordinates at the start of each step in the segment.
+        """
+        cas, dts, lambs, steps = xs
+        # scan over the reversed steps
+        rev_xs = (coords[::-1], cas[::-1], dts[::-1], lambs[::-1], steps[::-1], du_dl_adjoints[::-1])
+        carry, _ = jax.lax.scan(lambda c, step_xs: self._backward_step(c, step_xs, params), (x_adjoint, v_adjoint, p_adjoint), rev_xs)
+        return carry
+
+    def forward_mode(self):
+        params = self.stepper.get_params()
+        xs = self._step_xs(0, self.T())
+
+        if self.schedule is None and self.stepper.statistics is not None:
+            self._forward_streaming(params)
+            return
+
+        if self.schedule is None:
+            _, (coords, du_dls, nrgs) = self._forward_fn(self.x0, self.v0, params, xs)
+            self.all_coords = onp.concatenate([onp.expand_dims(self.x0, 0), onp.asarray(coords)])
+            self._record_du_dls(self.stepper.hold_inactive(du_dls).T)
+            self.stepper.energies = onp.sum(self.stepper.hold_inactive(nrgs), axis=1)
+            return
+
+        # only the snapshots that the schedule holds before its first reverse are kept
+        forward_snapshots = set(self.schedule.forward_snapshots)
+        self.snapshots = {0: (self.x0, self.v0)}
+        self.frames = [onp.asarray(self.x0)]
+        du_dls = []
+        energies = []
+        state = (self.x0, self.v0)
+        # the first step evaluates every gradient
+        du_dl = onp.zeros(self.stepper.get_F())
+        nrgs = onp.zeros(self.stepper.get_F())
+        for t in range(self.T()):
+            step_xs = tuple(a[t] for a in xs)
+            state, (_, step_du_dl, step_nrgs) = self._forward_step_fn(state, step_xs, params)
+            # gradients that were not evaluated at this step hold their last values
+            active = (t % self.stepper.intervals) == 0
+            du_dl = onp.where(active, step_du_dl, du_dl)
+            nrgs = onp.where(active, step_nrgs, nrgs)
+            if self.stepper.statistics is None:
+                du_dls.append(du_dl)
+            else:
+                self.stepper.statistics.update(onp.asarray(du_dl))
+            energies.append(onp.sum(nrgs))
+            if t + 1 in forward_snapshots:
+                self.snapshots[t + 1] = state
+            if self.frame_interval is not None and (t + 1) % self.frame_interval == 0:
+                self.frames.append(onp.asarray(state[0]))
+
+        if self.stepper.statistics is None:
+            self.stepper.du_dls = onp.asarray(du_dls).T
+        self.stepper.energies = onp.asarray(energies)
+
+    def _forward_streaming(self, params):
+        # every gradient is evaluated at the first step of each chunk, so hold_inactive() applies per chunk
+        period = int(onp.lcm.reduce(self.stepper.intervals))
+        chunk_size = period*max(1, self.chunk_size//period)
+
+        self.all_coords = None
+        self.frames = [onp.asarray(self.x0)]
+        energies = []
+        x_t, v_t = self.x0, self.v0
+        for start in range(0, self.T(), chunk_size):
+            end = min(self.T(), start + chunk_size)
+            (x_t, v_t), (coords, du_dls, nrgs) = self._forward_fn(x_t, v_t, params, self._step_xs(start, end))
+            self.stepper.statistics.update(self.stepper.hold_inactive(du_dls).T)
+            energies.append(onp.sum(self.stepper.hold_inactive(nrgs), axis=1))
+            for t in range(start, end):
+                if (t + 1) % self.frame_interval == 0:
+                    self.frames.append(onp.asarray(coords[t - start]))
+
+        self.stepper.energies = onp.concatenate(energies)
+
+    def _record_du_dls(self, du_dls):
+        if self.stepper.statistics is None:
+            self.stepper.du_dls = du_dls
+        else:
+            self.stepper.statistics.update(du_dls)
+
+    def backward_mode(self):
+        if self.stepper.du_dl_adjoint is None:
+            raise Exception("You probably forgot to set du_dl adjoints!")
+
+        params = self.stepper.get_params()
+        xs = self._step_xs(0, self.T())
+        # the du_dls that were held over steps contribute to the step they were evaluated at
+        du_dl_adjoints = np.asarray(self.stepper.fold_du_dl_adjoint(self.stepper.du_dl_adjoint.T))
+        p_adjoint = jax.tree_util.tree_map(np.zeros_like, params)
+        carry = (np.asarray(self.x_t_adjoint), np.zeros_like(self.x0), p_adjoint)
+
+        if self.schedule is None:
+            if self.all_coords is None:
+                raise Exception("backward_mode() needs every frame, which is not kept when du_dls are streamed into statistics")
+            carry = self._backward_fn(*carry, params, np.asarray(self.all_coords[:-1]), xs, du_dl_adjoints)
+        else:
+            held = dict(self.snapshots)
+            current = None
+            for action in self.schedule.actions:
+                kind = action[0]
+                if kind == "advance":
+                    _, a, b = action
+                    if b in held:
+                        # recorded during forward_mode()
+                        current = (b, held[b])
+                        continue
+                    state = held[a]
+                    for t in range(a, b):
+                        state, _ = self._forward_step_fn(state, tuple(x[t] for x in xs), params)
+                    current = (b, state)
+                elif kind == "store":
+                    held[action[1]] = current[1]
+                elif kind == "free":
+                    del held[action[1]]
+                elif kind == "reverse":
+                    t = action[1]
+                    if t in held:
+                        x_t = held[t][0]
+                    else:
+                        assert current[0] == t
+                        x_t = current[1][0]
+                    step_xs = (x_t, xs[0][t], xs[1][t], xs[2][t], xs[3][t], du_dl_adjoints[t])
+                    carry, _ = self._backward_step_fn(carry, step_xs, params)
+
+        x_adjoint, v_adjoint, p_adjoint = carry
+        self.x_t_adjoint = onp.asarray(x_adjoint)
+        self.v_t_adjoint = onp.asarray(v_adjoint)
+        self.stepper.set_du_dp_tangents(p_adjoint)
+
+    def get_schedule_summary(self):
+        """
+        Memory and recompute tradeoff picked for backward_mode(), or None if every frame is stored.
+        """
+        if self.schedule is None:
+            return None
+        return self.schedule.summary()
+
+    def get_frames(self):
+        """
+        Every frame_interval-th frame, including the initial one. Only the initial one if
+        memory_budget was set without a frame_interval.
+        """
+        if self.all_coords is not None:
+            return self.all_coords[::self.frame_interval]
+        return onp.stack(self.frames)
+
+    def get_all_coords(self):
+        if self.all_coords is None:
+            raise Exception("Every frame is only stored when memory_budget is None and du_dls are not streamed, use get_frames()")
+        return self.all_coords
+
+    def get_last_coords(self):
+        if self.all_coords is None:
+            raise Exception("Every frame is only stored when memory_budget is None and du_dls are not streamed, use get_frames()")
+        return self.all_coords[-1]
+
+    def set_x_t_adjoint(self, adjoint):
+        self.x_t_adjoint = onp.asarray(adjoint, dtype=onp.float64)
+
+    def get_x_t_adjoint(self):
+        return self.x_t_adjoint
+
+    def get_v_t_adjoint(self):
+        return self.v_t_adjoint
+
+
+# drop-in names of the custom_ops classes
+AlchemicalStepper_f64 = AlchemicalStepper
+ReversibleContext_f64 = ReversibleContext
@@ -0,0 +1,277 @@
+"""
+Energy minimizers used to relax the starting coordinates before the Langevin run,
+instead of ramping the step size up from zero inside the trajectory.
+
+The minimizers only need a function returning the energy and du_dx at a conformation,
+see gradients_energy_fn() for the CUDA or reference gradients and jax_energy_fn()
+for the JAX reference potentials. Both stop once the largest force on any atom is
+below a tolerance.
+"""
+import numpy as np
+
+
+def gradients_energy_fn(gradients, lamb):
+    """
+    Energy and du_dx summed over a list of gradients from ops, custom_ops or
+    reference, all of which implement execute_lambda(coords, lamb).
+    """
+    def energy_fn(x):
+        x = np.ascontiguousarray(x, dtype=np.float64)
+        total_du_dx = np.zeros_like(x)
+        total_nrg = 0.0
+        for g in gradients:
+            du_dx, _, nrg = g.execute_lambda(x, lamb)
+            total_du_dx += du_dx
+            total_nrg += nrg
+        return total_nrg, total_du_dx
+
+    return energy_fn
+
+
+def jax_energy_fn(nrg_fn):
+    """
+    Energy and du_dx of a JAX energy function nrg_fn(x).
+    """
+    import jax
+    vg_fn = jax.jit(jax.value_and_grad(nrg_fn))
+
+    def energy_fn(x):
+        nrg, du_dx = vg_fn(x)
+        return float(nrg), np.asarray(du_dx, dtype=np.float64)
+
+    return energy_fn
+
+
+def max_force(du_dx):
+    """
+    Largest norm of the force on any atom.
+    """
+    return np.amax(np.linalg.norm(du_dx, axis=-1))
+
+
+def _cap_step(dx, max_step):
+    # scale the whole step so that no atom moves further than max_step
+    largest = np.amax(np.linalg.norm(dx, axis=-1))
+    if largest > max_step:
+        dx = dx*(max_step/largest)
+    return dx
+
+
+def _summary(nrg, du_dx, iterations, evaluations, tolerance):
+    f_max = max_force(du_dx)
+    return {
+        "energy": nrg,
+        "max_force": f_max,
+        "iterations": iterations,
+        "evaluations": evaluations,
+        "converged": bool(f_max <= tolerance)
+    }
+
+
+def fire(
+    energy_fn,
+    x0,
+    masses=None,
+    tolerance=10.0,
+    max_iterations=5000,
+    dt_start=1e-3,
+    dt_max=1e-2,
+    max_step=0.01,
+    n_min=5,
+    f_inc=1.1,
+    f_dec=0.5,
+    alpha_start=0.1,
+    f_alpha=0.99):
+    """
+    Fast inertial relaxation engine (Bitzek et al., PRL 97, 2006). Only the forces are
+    used, so this is robust to the noisy energies of single precision gradients.
+
+    Parameters
+    ----------
+    energy_fn: callable
+        energy_fn(x) returns (energy, du_dx)
+
+    x0: np.array [N, 3]
+        initial coordinates
+
+    masses: np.array [N] or None
+        masses of the damped dynamics, unit masses if None
+
+    tolerance: float
+        stop once the largest force on any atom is below this, in kJ/mol/nm
+
+    max_iterations: int
+        maximum number of force evaluations
+
+    dt_start, dt_max: float
+        initial and largest timestep
+
+    max_step: float
+        largest displacement of any atom in a single step, in nm
+
+    n_min, f_inc, f_dec, alpha_start, f_alpha:
+        FIRE parameters, see the reference above
+
+    Returns
+    -------
+    np.array [N, 3], dict
+        minimized coordinates and a summary with the energy, max_force,
+        iterations, evaluations and whether the tolerance was reached
+
+    """
+    x = np.array(x0, dtype=np.float64)
+    v = np.zeros_like(x)
+    if masses is None:
+        inv_masses = np.ones((x.shape[0], 1))
+    else:
+        inv_masses = np.expand_dims(1/np.asarray(masses, dtype=np.float64), -1)
+
+    dt = dt_start
+    alpha = alpha_start
+    n_pos = 0
+
+    nrg, du_dx = energy_fn(x)
+    iteration = 0
+    while iteration < max_iterations and max_force(du_dx) > tolerance:
+        force = -du_dx
+        power = np.sum(force*v)
+        if power > 0:
+            v = (1 - alpha)*v + alpha*np.linalg.norm(v)*force/np.linalg.norm(force)
+            if n_pos > n_min:
+                dt = min(dt*f_inc, dt_max)
+                alpha = alpha*f_alpha
+            n_pos += 1
+        else:
+            # moving uphill, stop and restart more cautiously
+            v = np.zeros_like(v)
+            dt = dt*f_dec
+            alpha = alpha_start
+            n_pos = 0
+
+        v = v + dt*force*inv_masses
+        x = x + _cap_step(dt*v, max_step)
+        nrg, du_dx = energy_fn(x)
+        iteration += 1
+
+    return x, _summary(nrg, du_dx, iteration, iteration + 1, tolerance)
+
+
+def lbfgs(
+    energy_fn,
+    x0,
+    tolerance=10.0,
+    max_iterations=1000,
+    history=10,
+    max_step=0.01,
+    c1=1e-4,
+    max_backtracks=20):
+    """
+    Limited memory BFGS with a backtracking (Armijo) line search, see Nocedal and Wright,
+    Numerical Optimization, Algorithm 7.4.
+
+    Parameters
+    ----------
+    energy_fn: callable
+        energy_fn(x) returns (energy, du_dx)
+
+    x0: np.array [N, 3]
+        initial coordinates
+
+    tolerance: float
+        stop once the largest force on any atom is below this, in kJ/mol/nm
+
+    max_iterations: int
+        maximum number of line searches
+
+    history: int
+        number of (s, y) pairs used to approximate the inverse hessian
+
+    max_step: float
+        largest displacement of any atom in a single line search, in nm
+
+    c1: float
+        sufficient decrease parameter of the line search
+
+    max_backtracks: int
+        number of times the step is halved before the line search gives up
+
+    Returns
+    -------
+    np.array [N, 3], dict
+        minimized coordinates and a summary with the energy, max_force,
+        iterations, evaluations and whether the tolerance was reached
+
+    """
+    x = np.array(x0, dtype=np.float64)
+    nrg, du_dx = energy_fn(x)
+    evaluations = 1
+
+    s_list = []
+    y_list = []
+
+    iteration = 0
+    while iteration < max_iterations and max_force(du_dx) > tolerance:
+
+        # two loop recursion for -H*du_dx
+        q = du_dx.copy()
+        alphas = []
+        for s, y in zip(reversed(s_list), reversed(y_list)):
+            a = np.sum(s*q)/np.sum(y*s)
+            alphas.append(a)
+            q = q - a*y
+        if s_list:
+            q = q*np.sum(s_list[-1]*y_list[-1])/np.sum(y_list[-1]*y_list[-1])
+        for (s, y), a in zip(zip(s_list, y_list), reversed(alphas)):
+            b = np.sum(y*q)/np.sum(y*s)
+            q = q + s*(a - b)
+        direction = _cap_step(-q, max_step)
+
+        slope = np.sum(du_dx*direction)
+        if slope >= 0:
+            # not a descent direction, fall back to steepest descent
+            s_list, y_list = [], []
+            direction = _cap_step(-du_dx, max_step)
+            slope = np.sum(du_dx*direction)
+
+        step = 1.0
+        for _ in range(max_backtracks):
+            x_new = x + step*direction
+            nrg_new, du_dx_new = energy_fn(x_new)
+            evaluations += 1
+            if nrg_new <= nrg + c1*step*slope:
+                break
+            step *= 0.5
+        else:
+            if not s_list:
+                # steepest descent made no progress, we are as close as the precision allows
+                break
+            s_list, y_list = [], []
+            iteration += 1
+            continue
+
+        s = x_new - x
+        y = du_dx_new - du_dx
+        # skip updates that would make the inverse hessian indefinite
+        if np.sum(s*y) > 1e-10:
+            s_list.append(s)
+            y_list.append(y)
+            if len(s_list) > history:
+                s_list.pop(0)
+                y_list.pop(0)
+
+        x, nrg, du_dx = x_new, nrg_new, du_dx_new
+        iteration += 1
+
+    return x, _summary(nrg, du_dx, iteration, evaluations, tolerance)
+
+
+def minimize(energy_fn, x0, method="fire", **kwargs):
+    """
+    Dispatch to fire() or lbfgs(), kwargs are passed through.
+    """
+    if method == "fire":
+        return fire(energy_fn, x0, **kwargs)
+    elif method == "lbfgs":
+        return lbfgs(energy_fn, x0, **kwargs)
+    else:
+        raise Exception("Unknown minimization method", method)
@@ -49,6 +49,9 @@ def vibrational_eigenvalues(conf, masses, energies):
         Returns real and imaginary frequencies computed from
         the eigenvalues
 
+    Note: this builds the dense hessian, for large systems use
+    potentials.hessians.lowest_modes() with mass_weighted_matvec().
+
     """
     hessians = []
     for e in energies:
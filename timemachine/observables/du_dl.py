@@ -0,0 +1,129 @@
+import numpy as np
+
+
+class DuDlStatistics():
+
+    def __init__(self, num_forces, burn_in=0, block_size=1000, decimation=None):
+        """
+        Streaming statistics of the per force du/dl, so that the dense [F, T] array
+        never has to be stored or sent back.
+
+        Steps before burn_in are discarded. For the remaining steps this accumulates
+        running sums, Welford means and variances, averages over consecutive blocks of
+        block_size steps and, optionally, every decimation-th du/dl.
+
+        Parameters
+        ----------
+        num_forces: int
+            number of forces F
+
+        burn_in: int
+            index of the first step that is accumulated, eg. du_dl_cutoff
+
+        block_size: int
+            number of steps per block average
+
+        decimation: int or None
+            if not None, keep every decimation-th du/dl after burn_in
+
+        """
+        self.num_forces = num_forces
+        self.burn_in = burn_in
+        self.block_size = block_size
+        self.decimation = decimation
+
+        self.num_steps = 0 # every step seen, including the burn in
+        self.count = 0
+        self.sums = np.zeros(num_forces)
+        self.means = np.zeros(num_forces)
+        self.m2 = np.zeros(num_forces)
+
+        self.block_sums = np.zeros(num_forces)
+        self.block_count = 0
+        self.blocks = []
+        self.decimated = []
+
+    def update(self, du_dls):
+        """
+        Accumulate the du/dls of consecutive steps.
+
+        Parameters
+        ----------
+        du_dls: np.array [F] or [F, n]
+            du/dl of each force at one step or at n consecutive steps
+
+        """
+        du_dls = np.asarray(du_dls, dtype=np.float64).reshape(self.num_forces, -1)
+        n = du_dls.shape[1]
+        steps = np.arange(self.num_steps, self.num_steps + n)
+        self.num_steps += n
+
+        keep = steps >= self.burn_in
+        du_dls = du_dls[:, keep]
+        steps = steps[keep]
+        n = du_dls.shape[1]
+        if n == 0:
+            return
+
+        # merge the mean and M2 of this chunk (Chan et al.), which reduces to Welford for n=1
+        chunk_mean = np.mean(du_dls, axis=1)
+        chunk_m2 = np.sum((du_dls - np.expand_dims(chunk_mean, 1))**2, axis=1)
+        total = self.count + n
+        delta = chunk_mean - self.means
+        self.means = self.means + delta*n/total
+        self.m2 = self.m2 + chunk_m2 + delta*delta*self.count*n/total
+        self.count = total
+        self.sums += np.sum(du_dls, axis=1)
+
+        # fill the current block, then every complete block in this chunk
+        start = 0
+        while start < n:
+            take = min(self.block_size - self.block_count, n - start)
+            self.block_sums += np.sum(du_dls[:, start:start+take], axis=1)
+            self.block_count += take
+            start += take
+            if self.block_count == self.block_size:
+                self.blocks.append(self.block_sums/self.block_size)
+                self.block_sums = np.zeros(self.num_forces)
+                self.block_count = 0
+
+        if self.decimation is not None:
+            kept = (steps - self.burn_in) % self.decimation == 0
+            self.decimated.extend(du_dls[:, kept].T)
+
+    def variances(self):
+        """
+        Sample variance of each force, zero if fewer than two steps were accumulated.
+        """
+        if self.count < 2:
+            return np.zeros(self.num_forces)
+        return self.m2/(self.count - 1)
+
+    def block_averages(self):
+        """
+        Averages of every complete block, [F, B].
+        """
+        return np.array(self.blocks, dtype=np.float64).reshape(-1, self.num_forces).T
+
+    def summary(self):
+        """
+        Picklable summary of the accumulated statistics, this is what workers send back
+        in place of the dense du/dls.
+        """
+        if self.decimation is not None:
+            decimated = np.array(self.decimated, dtype=np.float64).reshape(-1, self.num_forces).T
+        else:
+            decimated = None
+
+        return {
+            "num_steps": self.num_steps,
+            "burn_in": self.burn_in,
+            "count": self.count,
+            "sums": self.sums,
+            "means": self.means,
+            "variances": self.variances(),
+            "block_size": self.block_size,
+            "block_averages": self.block_averages(),
+            "decimation": self.decimation,
+            "decimated": decimated
+        }
@@ -0,0 +1,292 @@
+import numpy as onp
+import jax
+import jax.numpy as np
+
+from timemachine.constants import BOLTZ
+from timemachine.potentials import nonbonded
+from timemachine.potentials.jax_utils import convert_to_4d
+
+
+def sum_energy_fns(energy_fns):
+    """
+    Combine potentials of the form U(conf, lamb), eg. functools.partial of
+    harmonic_bond or nonbonded with everything else bound, into a single one.
+    """
+    def total_energy(conf, lamb):
+        return sum(fn(conf, lamb) for fn in energy_fns)
+
+    return total_energy
+
+
+def frame_fn(energy_fn, compute_du_dx=False, compute_du_dl=False):
+    """
+    Per frame function returning (du_dx, du_dl, energy) with None for the
+    derivatives that were not requested.
+    """
+    argnums = []
+    if compute_du_dx:
+        argnums.append(0)
+    if compute_du_dl:
+        argnums.append(1)
+
+    if len(argnums) == 0:
+        return lambda conf, lamb: (None, None, energy_fn(conf, lamb))
+
+    vg_fn = jax.value_and_grad(energy_fn, argnums=tuple(argnums))
+
+    def fn(conf, lamb):
+        energy, grads = vg_fn(conf, lamb)
+        grads = list(grads)
+        du_dx = grads.pop(0) if compute_du_dx else None
+        du_dl = grads.pop(0) if compute_du_dl else None
+        return du_dx, du_dl, energy
+
+    return fn
+
+
+def estimate_frame_bytes(fn, *args):
+    """
+    Upper bound on the memory needed to evaluate fn on a single frame, from the
+    sizes of every intermediate in its jaxpr. This ignores buffer reuse so it
+    overestimates the peak usage.
+    """
+    closed_jaxpr = jax.make_jaxpr(fn)(*args)
+    total = 0
+    for eqn in closed_jaxpr.jaxpr.eqns:
+        for var in eqn.outvars:
+            aval = var.aval
+            if hasattr(aval, "shape"):
+                total += int(onp.prod(aval.shape))*onp.dtype(aval.dtype).itemsize
+    return max(total, 1)
+
+
+def evaluate_trajectory(
+    energy_fns,
+    frames,
+    lamb,
+    compute_du_dx=False,
+    compute_du_dl=False,
+    memory_budget=2**30,
+    chunk_size=None):
+    """
+    Evaluate energies, and optionally forces and du/dl, over a stack of frames.
+    Frames are processed in chunks with vmap, where the chunk size is chosen so
+    that a chunk fits within the memory budget.
+
+    Parameters
+    ----------
+    energy_fns: callable or list of callables
+        potentials of the form U(conf, lamb), eg. functools.partial(bonded.harmonic_bond,
+        params=params, box=None, bond_idxs=bond_idxs). Neighbor lists should not be bound
+        since they are only valid for a single frame.
+
+    frames: shape [T, num_atoms, 3] np.array
+        coordinates of each frame
+
+    lamb: float or shape [T] np.array
+        lambda at which all frames are evaluated, or one lambda per frame
+
+    compute_du_dx: bool
+        whether or not to compute the derivatives with respect to coordinates
+
+    compute_du_dl: bool
+        whether or not to compute the derivatives with respect to lambda
+
+    memory_budget: int
+        approximate number of bytes available to each chunk, see estimate_frame_bytes()
+
+    chunk_size: int or None
+        number of frames per chunk, overrides memory_budget if not None.
+
+    Returns
+    -------
+    (np.array [T, num_atoms, 3] or None, np.array [T] or None, np.array [T])
+        du_dx, du_dl and energies, in the same order as the CUDA potentials.
+
+    """
+    if callable(energy_fns):
+        energy_fns = [energy_fns]
+    energy_fn = sum_energy_fns(energy_fns)
+
+    frames = np.asarray(frames)
+    T = frames.shape[0]
+    lambs = np.broadcast_to(np.asarray(lamb, dtype=frames.dtype), (T,))
+
+    fn = frame_fn(energy_fn, compute_du_dx, compute_du_dl)
+
+    if chunk_size is None:
+        frame_bytes = estimate_frame_bytes(fn, frames[0], lambs[0])
+        chunk_size = int(max(1, memory_budget//frame_bytes))
+
+    du_dx, du_dl, energies = chunked_vmap(fn, (frames, lambs), chunk_size)
+
+    return du_dx, du_dl, energies
+
+
+def chunked_vmap(fn, args, chunk_size):
+    """
+    Map fn over the leading axis of every array in args, vmapping chunk_size
+    elements at a time. The last chunk is padded so that every call has the
+    same shape and fn is only compiled once.
+    """
+    T = args[0].shape[0]
+    chunk_size = min(chunk_size, T)
+    batch_fn = jax.jit(jax.vmap(fn))
+
+    outputs = []
+    for start in range(0, T, chunk_size):
+        chunk = [a[start:start+chunk_size] for a in args]
+        num_elems = chunk[0].shape[0]
+
+        if num_elems < chunk_size:
+            pad = chunk_size - num_elems
+            chunk = [np.concatenate([a, np.repeat(a[-1:], pad, axis=0)]) for a in chunk]
+
+        out = batch_fn(*chunk)
+        outputs.append(jax.tree_util.tree_map(lambda o: o[:num_elems], out))
+
+    return jax.tree_util.tree_map(lambda *o: np.concatenate(o), *outputs)
+
+
+def lambda_coupled_pairs(lambda_offset_idxs, exclusion_idxs, charge_scales, lj_scales):
+    """
+    Enumerate the pairs whose nonbonded energy depends on lambda. The fourth
+    coordinates of atoms i and j differ by cutoff*(plane_i - plane_j) + lamb*(offset_i - offset_j),
+    so only pairs with different lambda_offset_idxs are coupled. Coupled exclusions
+    are appended with negated scales so that the list can be passed directly to
+    nonbonded.nonbonded_pairs().
+
+    Returns
+    -------
+    (np.array [P, 2], np.array [P], np.array [P])
+        pair idxs, charge scales and lj scales
+
+    """
+    offsets = onp.asarray(lambda_offset_idxs)
+    # every pair of atoms from two different offset groups, this avoids enumerating all N^2 pairs
+    groups = [onp.where(offsets == o)[0] for o in onp.unique(offsets)]
+    pair_idxs = [onp.zeros((0, 2), dtype=onp.int32)]
+    for a in range(len(groups)):
+        for b in range(a + 1, len(groups)):
+            i_idxs, j_idxs = onp.meshgrid(groups[a], groups[b], indexing='ij')
+            pair_idxs.append(onp.stack([i_idxs.reshape(-1), j_idxs.reshape(-1)], axis=1))
+    pair_idxs = onp.concatenate(pair_idxs)
+    P = pair_idxs.shape[0]
+
+    exclusion_idxs = onp.asarray(exclusion_idxs)
+    exc_coupled = offsets[exclusion_idxs[:, 0]] != offsets[exclusion_idxs[:, 1]]
+
+    pair_idxs = onp.concatenate([pair_idxs, exclusion_idxs[exc_coupled]]).astype(onp.int32)
+    pair_charge_scales = onp.concatenate([onp.ones(P), -onp.asarray(charge_scales)[exc_coupled]])
+    pair_lj_scales = onp.concatenate([onp.ones(P), -onp.asarray(lj_scales)[exc_coupled]])
+
+    return pair_idxs, pair_charge_scales, pair_lj_scales
+
+
+def u_kn_matrix(
+    frames,
+    lambda_schedule,
+    temperature,
+    nonbonded_kwargs,
+    static_fns=(),
+    lambda_fns=(),
+    memory_budget=2**30,
+    chunk_size=None):
+    """
+    Reduced energy of every frame at every lambda window, as used by MBAR.
+
+    The lambda independent part of each frame is computed once: the static_fns and
+    the nonbonded energy of every pair that is not coupled to lambda, see lambda_coupled_pairs().
+    Only the coupled pairs and the lambda_fns are re-evaluated at each window.
+
+    Parameters
+    ----------
+    frames: shape [T, num_atoms, 3] np.array
+        coordinates of the frames pooled over every window
+
+    lambda_schedule: shape [K] np.array
+        lambda of each window
+
+    temperature: float
+        temperature in Kelvin used to reduce the energies
+
+    nonbonded_kwargs: dict
+        every argument of nonbonded.nonbonded() except conf and lamb, eg. charge_params,
+        lj_params, exclusion_idxs, charge_scales, lj_scales, cutoff, lambda_plane_idxs,
+        lambda_offset_idxs and box.
+
+    static_fns: list of callables
+        potentials U(conf, lamb) that do not depend on lambda, eg. harmonic_bond.
+        These are evaluated at lambda_schedule[0].
+
+    lambda_fns: list of callables
+        potentials U(conf, lamb) other than nonbonded that depend on lambda, eg. restraints.
+
+    memory_budget: int
+        approximate number of bytes available to each chunk of frames, see estimate_frame_bytes()
+
+    chunk_size: int or None
+        number of frames per chunk, overrides memory_budget if not None.
+
+    Returns
+    -------
+    np.array [K, T]
+        reduced energies u_kn = U(x_n, lambda_k)/kT
+
+    """
+    kT = BOLTZ*temperature
+    lambda_schedule = np.asarray(lambda_schedule, dtype=np.float64)
+    frames = np.asarray(frames)
+
+    kwargs = dict(nonbonded_kwargs)
+    kwargs.pop("nblist", None)
+    cutoff = kwargs["cutoff"]
+    box = kwargs.get("box", None)
+    plane_idxs = kwargs["lambda_plane_idxs"]
+    offset_idxs = kwargs["lambda_offset_idxs"]
+
+    pair_idxs, pair_charge_scales, pair_lj_scales = lambda_coupled_pairs(
+        offset_idxs,
+        kwargs["exclusion_idxs"],
+        kwargs["charge_scales"],
+        kwargs["lj_scales"]
+    )
+
+    def coupled_nonbonded(conf, lamb):
+        conf_4d = convert_to_4d(conf, lamb, plane_idxs, offset_idxs, cutoff)
+        return nonbonded.nonbonded_pairs(
+            conf_4d,
+            kwargs["charge_params"],
+            kwargs["lj_params"],
+            pair_idxs,
+            pair_charge_scales,
+            pair_lj_scales,
+            cutoff,
+            box,
+            rf_dielectric=kwargs.get("rf_dielectric", None),
+            switch_distance=kwargs.get("switch_distance", None)
+        )
+
+    def window_energy(conf, lamb):
+        nrg = coupled_nonbonded(conf, lamb)
+        for fn in lambda_fns:
+            nrg = nrg + fn(conf, lamb)
+        return nrg
+
+    lamb_0 = lambda_schedule[0]
+
+    def frame_u(conf):
+        # lambda independent energy, the coupled pairs at lamb_0 are removed from the total
+        static = nonbonded.nonbonded(conf, lamb_0, **kwargs) - coupled_nonbonded(conf, lamb_0)
+        for fn in static_fns:
+            static = static + fn(conf, lamb_0)
+        coupled = jax.vmap(window_energy, in_axes=(None, 0))(conf, lambda_schedule)
+        return (static + coupled)/kT
+
+    if chunk_size is None:
+        frame_bytes = estimate_frame_bytes(frame_u, frames[0])
+        chunk_size = int(max(1, memory_budget//frame_bytes))
+
+    u_nk = chunked_vmap(frame_u, (frames,), chunk_size)
+
+    return np.transpose(u_nk)
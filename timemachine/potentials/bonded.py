@@ -1,5 +1,7 @@
+import functools
 import jax.numpy as np
 
+from timemachine.potentials import fixed_point
 from timemachine.potentials.jax_utils import distance, delta_r, convert_to_4d
 
 def centroid_restraint(conf, lamb, masses, lamb_flag, lamb_offset, group_a_idxs, group_b_idxs, kb, b0):
@@ -65,7 +67,7 @@ def restraint(conf, lamb, params, lamb_flags, box, bond_idxs):
     return energy
 
 # lamb is *not used* it is used in the alchemical stuffl ater
-def harmonic_bond(conf, lamb, params, box, bond_idxs):
+def harmonic_bond(conf, lamb, params, box, bond_idxs, precision=None):
     """
     Compute the harmonic bond energy given a collection of molecules.
 
@@ -88,9 +90,16 @@ def harmonic_bond(conf, lamb, params, box, bond_idxs):
     param_idxs: [num_bonds, 2] np.array
         each element (k_idx, r_idx) maps into params for bond constants and ideal lengths
 
+    precision: np.float32, np.float64 or None
+        if not None, then each term is evaluated in this precision and the energy and
+        du_dx are accumulated in 64 bit fixed point, see fixed_point.bonded_energy()
+
     """
     assert params.shape == bond_idxs.shape
 
+    if precision is not None:
+        return fixed_point.bonded_energy(harmonic_bond, conf, lamb, params, box, bond_idxs, precision)
+
     ci = conf[bond_idxs[:, 0]]
     cj = conf[bond_idxs[:, 1]]
     dij = distance(ci, cj, box)
@@ -101,7 +110,7 @@ def harmonic_bond(conf, lamb, params, box, bond_idxs):
     return energy
 
 
-def harmonic_angle(conf, lamb, params, box, angle_idxs, cos_angles=True):
+def harmonic_angle(conf, lamb, params, box, angle_idxs, cos_angles=True, precision=None):
     """
     Compute the harmonic bond energy given a collection of molecules.
 
@@ -129,7 +138,15 @@ def harmonic_angle(conf, lamb, params, box, angle_idxs, cos_angles=True):
         if True, then this instead implements V(t) = k*(cos(t)-cos(t0))^2. This is far more
         numerically stable when the angle is pi.
 
+    precision: np.float32, np.float64 or None
+        if not None, then each term is evaluated in this precision and the energy and
+        du_dx are accumulated in 64 bit fixed point, see fixed_point.bonded_energy()
+
     """
+    if precision is not None:
+        potential = functools.partial(harmonic_angle, cos_angles=cos_angles)
+        return fixed_point.bonded_energy(potential, conf, lamb, params, box, angle_idxs, precision)
+
     ci = conf[angle_idxs[:, 0]]
     cj = conf[angle_idxs[:, 1]]
     ck = conf[angle_idxs[:, 2]]
@@ -205,7 +222,7 @@ def signed_torsion_angle(ci, cj, ck, cl):
     return np.arctan2(y, x)
 
 
-def periodic_torsion(conf, lamb, params, box, torsion_idxs):
+def periodic_torsion(conf, lamb, params, box, torsion_idxs, precision=None):
     """
     Compute the periodic torsional energy.
 
@@ -225,11 +242,18 @@ def periodic_torsion(conf, lamb, params, box, torsion_idxs):
 
     param_idxs: shape [num_torsions, 3] np.array
         indices into the params array denoting the force constant, phase, and period
-    
+
+    precision: np.float32, np.float64 or None
+        if not None, then each term is evaluated in this precision and the energy and
+        du_dx are accumulated in 64 bit fixed point, see fixed_point.bonded_energy()
+
     """
 
     conf = conf[:, :3] # this is defined only in 3d
 
+    if precision is not None:
+        return fixed_point.bonded_energy(periodic_torsion, conf, lamb, params, box, torsion_idxs, precision)
+
     ci = conf[torsion_idxs[:, 0]]
     cj = conf[torsion_idxs[:, 1]]
     ck = conf[torsion_idxs[:, 2]]
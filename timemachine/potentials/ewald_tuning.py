@@ -0,0 +1,212 @@
+import time
+import functools
+
+import numpy as onp
+import jax
+
+from timemachine.potentials import nonbonded
+from timemachine.potentials.neighborlist import box_widths
+
+
+# (box, num_atoms, tolerance, methods, cutoffs, max_kmax) -> (params, error, seconds)
+_tuning_cache = {}
+
+
+def clear_cache():
+    _tuning_cache.clear()
+
+
+def alpha_for_cutoff(cutoff, tolerance):
+    """
+    Ewald splitting parameter whose real space error at the cutoff matches the
+    tolerance, using the same estimate as OpenMM: exp(-(alpha*cutoff)^2) = 2*tolerance
+    """
+    return onp.sqrt(-onp.log(2*tolerance))/cutoff
+
+
+def real_space_error(alpha, cutoff):
+    return onp.exp(-(alpha*cutoff)**2)/2
+
+
+def ewald_reciprocal_error(alpha, width, kmax):
+    """
+    Estimated relative force error of the explicit reciprocal sum truncated
+    at kmax along a box dimension of the given width.
+    """
+    return 0.05*onp.sqrt(width*alpha)*kmax*onp.exp(-(onp.pi*kmax/(width*alpha))**2)
+
+
+def pme_reciprocal_error(alpha, width, grid_size):
+    """
+    Estimated relative force error of fifth order PME with grid_size points
+    along a box dimension of the given width.
+    """
+    return (2*alpha*width/(3*grid_size))**5
+
+
+def kmax_for_tolerance(alpha, widths, tolerance, max_kmax):
+    """
+    Smallest kmax that meets the tolerance along every box dimension, or None
+    if that requires more than max_kmax.
+    """
+    for kmax in range(1, max_kmax + 1):
+        errors = [ewald_reciprocal_error(alpha, w, kmax) for w in widths]
+        if max(errors) <= tolerance:
+            return kmax
+    return None
+
+
+def pme_grid_for_tolerance(alpha, widths, tolerance):
+    return tuple(int(onp.ceil(2*alpha*w/(3*tolerance**0.2))) for w in widths)
+
+
+def time_setting(conf, box, charges, params, repeats=3):
+    """
+    Wall clock seconds of a jitted energy and gradient evaluation of ewald_energy()
+    with the given parameters, excluding compilation.
+    """
+    N = conf.shape[0]
+    scale_matrix = onp.ones((N, N)) - onp.eye(N)
+
+    fn = functools.partial(
+        nonbonded.ewald_energy,
+        box=box,
+        scale_matrix=scale_matrix,
+        cutoff=params["cutoff"],
+        alpha=params["alpha"],
+        kmax=params["kmax"],
+        method=params["method"],
+        pme_grid=params["pme_grid"]
+    )
+    grad_fn = jax.jit(jax.value_and_grad(lambda x, q: fn(x, charges=q), argnums=(0, 1)))
+
+    # compile
+    jax.tree_util.tree_map(lambda a: a.block_until_ready(), grad_fn(conf, charges))
+
+    best = onp.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        jax.tree_util.tree_map(lambda a: a.block_until_ready(), grad_fn(conf, charges))
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def candidate_settings(box, tolerance, cutoffs, methods, max_kmax):
+    """
+    Enumerate the settings for each candidate cutoff that are expected to meet the tolerance.
+    """
+    widths = box_widths(box)
+    candidates = []
+    for cutoff in cutoffs:
+        alpha = alpha_for_cutoff(cutoff, tolerance)
+        real_error = real_space_error(alpha, cutoff)
+        for method in methods:
+            if method == "ewald":
+                kmax = kmax_for_tolerance(alpha, widths, tolerance, max_kmax)
+                if kmax is None:
+                    continue
+                recip_error = max(ewald_reciprocal_error(alpha, w, kmax) for w in widths)
+                params = {"method": method, "cutoff": cutoff, "alpha": alpha, "kmax": kmax, "pme_grid": None}
+            elif method == "pme":
+                pme_grid = pme_grid_for_tolerance(alpha, widths, tolerance)
+                recip_error = max(pme_reciprocal_error(alpha, w, k) for w, k in zip(widths, pme_grid))
+                params = {"method": method, "cutoff": cutoff, "alpha": alpha, "kmax": None, "pme_grid": pme_grid}
+            else:
+                raise ValueError("Unknown reciprocal space method: " + str(method))
+            candidates.append((params, max(real_error, recip_error)))
+
+    return candidates
+
+
+def tune_ewald(
+    box,
+    charges,
+    tolerance=5e-4,
+    conf=None,
+    cutoffs=None,
+    methods=("ewald", "pme"),
+    max_kmax=20,
+    repeats=3):
+    """
+    Choose the cheapest Ewald or PME setting whose estimated relative force error
+    is within the tolerance. For each candidate cutoff alpha is chosen to meet the
+    tolerance in real space, then kmax or the PME grid are the smallest that meet it
+    in reciprocal space. Each candidate is timed and the fastest is returned.
+
+    Results are cached per box shape, atom count and set of tuning arguments.
+
+    Parameters
+    ----------
+    box: shape [3, 3] np.array
+        periodic box vectors
+
+    charges: shape [num_atoms] np.array
+        charge of each atom
+
+    tolerance: float
+        target relative force error, same definition as OpenMM's ewaldErrorTolerance.
+
+    conf: shape [num_atoms, 3] np.array or None
+        coordinates used for timing, if None atoms are placed uniformly in the box.
+        The cost of the reference potentials does not depend on the conformation.
+
+    cutoffs: list of float or None
+        candidate cutoffs, if None then these span 0.5 nm to half the smallest box width.
+
+    methods: tuple of str
+        reciprocal space methods to consider, see electrostatics()
+
+    max_kmax: int
+        explicit Ewald settings that need more than this are skipped.
+
+    repeats: int
+        number of timed evaluations per candidate, the fastest is used.
+
+    Returns
+    -------
+    (dict, float, float)
+        keyword arguments for electrostatics() (method, cutoff, alpha, kmax, pme_grid),
+        the estimated error and the seconds per energy and gradient evaluation.
+
+    """
+    box = onp.asarray(box, dtype=onp.float64)
+    charges = onp.asarray(charges, dtype=onp.float64)
+    N = charges.shape[0]
+
+    max_cutoff = onp.amin(box_widths(box))/2
+    if cutoffs is None:
+        cutoffs = onp.linspace(min(0.5, max_cutoff), max_cutoff, 4)
+    cutoffs = [float(c) for c in cutoffs if c <= max_cutoff]
+    if len(cutoffs) == 0:
+        raise ValueError("Cutoffs cannot be larger than half the smallest box width.")
+
+    # the cost does not depend on the conformation, and repeats only affect the timing noise
+    key = (
+        tuple(onp.round(box, 6).reshape(-1)),
+        N,
+        tolerance,
+        tuple(methods),
+        tuple(cutoffs),
+        max_kmax
+    )
+    if key in _tuning_cache:
+        return _tuning_cache[key]
+
+    if conf is None:
+        conf = onp.matmul(onp.random.RandomState(N).rand(N, 3), box)
+    conf = onp.asarray(conf, dtype=onp.float64)
+
+    candidates = candidate_settings(box, tolerance, cutoffs, methods, max_kmax)
+    if len(candidates) == 0:
+        raise ValueError("No candidate setting meets the tolerance, try increasing max_kmax or enabling PME.")
+
+    best = None
+    for params, error in candidates:
+        seconds = time_setting(conf, box, charges, params, repeats)
+        if best is None or seconds < best[2]:
+            best = (params, error, seconds)
+
+    _tuning_cache[key] = best
+
+    return best
@@ -0,0 +1,355 @@
+import functools
+
+import numpy as onp
+import jax
+import jax.numpy as np
+
+from timemachine.potentials.jax_utils import convert_to_4d, delta_r
+from timemachine.potentials.neighborlist import build_neighbor_list
+from timemachine.potentials.nonbonded import nonbonded_pair_energies
+
+
+# same as timemachine/cpp/src/fixed_point_prod.hpp
+FIXED_EXPONENT = 0x1000000000
+
+
+def to_fixed_point(x):
+    """
+    Convert to 64 bit fixed point, truncating towards zero as in the CUDA kernels:
+    static_cast<unsigned long long>((long long) (x*FIXED_EXPONENT))
+    """
+    # without x64 jax silently casts to int32, which overflows for any |x| above 2^-5
+    assert jax.dtypes.canonicalize_dtype(np.int64) == np.int64, "fixed point accumulation requires jax_enable_x64"
+    return (x*FIXED_EXPONENT).astype(np.int64)
+
+
+def from_fixed_point(v):
+    return v.astype(np.float64)/FIXED_EXPONENT
+
+
+def cast_floats(x, precision):
+    """
+    Cast every floating point array in a pytree to precision, integer arrays are left as is.
+    """
+    def cast(a):
+        a = np.asarray(a)
+        if np.issubdtype(a.dtype, np.floating):
+            return a.astype(precision)
+        return a
+    return jax.tree_util.tree_map(cast, x)
+
+
+def _accumulate(idxs, grads, shape, precision, fixed_point):
+    # scatter the per term gradients [num_terms, K, D] onto the atoms
+    if fixed_point:
+        return from_fixed_point(np.zeros(shape, dtype=np.int64).at[idxs].add(to_fixed_point(grads)))
+    return np.zeros(shape, dtype=precision).at[idxs].add(grads).astype(np.float64)
+
+
+def _accumulate_pairs(pair_idxs, grads, shape, precision, fixed_point):
+    # the gradient of a pair term on its second atom is minus the gradient on its first, so
+    # the per pair gradients [num_pairs, D] are converted once and scattered with opposite
+    # signs. Converting and scattering the stacked [num_pairs, 2, D] gradients instead is
+    # about twice as slow on the CPU.
+    src_idxs = pair_idxs[:, 0]
+    dst_idxs = pair_idxs[:, 1]
+    if fixed_point:
+        grads = to_fixed_point(grads)
+        zeros = np.zeros(shape, dtype=np.int64)
+        return from_fixed_point(zeros.at[src_idxs].add(grads) - zeros.at[dst_idxs].add(grads))
+    zeros = np.zeros(shape, dtype=precision)
+    return (zeros.at[src_idxs].add(grads) - zeros.at[dst_idxs].add(grads)).astype(np.float64)
+
+
+def _sum(energies, fixed_point):
+    if fixed_point:
+        return from_fixed_point(np.sum(to_fixed_point(energies)))
+    return np.sum(energies.astype(np.float64))
+
+
+def _evaluate(terms_fn, accumulate_fn, conf, args, precision, fixed_point):
+    energies, grads = terms_fn(cast_floats(conf, precision), cast_floats(args, precision))
+    return accumulate_fn(grads, conf.shape, precision, fixed_point), _sum(energies, fixed_point)
+
+
+def fixed_point_gradients(terms_fn, accumulate_fn, precision=np.float32, fixed_point=True):
+    """
+    Differentiable du_dx and energy of a potential that is a sum of independent terms, eg.
+    bonds or pairs. Each term and its gradient is evaluated in precision and never summed in
+    floating point. If fixed_point is True the per term gradients are converted to 64 bit
+    fixed point and accumulated onto the atoms with integer adds, which are associative, so
+    the energy and du_dx are bitwise reproducible regardless of the term order.
+
+    du_dx and the energy come from a single evaluation of the terms, and the fixed point
+    du_dx is installed as the derivative of the energy with respect to conf. Derivatives of
+    du_dx itself, and of the energy with respect to args, are taken in floating point, the
+    same split as the CUDA kernels where the forces are accumulated in fixed point and the
+    jvps in floating point. So grad, jvp and the second order derivatives used by the
+    reference engine all work as usual.
+
+    Parameters
+    ----------
+    terms_fn: callable
+        terms_fn(conf, args) -> (energies [num_terms], grads), the per term energies and
+        gradients with respect to the coordinates of the atoms of each term.
+
+    accumulate_fn: callable
+        accumulate_fn(grads, shape, precision, fixed_point) -> du_dx, scatters the per term
+        gradients onto the atoms, eg. functools.partial(_accumulate, idxs).
+
+    precision: np.float32 or np.float64
+        precision conf, args and the terms are evaluated in
+
+    fixed_point: bool
+        whether or not to accumulate in fixed point.
+
+    Returns
+    -------
+    callable
+        gradients_fn(conf, args) -> (du_dx, energy), both in float64.
+
+    """
+
+    def evaluate(conf, args, fixed_point):
+        return _evaluate(terms_fn, accumulate_fn, conf, args, precision, fixed_point)
+
+    @jax.custom_jvp
+    def gradients_fn(conf, args):
+        return evaluate(conf, args, fixed_point)
+
+    @gradients_fn.defjvp
+    def gradients_jvp(primals, tangents):
+        conf, args = primals
+        conf_dot, args_dot = tangents
+        du_dx, energy = gradients_fn(conf, args)
+        _, (du_dx_dot, _) = jax.jvp(lambda conf, args: evaluate(conf, args, False), primals, tangents)
+        _, (_, args_energy_dot) = jax.jvp(lambda args: evaluate(conf, args, False), (args,), (args_dot,))
+        energy_dot = np.sum(du_dx*conf_dot) + args_energy_dot
+        return (du_dx, energy), (du_dx_dot, energy_dot)
+
+    return gradients_fn
+
+
+def term_gradients(term_fn, conf, idxs, term_args, precision=np.float32, fixed_point=True):
+    """
+    Energy and gradient of a potential that is a sum of independent terms, eg. bonds or
+    pairs. Each term is evaluated with vmap on its own atoms, so the per-term gradients
+    are never summed in floating point, see fixed_point_gradients().
+
+    Parameters
+    ----------
+    term_fn: callable
+        term_fn(x_local, *args) -> energy of a single term, where x_local [K, D] are the
+        coordinates of its atoms and args the matching rows of term_args.
+
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates
+
+    idxs: shape [num_terms, K] np.array
+        atoms of each term
+
+    term_args: tuple of [num_terms, ...] np.array
+        per term parameters
+
+    precision: np.float32 or np.float64
+        precision the terms are evaluated in
+
+    fixed_point: bool
+        whether or not to accumulate the gradients in fixed point.
+
+    Returns
+    -------
+    (np.array [num_atoms, D], np.float64)
+        gradient of the energy with respect to conf, and the energy, both in float64.
+        In fixed point mode the energy is accumulated in fixed point as well.
+
+    """
+    idxs = onp.asarray(idxs)
+
+    def terms_fn(conf, args):
+        return jax.vmap(jax.value_and_grad(term_fn))(conf[idxs], *args)
+
+    return _evaluate(terms_fn, functools.partial(_accumulate, idxs), conf, tuple(term_args), precision, fixed_point)
+
+
+def _bonded_terms(potential, idxs):
+    K = idxs.shape[1]
+    local_idxs = onp.arange(K, dtype=onp.int32).reshape(1, K)
+
+    def terms_fn(conf, args):
+        params, lamb, box = args
+        def term_fn(x_local, p):
+            return potential(x_local, lamb, np.expand_dims(p, 0), box, local_idxs)
+        return jax.vmap(jax.value_and_grad(term_fn))(conf[idxs], params)
+
+    return terms_fn
+
+
+def bonded_energy(potential, conf, lamb, params, box, idxs, precision=np.float32, fixed_point=True):
+    """
+    Differentiable fixed point variant of the bonded potentials of the form
+    potential(conf, lamb, params, box, idxs), eg. harmonic_bond, harmonic_angle
+    and periodic_torsion, see fixed_point_gradients().
+    """
+    idxs = onp.asarray(idxs)
+    gradients_fn = fixed_point_gradients(_bonded_terms(potential, idxs), functools.partial(_accumulate, idxs), precision, fixed_point)
+    return gradients_fn(conf, (params, np.asarray(lamb, dtype=np.float64), box))[1]
+
+
+def bonded_gradients(potential, conf, lamb, params, box, idxs, precision=np.float32, fixed_point=True):
+    """
+    du_dx and energy of bonded_energy() in a single pass.
+    """
+    idxs = onp.asarray(idxs)
+    args = (params, np.asarray(lamb, dtype=np.float64), box)
+    return _evaluate(_bonded_terms(potential, idxs), functools.partial(_accumulate, idxs), conf, args, precision, fixed_point)
+
+
+def dense_neighbor_list(num_atoms):
+    """
+    Neighbor list of every pair i < j, in the padded format of neighborlist.neighbor_list().
+    """
+    i_idxs = onp.arange(num_atoms).reshape(num_atoms, 1)
+    j_idxs = onp.arange(num_atoms).reshape(1, num_atoms)
+    return onp.where(j_idxs > i_idxs, j_idxs, num_atoms).astype(onp.int32)
+
+
+def default_neighbor_list(conf, cutoff, box=None):
+    """
+    Neighbor list of conf built on the host with neighborlist.build_neighbor_list(). If conf
+    is traced, eg. under jit, it cannot be binned on the host, and if cutoff is None every
+    pair interacts, so in either case every pair i < j is listed instead.
+    """
+    try:
+        conf = jax.core.concrete_or_error(onp.asarray, conf)
+    except jax.core.ConcretizationTypeError:
+        return dense_neighbor_list(conf.shape[0])
+    if cutoff is None:
+        return dense_neighbor_list(conf.shape[0])
+    return build_neighbor_list(conf[:, :3], cutoff, box=box)
+
+
+def neighbor_pairs(nblist, exclusion_idxs, charge_scales, lj_scales):
+    """
+    Pairs of a padded neighbor list with unit scales followed by the exclusions with negated
+    scales, so that nonbonded_pairs() over this list equals nonbonded(). Padding is turned
+    into (i, i) pairs, which contribute zero, so the shapes are static and this can be jitted.
+    """
+    nblist = np.asarray(nblist)
+    N, M = nblist.shape
+    i_idxs = np.repeat(np.arange(N, dtype=np.int32), M)
+    j_idxs = nblist.reshape(-1)
+    j_idxs = np.where(j_idxs < N, j_idxs, i_idxs)
+    pair_idxs = np.concatenate([np.stack([i_idxs, j_idxs], axis=1), np.asarray(exclusion_idxs, dtype=np.int32)])
+    pair_charge_scales = np.concatenate([np.ones(N*M), -np.asarray(charge_scales)])
+    pair_lj_scales = np.concatenate([np.ones(N*M), -np.asarray(lj_scales)])
+    return pair_idxs, pair_charge_scales, pair_lj_scales
+
+
+def nonbonded_pair_list(conf, cutoff, exclusion_idxs, charge_scales, lj_scales, box=None, nblist=None):
+    """
+    Compact variant of neighbor_pairs() built on the host. The pairs come from a cell list,
+    see neighborlist.build_neighbor_list(), so only the O(N) pairs within the cutoff of conf
+    are listed. The list uses the 3D distance, which is never larger than the 4D distance,
+    so it contains every interacting pair at any lambda.
+    """
+    if nblist is None:
+        nblist = build_neighbor_list(onp.asarray(conf)[:, :3], cutoff, box=box)
+    nblist = onp.asarray(nblist)
+    N, M = nblist.shape
+    i_idxs = onp.repeat(onp.arange(N), M)
+    j_idxs = nblist.reshape(-1)
+    mask = j_idxs < N
+    P = onp.sum(mask)
+    pair_idxs = onp.concatenate([onp.stack([i_idxs[mask], j_idxs[mask]], axis=1), onp.asarray(exclusion_idxs)]).astype(onp.int32)
+    pair_charge_scales = onp.concatenate([onp.ones(P), -onp.asarray(charge_scales)])
+    pair_lj_scales = onp.concatenate([onp.ones(P), -onp.asarray(lj_scales)])
+    return pair_idxs, pair_charge_scales, pair_lj_scales
+
+
+def _pair_terms(pair_idxs, cutoff, rf_dielectric=None, switch_distance=None):
+    src_idxs = pair_idxs[:, 0]
+    dst_idxs = pair_idxs[:, 1]
+    keep = src_idxs != dst_idxs
+
+    def terms_fn(conf, args):
+        charge_params, lj_params, charge_scales, lj_scales, box = args
+        qij = charge_params[src_idxs]*charge_params[dst_idxs]
+        sig_ij = (lj_params[src_idxs, 0] + lj_params[dst_idxs, 0])/2
+        eps_ij = np.sqrt(lj_params[src_idxs, 1]*lj_params[dst_idxs, 1])
+
+        def energies_fn(dr):
+            return nonbonded_pair_energies(dr, qij, sig_ij, eps_ij, charge_scales, lj_scales, keep, cutoff, rf_dielectric, switch_distance)
+
+        # each pair energy only depends on its own displacement, so a single vjp gives
+        # the per pair gradients with respect to the first atom without summing over pairs,
+        # see _accumulate_pairs().
+        dr = delta_r(conf[src_idxs], conf[dst_idxs], box)
+        energies, vjp_fn = jax.vjp(energies_fn, dr)
+        grads, = vjp_fn(np.ones_like(energies))
+        return energies, grads
+
+    return terms_fn
+
+
+def nonbonded_energy(
+    conf,
+    charge_params,
+    lj_params,
+    pair_idxs,
+    charge_scales,
+    lj_scales,
+    cutoff,
+    box=None,
+    precision=np.float32,
+    fixed_point=True,
+    rf_dielectric=None,
+    switch_distance=None):
+    """
+    Differentiable fixed point variant of nonbonded_pairs(), see fixed_point_gradients().
+    The pair list usually comes from neighbor_pairs() or nonbonded_pair_list(), conf
+    is typically 4D.
+    """
+    pair_idxs = np.asarray(pair_idxs)
+    gradients_fn = fixed_point_gradients(_pair_terms(pair_idxs, cutoff, rf_dielectric, switch_distance), functools.partial(_accumulate_pairs, pair_idxs), precision, fixed_point)
+    args = (np.asarray(charge_params), np.asarray(lj_params), np.asarray(charge_scales), np.asarray(lj_scales), box)
+    return gradients_fn(conf, args)[1]
+
+
+def nonbonded_gradients(
+    conf,
+    lamb,
+    charge_params,
+    lj_params,
+    pair_idxs,
+    charge_scales,
+    lj_scales,
+    cutoff,
+    lambda_plane_idxs,
+    lambda_offset_idxs,
+    box=None,
+    precision=np.float32,
+    fixed_point=True,
+    rf_dielectric=None,
+    switch_distance=None):
+    """
+    du_dx, du_dl and energy of nonbonded_energy() in a single pass. Gradients are
+    accumulated on the 4D coordinates, du_dl is recovered from the gradient of the
+    fourth dimension.
+
+    Returns
+    -------
+    (np.array [num_atoms, 3], np.float64, np.float64)
+        du_dx, du_dl and the energy
+
+    """
+    conf_4d = convert_to_4d(cast_floats(conf, precision), lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff)
+    pair_idxs = np.asarray(pair_idxs)
+
+    args = (np.asarray(charge_params), np.asarray(lj_params), np.asarray(charge_scales), np.asarray(lj_scales), box)
+    du_dx_4d, energy = _evaluate(_pair_terms(pair_idxs, cutoff, rf_dielectric, switch_distance), functools.partial(_accumulate_pairs, pair_idxs), conf_4d, args, precision, fixed_point)
+
+    # w = cutoff*plane + lamb*offset
+    du_dl = np.sum(du_dx_4d[:, 3]*np.asarray(lambda_offset_idxs, dtype=np.float64))
+
+    return du_dx_4d[:, :3], du_dl, energy
@@ -0,0 +1,299 @@
+import numpy as onp
+import jax
+import jax.numpy as np
+
+from timemachine.potentials.jax_utils import distance, delta_r, convert_to_4d
+from timemachine.potentials.bonded import signed_torsion_angle
+from timemachine.potentials.gbsa import born_integral, born_radii, born_self_energy
+
+
+TERM_NAMES = ("LennardJones", "Electrostatics", "GBSA")
+
+
+def nonbonded_gbsa_terms(
+    conf,
+    lamb,
+    charge_params,
+    lj_params,
+    gb_params,
+    exclusion_idxs,
+    charge_scales,
+    lj_scales,
+    cutoff,
+    lambda_plane_idxs,
+    lambda_offset_idxs,
+    alpha,
+    beta,
+    gamma,
+    dielectric_offset=0.009,
+    surface_tension=28.3919551,
+    solute_dielectric=1.0,
+    solvent_dielectric=78.5,
+    probe_radius=0.14):
+    """
+    Fused evaluation of nonbonded.nonbonded() and gbsa.gbsa_obc() on the same 4D coordinates.
+    The pair distances, the exclusion distances and the charge products are computed once and
+    shared by the Lennard-Jones, electrostatic and GB terms.
+
+    The GB cutoffs (cutoff_radii and cutoff_force) are assumed to be equal to the nonbonded
+    cutoff, as in setup_system.create_system(), so that both potentials see the same 4D coordinates.
+
+    Returns
+    -------
+    np.array [3]
+        Lennard-Jones, electrostatic and GBSA energies, in the order of TERM_NAMES.
+
+    """
+    conf_4d = convert_to_4d(conf, lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff)
+    N = conf.shape[0]
+
+    # shared pair geometry
+    ri = np.expand_dims(conf_4d, 0)
+    rj = np.expand_dims(conf_4d, 1)
+    dij = distance(ri, rj)
+    keep_mask = np.ones((N, N)) - np.eye(N)
+    r = np.where(keep_mask, dij, np.ones_like(dij)) # avoid divide-by-zero on the diagonal
+    in_cutoff = dij < cutoff
+
+    charges = charge_params
+    qij = np.outer(charges, charges)
+
+    src_idxs = exclusion_idxs[:, 0]
+    dst_idxs = exclusion_idxs[:, 1]
+    d_exc = distance(conf_4d[src_idxs], conf_4d[dst_idxs])
+    # same cutoff conventions as lennard_jones_exclusion() and simple_energy()
+    lj_exc_mask = (d_exc < cutoff) & (src_idxs != dst_idxs)
+    es_exc_mask = (d_exc <= cutoff) & (src_idxs != dst_idxs)
+
+    # Lennard-Jones
+    sig = lj_params[:, 0]
+    eps = lj_params[:, 1]
+
+    sig_ij = (np.expand_dims(sig, 0) + np.expand_dims(sig, 1))/2
+    eps_ij = np.sqrt(np.expand_dims(eps, 0) * np.expand_dims(eps, 1))
+    eps_ij = np.where(in_cutoff & (keep_mask > 0), eps_ij, np.zeros_like(eps_ij))
+
+    sig2 = sig_ij/r
+    sig2 *= sig2
+    sig6 = sig2*sig2*sig2
+    lj = np.sum(4*eps_ij*(sig6-1.0)*sig6)/2
+
+    sig_exc = (sig[src_idxs] + sig[dst_idxs])/2
+    eps_exc = np.sqrt(eps[src_idxs] * eps[dst_idxs])
+    sig2 = sig_exc/d_exc
+    sig2 *= sig2
+    sig6 = sig2*sig2*sig2
+    lj_exc = np.where(lj_exc_mask, lj_scales*4*eps_exc*(sig6-1.0)*sig6, np.zeros_like(d_exc))
+    lj = lj - np.sum(lj_exc)
+
+    # electrostatics
+    es_ij = np.where(keep_mask > 0, qij/r, np.zeros_like(r))
+    es_ij = np.where(dij > cutoff, np.zeros_like(es_ij), es_ij)
+    es = np.sum(es_ij)/2
+
+    es_exc = charge_scales*charges[src_idxs]*charges[dst_idxs]/d_exc
+    es_exc = np.where(es_exc_mask, es_exc, np.zeros_like(es_exc))
+    es = es - np.sum(es_exc)
+
+    # GBSA
+    radii = gb_params[:, 0]
+    scales = gb_params[:, 1]
+
+    or1 = radii.reshape((N, 1)) - dielectric_offset
+    or2 = radii.reshape((1, N)) - dielectric_offset
+    sr2 = scales.reshape((1, N)) * or2
+
+    I = born_integral(r, or1, sr2)
+    I = np.where((keep_mask > 0) & (dij <= cutoff), I, np.zeros_like(I))
+    I = np.sum(I, axis=1)
+
+    B = born_radii(I, radii, dielectric_offset, alpha, beta, gamma)
+
+    gb = born_self_energy(charges, radii, B, surface_tension, solute_dielectric, solvent_dielectric, probe_radius)
+
+    BB = np.outer(B, B)
+    f = np.sqrt(r ** 2 + BB * np.exp(-r ** 2 / (4 * BB)))
+    ixns = - (1 / solute_dielectric - 1 / solvent_dielectric) * qij / f
+    ixns = np.where((keep_mask > 0) & (dij <= cutoff), ixns, np.zeros_like(ixns))
+    gb += np.sum(ixns)/2
+
+    return np.stack([lj, es, gb])
+
+
+def nonbonded_gbsa_derivatives(conf, lamb, charge_params, lj_params, gb_params, **kwargs):
+    """
+    Per term energies and derivatives of nonbonded_gbsa_terms() from a single forward pass.
+
+    Returns
+    -------
+    dict
+        for each name in TERM_NAMES a dict with the energy, du_dx, du_dl, du_dcharge, du_dlj
+        and du_dgb of that term. Summing LennardJones and Electrostatics gives the breakdown
+        of the Nonbonded force used by the trainer.
+
+    """
+    def terms_fn(x, l, q, lj, gb):
+        return nonbonded_gbsa_terms(x, l, q, lj, gb, **kwargs)
+
+    energies, vjp_fn = jax.vjp(terms_fn, conf, lamb, charge_params, lj_params, gb_params)
+
+    results = {}
+    for idx, name in enumerate(TERM_NAMES):
+        du_dx, du_dl, du_dq, du_dlj, du_dgb = vjp_fn(np.eye(len(TERM_NAMES), dtype=energies.dtype)[idx])
+        results[name] = {
+            "energy": energies[idx],
+            "du_dx": du_dx,
+            "du_dl": du_dl,
+            "du_dcharge": du_dq,
+            "du_dlj": du_dlj,
+            "du_dgb": du_dgb
+        }
+
+    return results
+
+
+BONDED_TERM_NAMES = ("HarmonicBond", "HarmonicAngle", "PeriodicTorsion")
+
+
+def unique_torsions(torsion_idxs):
+    """
+    Deduplicate the torsion quadruples, eg. the rows repeated once per periodicity
+    by ProperTorsionHandler.parameterize().
+
+    Returns
+    -------
+    (np.array [num_unique, 4], np.array [num_torsions])
+        unique quadruples, and for each torsion the row of its quadruple.
+
+    """
+    torsion_idxs = onp.asarray(torsion_idxs, dtype=onp.int32).reshape(-1, 4)
+    if torsion_idxs.shape[0] == 0:
+        return torsion_idxs, onp.zeros(0, dtype=onp.int32)
+    unique_idxs, inverse = onp.unique(torsion_idxs, axis=0, return_inverse=True)
+    return unique_idxs.astype(onp.int32), inverse.reshape(-1).astype(onp.int32)
+
+
+def bonded_terms(conf, bond_params, angle_params, torsion_params, bond_idxs, angle_idxs, unique_torsion_idxs, torsion_inverse, box=None):
+    """
+    Per term energies of bonded.harmonic_bond(), bonded.harmonic_angle() (with cos_angles=True)
+    and bonded.periodic_torsion(). The dihedral angle of each unique quadruple is computed once
+    and broadcast to all of its Fourier terms, see unique_torsions().
+
+    Returns
+    -------
+    tuple of np.array [num_bonds], [num_angles], [num_torsions]
+        energy of every bond, angle and torsion term.
+
+    """
+    ci = conf[bond_idxs[:, 0]]
+    cj = conf[bond_idxs[:, 1]]
+    dij = distance(ci, cj, box)
+    bond_nrgs = bond_params[:, 0]/2 * np.power(dij - bond_params[:, 1], 2.0)
+
+    ci = conf[angle_idxs[:, 0]]
+    cj = conf[angle_idxs[:, 1]]
+    ck = conf[angle_idxs[:, 2]]
+    vij = delta_r(ci, cj, box)
+    vjk = delta_r(ck, cj, box)
+    tb = np.sum(vij*vjk, -1)/(np.linalg.norm(vij, axis=-1)*np.linalg.norm(vjk, axis=-1))
+    angle_nrgs = angle_params[:, 0]/2 * np.power(tb - np.cos(angle_params[:, 1]), 2)
+
+    x3 = conf[:, :3] # torsions are defined only in 3d
+    theta = signed_torsion_angle(
+        x3[unique_torsion_idxs[:, 0]],
+        x3[unique_torsion_idxs[:, 1]],
+        x3[unique_torsion_idxs[:, 2]],
+        x3[unique_torsion_idxs[:, 3]]
+    )
+    theta = theta[torsion_inverse]
+    ks = torsion_params[:, 0]
+    phase = torsion_params[:, 1]
+    period = torsion_params[:, 2]
+    torsion_nrgs = ks*(1+np.cos(period * theta - phase))
+
+    return bond_nrgs, angle_nrgs, torsion_nrgs
+
+
+class FusedBonded():
+
+    def __init__(self, bond_idxs, angle_idxs, torsion_idxs, box=None):
+        """
+        Harmonic bonds, harmonic angles and periodic torsions evaluated in a single jitted call.
+        Proper and improper torsions can be concatenated into one torsion_idxs array, the
+        quadruples are deduplicated once here so each dihedral angle is computed only once.
+
+        Parameters
+        ----------
+        bond_idxs: shape [num_bonds, 2] np.array
+
+        angle_idxs: shape [num_angles, 3] np.array
+
+        torsion_idxs: shape [num_torsions, 4] np.array
+            may contain repeated quadruples, one per Fourier term.
+
+        box: shape [3, 3] np.array
+            periodic boundary vectors used by the bonds and angles, if not None
+
+        """
+        self.bond_idxs = onp.asarray(bond_idxs, dtype=onp.int32).reshape(-1, 2)
+        self.angle_idxs = onp.asarray(angle_idxs, dtype=onp.int32).reshape(-1, 3)
+        self.unique_torsion_idxs, self.torsion_inverse = unique_torsions(torsion_idxs)
+        self.box = box
+        self._derivatives_fn = jax.jit(self._derivatives)
+
+    def energies(self, conf, bond_params, angle_params, torsion_params):
+        """
+        Per term energies, see bonded_terms().
+        """
+        return bonded_terms(
+            conf,
+            bond_params,
+            angle_params,
+            torsion_params,
+            self.bond_idxs,
+            self.angle_idxs,
+            self.unique_torsion_idxs,
+            self.torsion_inverse,
+            self.box
+        )
+
+    def _derivatives(self, conf, bond_params, angle_params, torsion_params):
+
+        def totals_fn(x, bp, ap, tp):
+            nrgs = self.energies(x, bp, ap, tp)
+            return np.stack([np.sum(e) for e in nrgs]), nrgs
+
+        totals, vjp_fn, nrgs = jax.vjp(totals_fn, conf, bond_params, angle_params, torsion_params, has_aux=True)
+
+        results = []
+        for idx in range(len(BONDED_TERM_NAMES)):
+            du_dx, du_dbp, du_dap, du_dtp = vjp_fn(np.eye(len(BONDED_TERM_NAMES), dtype=totals.dtype)[idx])
+            results.append((totals[idx], nrgs[idx], du_dx, (du_dbp, du_dap, du_dtp)[idx]))
+
+        return results
+
+    def derivatives(self, conf, bond_params, angle_params, torsion_params):
+        """
+        Energies and derivatives of every bonded term from a single jitted call.
+
+        Returns
+        -------
+        dict
+            for each name in BONDED_TERM_NAMES a dict with the total energy, the per term
+            energies, du_dx and du_dp of that term. Parameter gradients have the same shape
+            as the parameters, one row per (possibly repeated) term, so they can be passed
+            directly to the vjp_fn returned by the handlers.
+
+        """
+        results = {}
+        for name, (energy, energies, du_dx, du_dp) in zip(
+            BONDED_TERM_NAMES,
+            self._derivatives_fn(conf, bond_params, angle_params, torsion_params)):
+            results[name] = {
+                "energy": energy,
+                "energies": energies,
+                "du_dx": du_dx,
+                "du_dp": du_dp
+            }
+
+        return results
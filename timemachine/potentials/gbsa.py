@@ -4,11 +4,57 @@
 import jax.numpy as np
 from jax import grad, jit
 from timemachine.potentials.jax_utils import delta_r, distance, lambda_to_w, convert_to_4d
+from timemachine.potentials.neighborlist import gather_neighbors
 
 def step(x):
     # return (x > 0)
     return 1.0 * (x >= 0)
 
+def born_integral(r, or1, sr2):
+    """
+    Descreening integral of atom j (scaled offset radius sr2) over atom i
+    (offset radius or1) a distance r apart, used to compute the Born radius of i.
+    """
+    L = np.maximum(or1, abs(r - sr2))
+    U = r + sr2
+
+    I = 1 / L - 1 / U + 0.25 * (r - sr2 ** 2 / r) * (1 / (U ** 2) - 1 / (L ** 2)) + 0.5 * np.log(
+        L / U) / r
+    # handle the interior case
+    I = np.where(or1 < (sr2 - r), I + 2*(1/or1 - 1/L), I)
+    I = step(r + sr2 - or1) * 0.5 * I # note the extra 0.5 here
+    return I
+
+def born_radii(I, radii, dielectric_offset, alpha, beta, gamma):
+    """
+    OBC Born radii from the summed descreening integrals I of each atom.
+    """
+    offset_radius = radii - dielectric_offset
+
+    psi = I * offset_radius
+
+    psi_coefficient = alpha
+    psi2_coefficient = beta
+    psi3_coefficient = gamma
+
+    psi_term = (psi_coefficient * psi) - (psi2_coefficient * psi ** 2) + (psi3_coefficient * psi ** 3)
+
+    return 1 / (1 / offset_radius - np.tanh(psi_term) / radii)
+
+def born_self_energy(charges, radii, B, surface_tension, solute_dielectric, solvent_dielectric, probe_radius):
+    """
+    Single particle terms: the ACE surface area term and the on-diagonal GB term.
+    """
+    E = 0.0
+    # single particle
+    # ACE
+    E += np.sum(surface_tension * (radii + probe_radius) ** 2 * (radii / B) ** 6)
+
+    # on-diagonal
+    E += np.sum(-0.5 * (1 / solute_dielectric - 1 / solvent_dielectric) * charges ** 2 / B)
+
+    return E
+
 def gbsa_obc(
     coords,
     # params,
@@ -30,7 +76,15 @@ def gbsa_obc(
     surface_tension=28.3919551,
     solute_dielectric=1.0,
     solvent_dielectric=78.5,
-    probe_radius=0.14):
+    probe_radius=0.14,
+    nblist=None):
+    """
+    OBC generalized Born energy with a surface area term.
+
+    If nblist is not None, then only the pairs in the neighbor list are visited, see
+    gbsa_obc_nblist(). The list must be built with a cutoff of at least cutoff_radii.
+
+    """
 
     box = None
 
@@ -38,6 +92,24 @@ def gbsa_obc(
 
     coords_4d = convert_to_4d(coords, lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff_radii)
 
+    if nblist is not None:
+        return gbsa_obc_nblist(
+            coords_4d,
+            charge_params,
+            gb_params,
+            alpha,
+            beta,
+            gamma,
+            cutoff_radii,
+            cutoff_force,
+            nblist,
+            dielectric_offset,
+            surface_tension,
+            solute_dielectric,
+            solvent_dielectric,
+            probe_radius
+        )
+
     N = len(charge_params)
 
     radii = gb_params[:, 0]
@@ -55,14 +127,7 @@ def gbsa_obc(
     or2 = radii.reshape((1, N)) - dielectric_offset
     sr2 = scales.reshape((1, N)) * or2
 
-    L = np.maximum(or1, abs(r - sr2))
-    U = r + sr2
-
-    I = 1 / L - 1 / U + 0.25 * (r - sr2 ** 2 / r) * (1 / (U ** 2) - 1 / (L ** 2)) + 0.5 * np.log(
-        L / U) / r
-    # handle the interior case
-    I = np.where(or1 < (sr2 - r), I + 2*(1/or1 - 1/L), I)
-    I = step(r + sr2 - or1) * 0.5 * I # note the extra 0.5 here
+    I = born_integral(r, or1, sr2)
     I -= np.diag(np.diag(I))
 
     # switch I only for now
@@ -74,27 +139,11 @@ def gbsa_obc(
     I = np.sum(I, axis=1)
 
     # okay, next compute born radii
-    offset_radius = radii - dielectric_offset
+    B = born_radii(I, radii, dielectric_offset, alpha, beta, gamma)
 
-    psi = I * offset_radius
-
-    psi_coefficient = alpha
-    psi2_coefficient = beta
-    psi3_coefficient = gamma
-
-    psi_term = (psi_coefficient * psi) - (psi2_coefficient * psi ** 2) + (psi3_coefficient * psi ** 3)
-
-    B = 1 / (1 / offset_radius - np.tanh(psi_term) / radii)
-
-    E = 0.0
-    # single particle
-    # ACE
-    E += np.sum(surface_tension * (radii + probe_radius) ** 2 * (radii / B) ** 6)
-
-    # on-diagonal
     charges = charge_params
 
-    E += np.sum(-0.5 * (1 / solute_dielectric - 1 / solvent_dielectric) * charges ** 2 / B)
+    E = born_self_energy(charges, radii, B, surface_tension, solute_dielectric, solvent_dielectric, probe_radius)
 
     # particle pair
     f = np.sqrt(r ** 2 + np.outer(B, B) * np.exp(-r ** 2 / (4 * np.outer(B, B))))
@@ -108,4 +157,69 @@ def gbsa_obc(
 
     E += np.sum(np.triu(ixns, k=1))
 
-    return E
\ No newline at end of file
+    return E
+
+def gbsa_obc_nblist(
+    coords_4d,
+    charge_params,
+    gb_params,
+    alpha,
+    beta,
+    gamma,
+    cutoff_radii,
+    cutoff_force,
+    nblist,
+    dielectric_offset=0.009,
+    surface_tension=28.3919551,
+    solute_dielectric=1.0,
+    solvent_dielectric=78.5,
+    probe_radius=0.14):
+    """
+    Neighbor list variant of gbsa_obc() operating on 4D coordinates. Born radii are
+    accumulated in a first pass over the half list, where each pair (i, j) descreens
+    both i and j, and the pair energies are computed in a second pass over the same list.
+
+    Since the 4D distance is never smaller than the 3D distance a list built on the 3D
+    coordinates with cutoff_radii is valid at every lambda.
+    """
+    N = coords_4d.shape[0]
+
+    charges = np.asarray(charge_params)
+    radii = np.asarray(gb_params[:, 0])
+    scales = np.asarray(gb_params[:, 1])
+
+    ri, rj, mask = gather_neighbors(coords_4d, nblist)
+    j_idxs = np.where(mask, nblist, 0)
+    dij = distance(ri, rj)
+    r = np.where(mask, dij, np.ones_like(dij)) # padded entries may alias i
+
+    offset_radii = radii - dielectric_offset
+    scaled_radii = scales * offset_radii
+
+    # pass 1: descreening of i by j and of j by i
+    or_i = np.expand_dims(offset_radii, 1)
+    I_ij = born_integral(r, or_i, scaled_radii[j_idxs])
+    I_ji = born_integral(r, offset_radii[j_idxs], np.expand_dims(scaled_radii, 1))
+
+    keep = mask & (dij <= cutoff_radii)
+    I_ij = np.where(keep, I_ij, np.zeros_like(I_ij))
+    I_ji = np.where(keep, I_ji, np.zeros_like(I_ji))
+
+    I = np.sum(I_ij, axis=1)
+    I = I.at[j_idxs.reshape(-1)].add(I_ji.reshape(-1))
+
+    B = born_radii(I, radii, dielectric_offset, alpha, beta, gamma)
+
+    E = born_self_energy(charges, radii, B, surface_tension, solute_dielectric, solvent_dielectric, probe_radius)
+
+    # pass 2: pair terms, every pair is visited once
+    BB = np.expand_dims(B, 1) * B[j_idxs]
+    f = np.sqrt(r ** 2 + BB * np.exp(-r ** 2 / (4 * BB)))
+    charge_products = np.expand_dims(charges, 1) * charges[j_idxs]
+
+    ixns = - (1 / solute_dielectric - 1 / solvent_dielectric) * charge_products / f
+    ixns = np.where(mask & (dij <= cutoff_force), ixns, np.zeros_like(ixns))
+
+    E += np.sum(ixns)
+
+    return E
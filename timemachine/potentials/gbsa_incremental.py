@@ -0,0 +1,192 @@
+import numpy as onp
+import jax.numpy as np
+
+from timemachine.potentials.jax_utils import distance, convert_to_4d
+from timemachine.potentials.gbsa import born_integral, born_radii, born_self_energy
+
+
+class IncrementalGBSA():
+
+    def __init__(
+        self,
+        charge_params,
+        gb_params,
+        alpha,
+        beta,
+        gamma,
+        cutoff_radii,
+        cutoff_force,
+        lambda_plane_idxs,
+        lambda_offset_idxs,
+        dielectric_offset=0.009,
+        surface_tension=28.3919551,
+        solute_dielectric=1.0,
+        solvent_dielectric=78.5,
+        probe_radius=0.14,
+        threshold=0.0,
+        born_tolerance=0.0):
+        """
+        GBSA energy, identical to gbsa.gbsa_obc(), that is updated incrementally when
+        only a subset of the atoms moves, eg. a ligand being docked into a rigid host.
+
+        The descreening integrals, Born radii and pair energy of the last evaluated
+        conformation are cached. On the next call only the atoms displaced by more than
+        threshold (in 4D, so changes in lambda are picked up as well) are treated as moved:
+        the integrals of the moved atoms are recomputed from scratch, the contributions of
+        the moved atoms to every other integral are swapped out, and the pair energies of
+        every atom whose Born radius changed by more than born_tolerance are re-evaluated.
+
+        The integrals cost O(N*num_moved) and the pair energies O(N*num_changed), where
+        num_changed counts the moved atoms and the atoms whose Born radius changed. Within
+        cutoff_radii of a moved atom every Born radius changes, so with a long cutoff and
+        born_tolerance=0 num_changed is close to N. Once more than a quarter of the atoms
+        changed, the pair energy is recomputed in full, which is O(N^2) like gbsa_obc().
+        last_update records which of these paths was taken.
+
+        Atoms displaced by less than threshold keep their cached positions, and Born radii
+        that changed by less than born_tolerance keep their cached values, so the energy is
+        exact for threshold=0 and born_tolerance=0.
+
+        Parameters
+        ----------
+        threshold: float
+            displacement below which an atom is considered to be stationary.
+
+        born_tolerance: float
+            change in Born radius, in nm, below which the cached radius is kept.
+
+        See gbsa.gbsa_obc() for the other parameters.
+
+        """
+        assert cutoff_radii == cutoff_force
+
+        self.charges = onp.asarray(charge_params, dtype=onp.float64)
+        self.radii = onp.asarray(gb_params[:, 0], dtype=onp.float64)
+        scales = onp.asarray(gb_params[:, 1], dtype=onp.float64)
+
+        self.offset_radii = self.radii - dielectric_offset
+        self.scaled_radii = scales * self.offset_radii
+
+        self.alpha = alpha
+        self.beta = beta
+        self.gamma = gamma
+        self.cutoff_radii = cutoff_radii
+        self.cutoff_force = cutoff_force
+        self.lambda_plane_idxs = lambda_plane_idxs
+        self.lambda_offset_idxs = lambda_offset_idxs
+        self.dielectric_offset = dielectric_offset
+        self.surface_tension = surface_tension
+        self.solute_dielectric = solute_dielectric
+        self.solvent_dielectric = solvent_dielectric
+        self.probe_radius = probe_radius
+        self.threshold = threshold
+        self.born_tolerance = born_tolerance
+
+        self.reset()
+
+    def reset(self):
+        """
+        Discard the cache, the next call recomputes everything.
+        """
+        self.x_ref = None
+        self.I = None
+        self.B = None
+        self.pair_energy = None
+        self.last_update = None
+
+    def _descreening(self, x, i_idxs, j_idxs):
+        # [len(i_idxs), len(j_idxs)] descreening of each i by each j
+        ri = np.expand_dims(x[i_idxs], 1)
+        rj = np.expand_dims(x[j_idxs], 0)
+        dij = distance(ri, rj)
+        diag = np.expand_dims(i_idxs, 1) == np.expand_dims(j_idxs, 0)
+        r = np.where(diag, np.ones_like(dij), dij)
+        I = born_integral(r, np.expand_dims(self.offset_radii[i_idxs], 1), np.expand_dims(self.scaled_radii[j_idxs], 0))
+        return np.where(diag | (dij > self.cutoff_radii), np.zeros_like(I), I)
+
+    def _pair_energies(self, x, B, i_idxs, j_idxs):
+        # [len(i_idxs), len(j_idxs)] GB pair energies, zero on the diagonal
+        ri = np.expand_dims(x[i_idxs], 1)
+        rj = np.expand_dims(x[j_idxs], 0)
+        dij = distance(ri, rj)
+        diag = np.expand_dims(i_idxs, 1) == np.expand_dims(j_idxs, 0)
+        r = np.where(diag, np.ones_like(dij), dij)
+        BB = np.expand_dims(B[i_idxs], 1) * np.expand_dims(B[j_idxs], 0)
+        f = np.sqrt(r ** 2 + BB * np.exp(-r ** 2 / (4 * BB)))
+        qij = np.expand_dims(self.charges[i_idxs], 1) * np.expand_dims(self.charges[j_idxs], 0)
+        ixns = - (1 / self.solute_dielectric - 1 / self.solvent_dielectric) * qij / f
+        return np.where(diag | (dij > self.cutoff_force), np.zeros_like(ixns), ixns)
+
+    def _touching_energy(self, x, B, idxs):
+        # sum of the pair energies of every pair with at least one atom in idxs
+        all_idxs = onp.arange(x.shape[0])
+        return np.sum(self._pair_energies(x, B, idxs, all_idxs)) - np.sum(self._pair_energies(x, B, idxs, idxs))/2
+
+    def _full_update(self, x):
+        all_idxs = onp.arange(x.shape[0])
+        self.I = np.sum(self._descreening(x, all_idxs, all_idxs), axis=1)
+        self.B = born_radii(self.I, self.radii, self.dielectric_offset, self.alpha, self.beta, self.gamma)
+        self.pair_energy = np.sum(self._pair_energies(x, self.B, all_idxs, all_idxs))/2
+        self.x_ref = x
+        self.last_update = "full"
+
+    def _incremental_update(self, x_new, moved):
+        x_old = self.x_ref
+        N = x_old.shape[0]
+        all_idxs = onp.arange(N)
+
+        # swap out the contributions of the moved atoms to every integral
+        I = self.I - np.sum(self._descreening(x_old, all_idxs, moved), axis=1)
+        I = I + np.sum(self._descreening(x_new, all_idxs, moved), axis=1)
+        # and recompute the integrals of the moved atoms from scratch
+        I = I.at[moved].set(np.sum(self._descreening(x_new, moved, all_idxs), axis=1))
+
+        B = born_radii(I, self.radii, self.dielectric_offset, self.alpha, self.beta, self.gamma)
+
+        # radii that barely changed keep their cached values, otherwise a long cutoff changes every one
+        B_change = onp.abs(onp.asarray(B - self.B))
+        B = np.where(B_change > self.born_tolerance, B, self.B)
+        changed = onp.union1d(moved, onp.where(B_change > self.born_tolerance)[0])
+
+        if 4*len(changed) > N:
+            # the touching energies would cost more than a full evaluation
+            pair_energy = np.sum(self._pair_energies(x_new, B, all_idxs, all_idxs))/2
+            self.last_update = "incremental_full_pairs"
+        else:
+            pair_energy = self.pair_energy - self._touching_energy(x_old, self.B, changed)
+            pair_energy = pair_energy + self._touching_energy(x_new, B, changed)
+            self.last_update = "incremental"
+
+        self.I = I
+        self.B = B
+        self.pair_energy = pair_energy
+        self.x_ref = x_new
+
+    def energy(self, coords, lamb):
+        """
+        Compute the GBSA energy of coords at lamb, updating the cache.
+        """
+        x = convert_to_4d(np.asarray(coords), lamb, self.lambda_plane_idxs, self.lambda_offset_idxs, self.cutoff_radii)
+
+        if self.x_ref is None:
+            self._full_update(x)
+        else:
+            displacement = onp.linalg.norm(onp.asarray(x - self.x_ref), axis=-1)
+            moved = onp.where(displacement > self.threshold)[0]
+            if len(moved) > 0:
+                # atoms below the threshold keep their cached positions
+                x = self.x_ref.at[moved].set(x[moved])
+                if 2*len(moved) > x.shape[0]:
+                    self._full_update(x)
+                else:
+                    self._incremental_update(x, moved)
+
+        return born_self_energy(
+            self.charges,
+            self.radii,
+            self.B,
+            self.surface_tension,
+            self.solute_dielectric,
+            self.solvent_dielectric,
+            self.probe_radius
+        ) + self.pair_energy
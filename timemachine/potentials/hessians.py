@@ -0,0 +1,252 @@
+import numpy as onp
+import jax
+import jax.numpy as np
+from jax.ops import segment_sum
+from jax.scipy.sparse.linalg import cg
+
+
+def hvp_fn(energy_fn, conf, *args):
+    """
+    Hessian-vector products of energy_fn(conf, *args) with respect to conf, without
+    materializing the Hessian. The gradient is linearized once (forward-over-reverse),
+    so each product costs about as much as a gradient evaluation.
+
+    Parameters
+    ----------
+    energy_fn: callable
+        any potential of the form energy_fn(conf, *args), eg. bonded.harmonic_bond
+        with functools.partial() applied to its parameters.
+
+    conf: shape [num_atoms, D] np.array
+        point at which the Hessian is taken
+
+    Returns
+    -------
+    callable
+        v [num_atoms, D] -> H v [num_atoms, D]
+
+    """
+    grad_fn = jax.grad(lambda x: energy_fn(x, *args))
+    _, hvp = jax.linearize(grad_fn, conf)
+    return hvp
+
+
+def hvp(energy_fn, conf, v, *args):
+    """
+    Single Hessian-vector product H v, see hvp_fn().
+    """
+    return jax.jvp(jax.grad(lambda x: energy_fn(x, *args)), (conf,), (v,))[1]
+
+
+def bonded_hessian_blocks(potential, conf, lamb, params, box, idxs):
+    """
+    Block sparse Hessian of a bonded potential of the form potential(conf, lamb, params, box, idxs),
+    eg. harmonic_bond, harmonic_angle and periodic_torsion. Each term only couples its own K
+    atoms, so its Hessian is computed on local coordinates and stored as K*K dense D x D blocks.
+    Blocks with the same (row, col) are summed when applied.
+
+    Returns
+    -------
+    (np.array [T*K*K], np.array [T*K*K], np.array [T*K*K, D, D])
+        row atom, col atom and block of every term
+
+    """
+    idxs = onp.asarray(idxs)
+    T, K = idxs.shape
+    D = conf.shape[1]
+    local_idxs = onp.arange(K, dtype=onp.int32).reshape(1, K)
+
+    def term_fn(x_local, p):
+        return potential(x_local, lamb, np.expand_dims(p, 0), box, local_idxs)
+
+    x_local = conf[idxs] # [T, K, D]
+    blocks = jax.vmap(jax.hessian(term_fn))(x_local, params) # [T, K, D, K, D]
+    blocks = np.transpose(blocks, (0, 1, 3, 2, 4)).reshape(T*K*K, D, D)
+
+    rows = onp.repeat(idxs, K, axis=1).reshape(-1)
+    cols = onp.tile(idxs, (1, K)).reshape(-1)
+
+    return rows, cols, blocks
+
+
+def block_sparse_matvec(rows, cols, blocks, v):
+    """
+    H v for a Hessian stored as blocks, see bonded_hessian_blocks().
+    """
+    contrib = np.einsum('bij,bj->bi', blocks, v[cols])
+    return segment_sum(contrib, rows, num_segments=v.shape[0])
+
+
+def block_sparse_to_dense(rows, cols, blocks, num_atoms):
+    """
+    Dense [num_atoms, D, num_atoms, D] Hessian, intended for debugging small systems.
+    """
+    D = blocks.shape[-1]
+    H = np.zeros((num_atoms, num_atoms, D, D), dtype=blocks.dtype).at[rows, cols].add(blocks)
+    return np.transpose(H, (0, 2, 1, 3))
+
+
+def mass_weighted_matvec(matvec, masses):
+    """
+    v -> M^-1/2 H M^-1/2 v, whose eigenvalues are the squared angular frequencies of the
+    normal modes.
+    """
+    inv_sqrt_m = 1/np.sqrt(np.expand_dims(np.asarray(masses), -1))
+
+    def fn(v):
+        return inv_sqrt_m*matvec(inv_sqrt_m*v)
+
+    return fn
+
+
+def lanczos(matvec, shape, num_iters, seed=2020):
+    """
+    Lanczos tridiagonalization of a symmetric linear operator with full reorthogonalization.
+
+    Parameters
+    ----------
+    matvec: callable
+        v -> A v, where v has the given shape.
+
+    shape: tuple of int
+        shape of the vectors, eg. (num_atoms, 3).
+
+    num_iters: int
+        size of the Krylov subspace, capped by the dimension of the operator.
+
+    Returns
+    -------
+    (np.array [M], np.array [M-1], np.array [M, dim])
+        diagonal and off diagonal of the tridiagonal matrix, and the Lanczos vectors.
+
+    """
+    dim = int(onp.prod(shape))
+    num_iters = min(num_iters, dim)
+    rs = onp.random.RandomState(seed)
+
+    matvec = jax.jit(matvec)
+
+    V = onp.zeros((num_iters, dim))
+    alphas = []
+    betas = []
+
+    v = rs.randn(dim)
+    v /= onp.linalg.norm(v)
+
+    for k in range(num_iters):
+        V[k] = v
+        w = onp.asarray(matvec(v.reshape(shape))).reshape(-1)
+        alpha = onp.dot(w, v)
+        alphas.append(alpha)
+        # full reorthogonalization, done twice for stability
+        for _ in range(2):
+            w = w - V[:k+1].T @ (V[:k+1] @ w)
+        beta = onp.linalg.norm(w)
+        if k == num_iters - 1:
+            break
+        if beta < 1e-10:
+            # invariant subspace found, restart with a vector orthogonal to it
+            w = rs.randn(dim)
+            w = w - V[:k+1].T @ (V[:k+1] @ w)
+            beta_next = 0.0
+            w /= onp.linalg.norm(w)
+        else:
+            beta_next = beta
+            w = w/beta
+        betas.append(beta_next)
+        v = w
+
+    return onp.array(alphas), onp.array(betas), V[:len(alphas)]
+
+
+def lowest_modes(matvec, shape, num_modes, num_iters=None, seed=2020):
+    """
+    Lowest eigenvalues and eigenvectors of a symmetric linear operator, eg. a Hessian given by
+    hvp_fn() or its mass weighted variant, from the Ritz pairs of a Lanczos run.
+
+    Parameters
+    ----------
+    num_modes: int
+        number of eigenpairs to return.
+
+    num_iters: int or None
+        Krylov subspace size, defaults to max(4*num_modes, 50). Larger values resolve the
+        lowest modes of poorly separated spectra more accurately.
+
+    Returns
+    -------
+    (np.array [num_modes], np.array [num_modes, *shape])
+        eigenvalues in ascending order and the matching eigenvectors.
+
+    """
+    if num_iters is None:
+        num_iters = max(4*num_modes, 50)
+
+    alphas, betas, V = lanczos(matvec, shape, num_iters, seed)
+
+    T = onp.diag(alphas) + onp.diag(betas, 1) + onp.diag(betas, -1)
+    evals, evecs = onp.linalg.eigh(T)
+
+    ritz_vecs = (V.T @ evecs[:, :num_modes]).T
+
+    return evals[:num_modes], ritz_vecs.reshape((-1,) + tuple(shape))
+
+
+def total_derivative(energy_fn, conf, params, dxdp):
+    """
+    Matrix free equivalent of derivatives.total_derivative(). For each parameter p_m this
+    computes H dxdp[m] + d^2E/dx dp_m with a single jvp of the gradient, without
+    materializing the Hessian or the mixed partials.
+
+    Parameters
+    ----------
+    energy_fn: callable
+        energy_fn(conf, params) -> energy
+
+    conf: shape [num_atoms, D] np.array
+
+    params: shape [P] np.array
+
+    dxdp: shape [P, num_atoms, D] np.array
+        derivative of the coordinates with respect to each parameter.
+
+    Returns
+    -------
+    np.array [P, num_atoms, D]
+
+    """
+    grad_fn = jax.grad(energy_fn, argnums=0)
+    basis = np.eye(params.shape[0], dtype=params.dtype)
+
+    def column(dx, dp):
+        return jax.jvp(grad_fn, (conf, params), (dx, dp))[1]
+
+    return jax.vmap(column)(dxdp, basis)
+
+
+def implicit_derivative(energy_fn, conf, params, dp, damping=0.0, tol=1e-8, maxiter=None):
+    """
+    Derivative dx of a local minimum conf with respect to a change dp of the parameters,
+    from the implicit function theorem: H dx = -d^2E/dx dp. The linear system is solved
+    with conjugate gradients on Hessian-vector products.
+
+    Rigid body motions are zero modes of the Hessian of most systems. They are projected out
+    by CG when the right hand side is orthogonal to them, otherwise use damping > 0 to solve
+    (H + damping*I) dx = -d^2E/dx dp instead.
+
+    Returns
+    -------
+    np.array [num_atoms, D]
+
+    """
+    grad_fn = jax.grad(energy_fn, argnums=0)
+    rhs = -jax.jvp(lambda p: grad_fn(conf, p), (params,), (dp,))[1]
+
+    hvp = hvp_fn(energy_fn, conf, params)
+
+    def matvec(v):
+        return hvp(v) + damping*v
+
+    dx, _ = cg(matvec, rhs, tol=tol, maxiter=maxiter)
+
+    return dx
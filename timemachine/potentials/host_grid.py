@@ -0,0 +1,350 @@
+import os
+import hashlib
+
+import numpy as onp
+import jax.numpy as np
+
+from timemachine.potentials.batch import chunked_vmap
+
+
+def pocket_bounds(conf, pocket_idxs, spacing, margin=0.5):
+    """
+    Origin and shape of a grid that covers the pocket atoms, eg. from
+    setup_system.find_protein_pocket_atoms(), padded by margin nm on each side.
+
+    Returns
+    -------
+    (np.array [3], tuple of int)
+        origin and number of grid points along x, y and z.
+
+    """
+    pocket = onp.asarray(conf)[onp.asarray(pocket_idxs)]
+    lo = onp.amin(pocket, axis=0) - margin
+    hi = onp.amax(pocket, axis=0) + margin
+    shape = tuple(int(s) for s in onp.ceil((hi - lo)/spacing).astype(onp.int64) + 1)
+    return lo, shape
+
+
+def grid_points(origin, spacing, shape):
+    """
+    Cartesian coordinates [nx, ny, nz, 3] of every grid point.
+    """
+    axes = [origin[d] + spacing*onp.arange(shape[d]) for d in range(3)]
+    return onp.stack(onp.meshgrid(*axes, indexing='ij'), axis=-1)
+
+
+def tabulate_host_potentials(
+    host_conf,
+    host_charges,
+    host_lj,
+    guest_sigmas,
+    origin,
+    spacing,
+    shape,
+    cutoff,
+    w=0.0,
+    max_value=1e4,
+    chunk_size=1024):
+    """
+    Tabulate the potentials of a rigid host on a grid.
+
+    The electrostatic grid holds phi(r) = sum_j q_j/d_j. With the Lorentz-Berthelot rules the
+    LJ energy of a guest atom with (sig_i, eps_i) is sqrt(eps_i)*G_sig_i(r), where
+
+        G_sig(r) = sum_j sqrt(eps_j)*4*((sig_ij/d_j)^12 - (sig_ij/d_j)^6), sig_ij = (sig + sig_j)/2
+
+    so one LJ grid is tabulated per distinct guest sigma. Distances are taken in 4D with the
+    guest w above the host, and the same cutoffs as nonbonded.nonbonded() are applied. Values
+    are clipped to +/- max_value so that the grid stays finite inside the host.
+
+    Parameters
+    ----------
+    host_conf: shape [num_host_atoms, 3] np.array
+        host coordinates
+
+    host_charges: shape [num_host_atoms] np.array
+        host charges, pre-multiplied by sqrt(ONE_4PI_EPS0)
+
+    host_lj: shape [num_host_atoms, 2] np.array
+        (sig, eps) of each host atom
+
+    guest_sigmas: shape [S] np.array
+        distinct guest sigmas to tabulate
+
+    origin, spacing, shape:
+        grid geometry, see pocket_bounds()
+
+    cutoff: float
+        nonbonded cutoff
+
+    w: float
+        fourth dimension coordinate of the guest relative to the host
+
+    chunk_size: int
+        number of grid points evaluated at a time, bounds the memory to chunk_size*num_host_atoms.
+
+    Returns
+    -------
+    (np.array [nx, ny, nz], np.array [S, nx, ny, nz])
+        electrostatic and LJ grids
+
+    """
+    host_charges = np.asarray(host_charges)
+    host_sig = np.asarray(host_lj[:, 0])
+    sqrt_eps = np.sqrt(np.asarray(host_lj[:, 1]))
+    guest_sigmas = np.asarray(guest_sigmas)
+    host_conf = np.asarray(host_conf)
+
+    def point_fn(r):
+        dr = r - host_conf
+        d = np.sqrt(np.sum(dr*dr, axis=-1) + w*w)
+        d = np.where(d > 0, d, np.ones_like(d))
+
+        es = np.sum(np.where(d <= cutoff, host_charges/d, np.zeros_like(d)))
+
+        sig_ij = (np.expand_dims(guest_sigmas, 1) + np.expand_dims(host_sig, 0))/2 # [S, N]
+        sig2 = sig_ij/d
+        sig2 *= sig2
+        sig6 = sig2*sig2*sig2
+        lj = np.where(d < cutoff, 4*sqrt_eps*(sig6-1.0)*sig6, np.zeros_like(sig6))
+
+        return np.clip(es, -max_value, max_value), np.clip(np.sum(lj, axis=-1), -max_value, max_value)
+
+    points = grid_points(origin, spacing, shape).reshape(-1, 3)
+    es, lj = chunked_vmap(point_fn, (points,), chunk_size)
+
+    return onp.asarray(es).reshape(shape), onp.asarray(lj).T.reshape((-1,) + tuple(shape))
+
+
+def _interpolation_weights(t, order):
+    # weights of the neighbouring grid points at fractional offset t, see interpolate()
+    if order == 1:
+        return np.stack([1 - t, t], axis=-1), (0, 1)
+    elif order == 3:
+        # Catmull-Rom cubic convolution, interpolates the grid values exactly
+        t2 = t*t
+        t3 = t2*t
+        return np.stack([
+            (-t3 + 2*t2 - t)/2,
+            (3*t3 - 5*t2 + 2)/2,
+            (-3*t3 + 4*t2 + t)/2,
+            (t3 - t2)/2
+        ], axis=-1), (-1, 0, 1, 2)
+    else:
+        raise ValueError("Unsupported interpolation order: " + str(order))
+
+
+def interpolate(grids, grid_idxs, origin, spacing, x, order=1):
+    """
+    Interpolate grids[grid_idxs[i]] at x[i], trilinearly (order=1) or with tricubic
+    Catmull-Rom splines (order=3). Points outside the grid are clamped onto its faces,
+    so callers should check HostGrid.contains() first.
+
+    Parameters
+    ----------
+    grids: shape [G, nx, ny, nz] np.array
+        tabulated values
+
+    grid_idxs: shape [N] np.array
+        grid used for each point
+
+    origin: shape [3] np.array
+        coordinates of grids[:, 0, 0, 0]
+
+    spacing: float
+        grid spacing
+
+    x: shape [N, 3] np.array
+        coordinates
+
+    Returns
+    -------
+    np.array [N]
+        interpolated values
+
+    """
+    grids = np.asarray(grids)
+    shape = onp.array(grids.shape[1:])
+    u = (x - origin)/spacing
+    u = np.clip(u, 0, shape - 1)
+    base = np.clip(np.floor(u), 0, shape - 2)
+    t = u - base
+    base = base.astype(np.int32)
+
+    weights, offsets = _interpolation_weights(t, order) # [N, 3, K]
+
+    val = 0
+    for a, oa in enumerate(offsets):
+        ia = np.clip(base[:, 0] + oa, 0, shape[0] - 1)
+        for b, ob in enumerate(offsets):
+            ib = np.clip(base[:, 1] + ob, 0, shape[1] - 1)
+            for c, oc in enumerate(offsets):
+                ic = np.clip(base[:, 2] + oc, 0, shape[2] - 1)
+                wabc = weights[:, 0, a]*weights[:, 1, b]*weights[:, 2, c]
+                val = val + wabc*grids[grid_idxs, ia, ib, ic]
+
+    return val
+
+
+class HostGrid():
+
+    def __init__(self, origin, spacing, es_grid, lj_grids, guest_sigmas, w=0.0, order=1):
+        """
+        Precomputed electrostatic and LJ potentials of a rigid host, see tabulate_host_potentials().
+        The host-guest energy of a pose is interpolated from the grids in O(N_guest).
+
+        Parameters
+        ----------
+        order: int
+            1 for trilinear, 3 for tricubic interpolation.
+
+        """
+        self.origin = onp.asarray(origin, dtype=onp.float64)
+        self.spacing = float(spacing)
+        self.es_grid = onp.asarray(es_grid)
+        self.lj_grids = onp.asarray(lj_grids)
+        self.guest_sigmas = onp.asarray(guest_sigmas, dtype=onp.float64)
+        self.w = w
+        self.order = order
+
+    def sigma_idxs(self, guest_lj):
+        """
+        LJ grid of each guest atom. Every sigma must have been tabulated.
+        """
+        sig = onp.asarray(guest_lj)[:, 0]
+        idxs = onp.argmin(onp.abs(sig[:, None] - self.guest_sigmas[None, :]), axis=1)
+        assert onp.allclose(self.guest_sigmas[idxs], sig), "guest sigma was not tabulated"
+        return idxs.astype(onp.int32)
+
+    def contains(self, x):
+        """
+        Whether every point of x [N, 3] lies within the grid bounds, works on traced x.
+        """
+        hi = self.origin + self.spacing*(onp.array(self.es_grid.shape) - 1)
+        return np.all((x >= self.origin) & (x <= hi))
+
+    def energy(self, guest_conf, guest_charges, guest_lj, sigma_idxs=None):
+        """
+        Host-guest nonbonded energy of a guest pose, differentiable with respect to
+        guest_conf, guest_charges and the guest eps. Only valid for poses inside the
+        grid, see contains(), at the guest w the grid was tabulated at.
+
+        Parameters
+        ----------
+        guest_conf: shape [num_guest_atoms, 3] np.array
+            guest coordinates
+
+        guest_charges: shape [num_guest_atoms] np.array
+            guest charges, pre-multiplied by sqrt(ONE_4PI_EPS0)
+
+        guest_lj: shape [num_guest_atoms, 2] np.array
+            (sig, eps) of each guest atom
+
+        sigma_idxs: shape [num_guest_atoms] np.array
+            precomputed sigma_idxs(guest_lj), required when guest_lj is traced.
+
+        """
+        if sigma_idxs is None:
+            sigma_idxs = self.sigma_idxs(guest_lj)
+
+        x = guest_conf[:, :3]
+        phi = interpolate(
+            np.expand_dims(self.es_grid, 0),
+            onp.zeros(x.shape[0], dtype=onp.int32),
+            self.origin,
+            self.spacing,
+            x,
+            self.order
+        )
+        g = interpolate(self.lj_grids, sigma_idxs, self.origin, self.spacing, x, self.order)
+
+        return np.sum(guest_charges*phi) + np.sum(np.sqrt(guest_lj[:, 1])*g)
+
+    def save(self, path):
+        onp.savez(
+            path,
+            origin=self.origin,
+            spacing=self.spacing,
+            es_grid=self.es_grid,
+            lj_grids=self.lj_grids,
+            guest_sigmas=self.guest_sigmas,
+            w=self.w
+        )
+
+    @staticmethod
+    def load(path, order=1):
+        data = onp.load(path)
+        return HostGrid(
+            data['origin'],
+            float(data['spacing']),
+            data['es_grid'],
+            data['lj_grids'],
+            data['guest_sigmas'],
+            float(data['w']),
+            order
+        )
+
+
+def host_grid_cache_key(host_pdb_path, ff_hash, spacing, origin, shape, guest_sigmas, cutoff, w=0.0, max_value=1e4):
+    """
+    Key that identifies a host grid: the contents of the host PDB file, a hash of the
+    forcefield (eg. of serialize_handlers()) and the grid settings.
+    """
+    h = hashlib.sha256()
+    with open(host_pdb_path, 'rb') as fh:
+        h.update(fh.read())
+    h.update(str(ff_hash).encode())
+    settings = (float(spacing), tuple(onp.round(onp.asarray(origin, dtype=onp.float64), 8).tolist()), tuple(shape),
+        tuple(onp.round(onp.sort(onp.asarray(guest_sigmas, dtype=onp.float64)), 8).tolist()), float(cutoff), float(w),
+        float(max_value))
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+
+def load_or_build_host_grid(
+    cache_dir,
+    host_pdb_path,
+    ff_hash,
+    host_conf,
+    host_charges,
+    host_lj,
+    guest_sigmas,
+    origin,
+    spacing,
+    shape,
+    cutoff,
+    w=0.0,
+    order=1,
+    max_value=1e4,
+    **kwargs):
+    """
+    Build a HostGrid, or load it from cache_dir if a grid with the same key exists, see
+    host_grid_cache_key(). Extra kwargs are passed to tabulate_host_potentials().
+    """
+    guest_sigmas = onp.unique(onp.asarray(guest_sigmas, dtype=onp.float64))
+    key = host_grid_cache_key(host_pdb_path, ff_hash, spacing, origin, shape, guest_sigmas, cutoff, w, max_value)
+    path = os.path.join(cache_dir, "host_grid_"+key+".npz")
+
+    if os.path.exists(path):
+        return HostGrid.load(path, order)
+
+    es_grid, lj_grids = tabulate_host_potentials(
+        host_conf,
+        host_charges,
+        host_lj,
+        guest_sigmas,
+        origin,
+        spacing,
+        shape,
+        cutoff,
+        w=w,
+        max_value=max_value,
+        **kwargs
+    )
+    grid = HostGrid(origin, spacing, es_grid, lj_grids, guest_sigmas, w, order)
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    grid.save(path)
+
+    return grid
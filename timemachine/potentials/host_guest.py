@@ -0,0 +1,229 @@
+import numpy as onp
+import jax.numpy as np
+from jax import lax
+
+from timemachine.potentials.jax_utils import delta_r, safe_norm, convert_to_4d
+from timemachine.potentials.nonbonded import nonbonded, nonbonded_pairs, lennard_jones, simple_energy
+from timemachine.potentials.nonbonded import lennard_jones_kernel, coulomb_kernel, _switch
+
+
+class HostGuestNonbonded():
+
+    def __init__(
+        self,
+        host_conf,
+        charge_params,
+        lj_params,
+        exclusion_idxs,
+        charge_scales,
+        lj_scales,
+        cutoff,
+        lambda_plane_idxs,
+        lambda_offset_idxs,
+        num_host_atoms,
+        box=None,
+        host_grid=None,
+        switch_distance=None):
+        """
+        nonbonded.nonbonded() of a frozen host and a moving guest, eg. for docking and pose
+        ranking. The host conformation is fixed once here, so only the host-guest and
+        guest-guest pairs and the exclusions that touch the guest are evaluated per pose,
+        in O(N_host*N_guest). The host-host energy is evaluated once per lambda and cached.
+
+        The atoms are laid out as in setup_system.create_system(), host first followed by
+        the guest.
+
+        Parameters
+        ----------
+        host_conf: shape [num_host_atoms, 3] np.array
+            frozen host coordinates
+
+        num_host_atoms: int
+            number of host atoms, the remaining atoms belong to the guest.
+
+        host_grid: host_grid.HostGrid
+            if not None, the host-guest pairs are interpolated from the grid in O(N_guest)
+            rather than summed explicitly. The grid is tabulated at a fixed guest w, eg. 0 for
+            lamb=0 with zero lambda_plane_idxs, and is only valid there, so the host and the
+            guest must each share a single lambda_plane_idx and lambda_offset_idx. Poses with
+            guest atoms outside the grid fall back to the explicit sum.
+
+        switch_distance: float or None
+            if not None, the energies are switched off between switch_distance and the cutoff,
+            see nonbonded.nonbonded(). The host grid is tabulated without switching, so the
+            two cannot be combined.
+
+        See nonbonded.nonbonded() for the other parameters, which cover both host and guest.
+
+        """
+        N_H = num_host_atoms
+        assert host_conf.shape[0] == N_H
+
+        charge_params = onp.asarray(charge_params)
+        lj_params = onp.asarray(lj_params)
+        exclusion_idxs = onp.asarray(exclusion_idxs, dtype=onp.int32).reshape(-1, 2)
+        charge_scales = onp.asarray(charge_scales)
+        lj_scales = onp.asarray(lj_scales)
+        lambda_plane_idxs = onp.asarray(lambda_plane_idxs)
+        lambda_offset_idxs = onp.asarray(lambda_offset_idxs)
+
+        self.num_host_atoms = N_H
+        self.host_conf = onp.asarray(host_conf)
+        self.cutoff = cutoff
+        self.box = box
+        self.switch_distance = switch_distance
+
+        # parameter tables
+        self.host_charges = charge_params[:N_H]
+        self.guest_charges = charge_params[N_H:]
+        self.host_lj = lj_params[:N_H]
+        self.guest_lj = lj_params[N_H:]
+        self.charge_params = charge_params
+        self.lj_params = lj_params
+
+        self.host_plane_idxs = lambda_plane_idxs[:N_H]
+        self.host_offset_idxs = lambda_offset_idxs[:N_H]
+        self.guest_plane_idxs = lambda_plane_idxs[N_H:]
+        self.guest_offset_idxs = lambda_offset_idxs[N_H:]
+
+        # host-host exclusions only enter the cached host energy
+        is_host = onp.all(exclusion_idxs < N_H, axis=1)
+        self.host_exclusion_idxs = exclusion_idxs[is_host]
+        self.host_charge_scales = charge_scales[is_host]
+        self.host_lj_scales = lj_scales[is_host]
+        self.guest_exclusion_idxs = exclusion_idxs[~is_host]
+        self.guest_charge_scales = charge_scales[~is_host]
+        self.guest_lj_scales = lj_scales[~is_host]
+
+        # pairwise combining rules of every guest-host pair, [N_guest, N_host]
+        self.qij = onp.outer(self.guest_charges, self.host_charges)
+        self.sig_ij = (onp.expand_dims(self.guest_lj[:, 0], 1) + onp.expand_dims(self.host_lj[:, 0], 0))/2
+        self.eps_ij = onp.sqrt(onp.expand_dims(self.guest_lj[:, 1], 1) * onp.expand_dims(self.host_lj[:, 1], 0))
+
+        self.host_grid = host_grid
+        if host_grid is not None:
+            assert switch_distance is None, "host grids are tabulated without switching"
+            self.guest_sigma_idxs = host_grid.sigma_idxs(self.guest_lj)
+            for idxs in [self.host_plane_idxs, self.host_offset_idxs, self.guest_plane_idxs, self.guest_offset_idxs]:
+                assert len(onp.unique(idxs)) <= 1, "the host and the guest must each have a single w to use a grid"
+            # w of the guest relative to the host is grid_w_plane + lamb*grid_w_offset
+            self.grid_w_plane = 0.0
+            if self.guest_plane_idxs[0] != self.host_plane_idxs[0]:
+                self.grid_w_plane = cutoff*(self.guest_plane_idxs[0] - self.host_plane_idxs[0])
+            self.grid_w_offset = float(self.guest_offset_idxs[0] - self.host_offset_idxs[0])
+            self.check_grid_w(0.0 if self.grid_w_offset == 0 else None)
+
+        self._host_energy_cache = {}
+
+    def host_energy(self, lamb):
+        """
+        Host-host energy at lamb, computed once per value of lambda.
+        """
+        key = float(lamb)
+        if key not in self._host_energy_cache:
+            self._host_energy_cache[key] = nonbonded(
+                self.host_conf,
+                lamb,
+                self.host_charges,
+                self.host_lj,
+                self.host_exclusion_idxs,
+                self.host_charge_scales,
+                self.host_lj_scales,
+                self.cutoff,
+                self.host_plane_idxs,
+                self.host_offset_idxs,
+                box=self.box,
+                switch_distance=self.switch_distance
+            )
+        return self._host_energy_cache[key]
+
+    def check_grid_w(self, lamb):
+        """
+        Raise if the guest w at lamb differs from the w the host grid was tabulated at. lamb
+        must be concrete when the guest and host have different lambda_offset_idxs, since the
+        grid has no lambda dependence. lamb=None skips the check.
+        """
+        if lamb is None:
+            return
+        if self.grid_w_offset != 0:
+            lamb = float(lamb)
+        else:
+            lamb = 0.0
+        w = self.grid_w_plane + lamb*self.grid_w_offset
+        if not onp.isclose(abs(w), abs(self.host_grid.w)):
+            raise ValueError("Guest w " + str(w) + " does not match the host grid w " + str(self.host_grid.w))
+
+    def _grid_energy(self, operand):
+        guest_conf, _, _ = operand
+        return self.host_grid.energy(guest_conf, self.guest_charges, self.guest_lj, self.guest_sigma_idxs)
+
+    def _explicit_energy(self, operand):
+        _, host_4d, guest_4d = operand
+        dr = delta_r(np.expand_dims(guest_4d, 1), np.expand_dims(host_4d, 0), self.box)
+        dij = safe_norm(dr)
+        lj_keep = dij < self.cutoff
+        es_keep = dij <= self.cutoff
+
+        sw = _switch(dr, self.cutoff, self.switch_distance)
+
+        nrg = np.sum(lennard_jones_kernel(dr, self.sig_ij, self.eps_ij, lj_keep)*sw)
+        nrg += np.sum(coulomb_kernel(dr, self.qij, es_keep)*sw)
+        return nrg
+
+    def interaction_energy(self, guest_conf, lamb):
+        """
+        Host-guest and guest-guest energy of a guest pose, including the exclusions that
+        involve the guest. This is differentiable with respect to guest_conf and lamb.
+
+        Parameters
+        ----------
+        guest_conf: shape [num_guest_atoms, 3] np.array
+            guest coordinates
+
+        lamb: float
+            lambda
+
+        """
+        cutoff = self.cutoff
+        box = self.box
+
+        host_4d = convert_to_4d(self.host_conf, lamb, self.host_plane_idxs, self.host_offset_idxs, cutoff)
+        guest_4d = convert_to_4d(guest_conf, lamb, self.guest_plane_idxs, self.guest_offset_idxs, cutoff)
+
+        # host-guest, every pair is visited once
+        operand = (guest_conf, host_4d, guest_4d)
+        if self.host_grid is not None:
+            self.check_grid_w(lamb)
+            # the grid clamps atoms outside its bounds onto its faces
+            nrg = lax.cond(self.host_grid.contains(guest_conf[:, :3]), self._grid_energy, self._explicit_energy, operand)
+        else:
+            nrg = self._explicit_energy(operand)
+
+        # guest-guest
+        no_exclusions = onp.zeros((0, 2), dtype=onp.int32)
+        nrg += lennard_jones(guest_4d, self.guest_lj, cutoff, box=box, switch_distance=self.switch_distance)
+        nrg += simple_energy(guest_4d, self.guest_charges, no_exclusions, onp.zeros(0), cutoff, box=box,
+            switch_distance=self.switch_distance)
+
+        # exclusions with at least one guest atom
+        conf_4d = np.concatenate([host_4d, guest_4d])
+        nrg -= nonbonded_pairs(
+            conf_4d,
+            self.charge_params,
+            self.lj_params,
+            self.guest_exclusion_idxs,
+            self.guest_charge_scales,
+            self.guest_lj_scales,
+            cutoff,
+            box,
+            switch_distance=self.switch_distance
+        )
+
+        return nrg
+
+    def energy(self, guest_conf, lamb):
+        """
+        Total energy of the host and guest, identical to nonbonded.nonbonded() of the
+        combined system. lamb must be a concrete value since the host energy is cached.
+        """
+        return self.host_energy(lamb) + self.interaction_energy(guest_conf, lamb)
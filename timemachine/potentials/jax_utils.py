@@ -31,44 +31,78 @@ def rescale_coordinates(
 
 
 def delta_r(ri, rj, box=None):
+    """
+    Compute ri - rj, optionally under the minimum image convention.
+
+    Parameters
+    ----------
+    ri, rj: np.array [..., D]
+        coordinates, D can be either 3 or 4. The fourth (alchemical) dimension
+        is never wrapped.
+
+    box: shape [3, 3] np.array
+        periodic box vectors in the reduced form used by OpenMM, ie. box[0] = (ax, 0, 0),
+        box[1] = (bx, by, 0), box[2] = (cx, cy, cz), with ax >= 2|bx|, ax >= 2|cx| and by >= 2|cy|.
+        The cutoff must be less than half of the smallest box width.
+
+    """
     diff = ri - rj # this can be either N,N,3 or B,3
     dims = ri.shape[-1]
 
-    # assert box is not None
-
     # box is None for harmonic bonds, not None for nonbonded terms
     if box is not None:
-        for d in range(dims):
+        box_dims = box.shape[0]
+        # pad the box vectors with zeros in the extra dimensions
+        if dims > box_dims:
+            box = np.concatenate([box, np.zeros((box_dims, dims - box_dims), dtype=box.dtype)], axis=-1)
+        # triclinic boxes in reduced form must be wrapped in the order c, b, a
+        for d in reversed(range(box_dims)):
             diff -= box[d]*np.floor(np.expand_dims(diff[...,d], axis=-1)/box[d][d]+0.5)
 
     return diff
 
+def safe_norm(dxdydz):
+    """
+    Euclidean norm over the last axis whose derivative is zero (rather than nan) at the origin.
+    This lets callers mask out self-interactions without nans leaking into the gradients.
+    """
+    d2ij = np.sum(dxdydz*dxdydz, axis=-1)
+    d2ij = np.maximum(d2ij, np.finfo(d2ij.dtype).tiny)
+    return np.sqrt(d2ij)
+
+def group_delta_r(ri, rj, box=None, gij=None):
+    """
+    Compute ri - rj as in delta_r(), where pairs with gij True have every
+    dimension past the third zeroed so that their norm is the 3D distance.
+    """
+    deltas = delta_r(ri, rj, box)
+    if gij is not None and deltas.shape[-1] > 3:
+        dims = np.arange(deltas.shape[-1])
+        deltas = np.where(np.expand_dims(gij, -1) & (dims >= 3), np.zeros_like(deltas), deltas)
+    return deltas
+
 def distance(ri, rj, box=None, gij=None):
-    assert box is None
-    if gij is not None:
+    """
+    Compute the distance between ri and rj.
 
+    Parameters
+    ----------
+    ri, rj: np.array [..., D]
+        coordinates, D can be either 3 or 4.
 
+    box: shape [3, 3] np.array or None
+        periodic box vectors, if not None then the minimum image convention is used, see delta_r()
 
-        deltas_4d = np.power(ri - rj, 2)   
-        # print(deltas_4d.shape)
-        deltas_3d = deltas_4d[..., :3]
-        # print(deltas_3d.shape)
-        dij_4d = np.sqrt(np.sum(deltas_4d, axis=-1))
-        dij_3d = np.sqrt(np.sum(deltas_3d, axis=-1))
+    gij: np.array [...] of bool or None
+        if not None, then pairs where gij is True use only the first three dimensions.
 
-        # print("shapes", gij.shape, dij_3d.shape, dij_4d.shape)
+    """
+    deltas = delta_r(ri, rj, box)
+    if gij is not None:
+        dij_4d = safe_norm(deltas)
+        dij_3d = safe_norm(deltas[..., :3])
         dij = np.where(gij, dij_3d, dij_4d)
     else:
-        deltas = np.power(ri - rj, 2)
-        dij = np.sqrt(np.sum(deltas, axis=-1))
-
-    # print(dij)
+        dij = safe_norm(deltas)
 
     return dij
-
-# def distance(ri, rj, box=None):
-#     dxdydz = np.power(delta_r(ri, rj, box), 2)
-#     # np.linalg.norm nans but this doesn't
-#     dij = np.sqrt(np.sum(dxdydz, axis=-1))
-#     return dij
-
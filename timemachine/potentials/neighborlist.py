@@ -0,0 +1,416 @@
+import itertools
+
+import numpy as onp
+import jax
+import jax.numpy as np
+from jax import lax
+
+from timemachine.potentials.jax_utils import delta_r
+
+
+def box_widths(box):
+    """
+    Perpendicular distance between opposite faces of a periodic box.
+    """
+    box = onp.asarray(box)
+    volume = onp.abs(onp.linalg.det(box))
+    widths = []
+    for d in range(3):
+        u, v = box[(d+1) % 3], box[(d+2) % 3]
+        widths.append(volume/onp.linalg.norm(onp.cross(u, v)))
+    return onp.array(widths)
+
+
+def cell_offsets(grid_shape, periodic):
+    """
+    Offsets of the cells that must be searched around each cell. In periodic
+    systems dimensions with fewer than three cells are searched once per cell
+    to avoid visiting the same image twice.
+    """
+    dim_offsets = []
+    for g in grid_shape:
+        if periodic and g < 3:
+            dim_offsets.append(list(range(g)))
+        else:
+            dim_offsets.append([-1, 0, 1])
+    return onp.array(list(itertools.product(*dim_offsets)), dtype=onp.int32)
+
+
+def cell_grid(conf, cell_size, box=None):
+    """
+    Compute a cell grid that spans a conformation. This is done on the host
+    since the grid dimensions determine array shapes.
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates, only the first three dimensions are used.
+
+    cell_size: float
+        minimum width of each cell, typically the cutoff.
+
+    box: shape [3, 3] np.array or None
+        periodic box vectors, if not None then the grid tiles the box.
+
+    Returns
+    -------
+    (np.array [3], tuple of int)
+        origin of the grid and the number of cells along each dimension
+
+    Note: in non-periodic systems cells on the boundary are extended to infinity
+    so atoms that drift outside of the grid are still assigned a valid cell.
+
+    """
+    if box is not None:
+        grid_shape = onp.maximum(onp.floor(box_widths(box)/cell_size), 1).astype(onp.int32)
+        return onp.zeros(3), tuple(int(g) for g in grid_shape)
+
+    x = onp.asarray(conf)[:, :3]
+    origin = onp.amin(x, axis=0)
+    extent = onp.amax(x, axis=0) - origin
+    grid_shape = onp.maximum(onp.floor(extent/cell_size), 1).astype(onp.int32)
+    return origin, tuple(int(g) for g in grid_shape)
+
+
+def cell_list(conf, origin, cell_size, grid_shape, cell_capacity, box=None):
+    """
+    Bin atoms into a fixed capacity cell list.
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates, only the first three dimensions are used.
+
+    origin: shape [3] np.array
+        origin of the grid.
+
+    cell_size: float
+        width of each cell.
+
+    grid_shape: tuple of int
+        number of cells along each dimension.
+
+    cell_capacity: int
+        maximum number of atoms per cell.
+
+    box: shape [3, 3] np.array or None
+        periodic box vectors, if not None then atoms are binned by their
+        wrapped fractional coordinates and origin and cell_size are ignored.
+
+    Returns
+    -------
+    (np.array [num_atoms, 3], np.array [num_cells, cell_capacity], int)
+        cell coordinates of each atom, atoms in each cell padded with num_atoms,
+        and the occupancy of the most crowded cell.
+
+    """
+    N = conf.shape[0]
+    x = conf[:, :3]
+    grid_shape = onp.array(grid_shape, dtype=onp.int32)
+    n_cells = int(onp.prod(grid_shape))
+    strides = onp.array([grid_shape[1]*grid_shape[2], grid_shape[2], 1], dtype=onp.int32)
+
+    if box is not None:
+        frac = np.matmul(x, np.linalg.inv(box))
+        frac = frac - np.floor(frac)
+        cell_coords = np.floor(frac*grid_shape).astype(np.int32)
+    else:
+        cell_coords = np.floor((x - origin)/cell_size).astype(np.int32)
+    cell_coords = np.clip(cell_coords, 0, grid_shape - 1)
+    cell_ids = np.sum(cell_coords*strides, axis=-1)
+
+    perm = np.argsort(cell_ids)
+    sorted_ids = cell_ids[perm]
+    all_ids = np.arange(n_cells)
+    starts = np.searchsorted(sorted_ids, all_ids, side='left')
+    counts = np.searchsorted(sorted_ids, all_ids, side='right') - starts
+
+    slots = np.arange(cell_capacity)
+    slot_idxs = np.minimum(np.expand_dims(starts, 1) + slots, N - 1)
+    cell_atoms = np.where(np.expand_dims(slots, 0) < np.expand_dims(counts, 1), perm[slot_idxs], N)
+
+    return cell_coords, cell_atoms, np.amax(counts)
+
+
+def neighbor_list(
+    conf,
+    cutoff,
+    origin,
+    cell_size,
+    grid_shape,
+    cell_capacity,
+    max_neighbors,
+    block_size=256,
+    box=None):
+    """
+    Build a half neighbor list of every pair (i, j > i) whose 3D distance is within
+    the cutoff. All array shapes are fixed by the static arguments so this can be jitted,
+    and candidate pairs are enumerated in blocks of atoms to bound peak memory.
+
+    Since the 4D distance of the alchemical coordinates is never smaller than the 3D
+    distance, a list built on the 3D coordinates is a superset of the interacting
+    pairs at every lambda.
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates, only the first three dimensions are used.
+
+    cutoff: float
+        pairs further apart than this are omitted.
+
+    origin, cell_size, grid_shape:
+        cell grid, see cell_grid()
+
+    cell_capacity: int
+        maximum number of atoms per cell.
+
+    max_neighbors: int
+        maximum number of neighbors (j > i) stored per atom.
+
+    block_size: int
+        number of atoms whose candidates are enumerated at once.
+
+    box: shape [3, 3] np.array or None
+        periodic box vectors, if not None then cells are wrapped and distances
+        use the minimum image convention. See jax_utils.delta_r()
+
+    Returns
+    -------
+    (np.array [num_atoms, max_neighbors], int, int)
+        neighbor idxs padded with num_atoms, the largest number of neighbors of any atom,
+        and the occupancy of the most crowded cell. The list is only valid if these fit
+        within max_neighbors and cell_capacity respectively.
+
+    """
+    N = conf.shape[0]
+    x = conf[:, :3]
+    grid_shape_arr = onp.array(grid_shape, dtype=onp.int32)
+    strides = onp.array([grid_shape_arr[1]*grid_shape_arr[2], grid_shape_arr[2], 1], dtype=onp.int32)
+
+    cell_coords, cell_atoms, max_occupancy = cell_list(conf, origin, cell_size, grid_shape, cell_capacity, box)
+    offsets = cell_offsets(grid_shape, box is not None)
+
+    n_blocks = (N + block_size - 1)//block_size
+    # padded atoms are assigned the sentinel idx N
+    x_pad = np.concatenate([x, np.zeros((1, 3), dtype=x.dtype)])
+    cell_coords_pad = np.concatenate([cell_coords, np.zeros((1, 3), dtype=cell_coords.dtype)])
+    block_idxs = np.minimum(np.arange(n_blocks*block_size), N).reshape(n_blocks, block_size)
+
+    cutoff2 = cutoff*cutoff
+
+    def block_fn(atom_idxs):
+        ci = cell_coords_pad[atom_idxs] # [B, 3]
+        nbr_cells = np.expand_dims(ci, 1) + offsets # [B, 27, 3]
+        if box is not None:
+            nbr_cells = np.mod(nbr_cells, grid_shape_arr)
+        valid_cells = np.all((nbr_cells >= 0) & (nbr_cells < grid_shape_arr), axis=-1)
+        nbr_ids = np.where(valid_cells, np.sum(nbr_cells*strides, axis=-1), 0)
+        candidates = np.where(np.expand_dims(valid_cells, -1), cell_atoms[nbr_ids], N)
+        candidates = candidates.reshape(block_size, -1) # [B, 27*C]
+
+        xi = np.expand_dims(x_pad[atom_idxs], 1)
+        xj = x_pad[candidates]
+        d2ij = np.sum(np.power(delta_r(xi, xj, box), 2), axis=-1)
+
+        i_idxs = np.expand_dims(atom_idxs, 1)
+        keep = (candidates < N) & (candidates > i_idxs) & (i_idxs < N) & (d2ij <= cutoff2)
+        num_kept = np.sum(keep, axis=-1)
+
+        # move the kept candidates to the front and truncate
+        order = np.argsort(np.logical_not(keep), axis=-1)[:, :max_neighbors]
+        nbrs = np.take_along_axis(candidates, order, axis=-1)
+        nbrs = np.where(np.take_along_axis(keep, order, axis=-1), nbrs, N)
+
+        return nbrs, num_kept
+
+    nbrs, num_kept = lax.map(block_fn, block_idxs)
+    nbrs = nbrs.reshape(-1, max_neighbors)[:N]
+
+    return nbrs.astype(np.int32), np.amax(num_kept), max_occupancy
+
+
+_neighbor_list_jit = jax.jit(neighbor_list, static_argnums=(4, 5, 6, 7))
+
+
+def build_neighbor_list(conf, cutoff, max_neighbors=None, cell_capacity=None, padding=1.2, block_size=256, box=None):
+    """
+    Convenience function that sizes the cell grid and capacities from the current
+    conformation and returns a neighbor list, see neighbor_list().
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates, only the first three dimensions are used.
+
+    cutoff: float
+        pairs further apart than this are omitted.
+
+    max_neighbors: int or None
+        capacity of the list, if None then this is estimated from conf and grown by padding.
+
+    cell_capacity: int or None
+        capacity of each cell, if None then this is estimated from conf and grown by padding.
+
+    padding: float
+        multiplicative headroom used when estimating capacities.
+
+    block_size: int
+        number of atoms whose candidates are enumerated at once.
+
+    box: shape [3, 3] np.array or None
+        periodic box vectors, if not None then the cutoff must be less than half
+        of the smallest box width.
+
+    Returns
+    -------
+    np.array [num_atoms, max_neighbors]
+        neighbor idxs padded with num_atoms
+
+    """
+    assert cutoff is not None and cutoff > 0
+    conf = onp.asarray(conf)
+    if box is not None:
+        box = onp.asarray(box)
+        if onp.any(box_widths(box) < 2*cutoff):
+            raise ValueError("Box widths cannot be smaller than twice the cutoff.")
+
+    origin, grid_shape = cell_grid(conf, cutoff, box)
+    cell_size = cutoff
+
+    if cell_capacity is None:
+        _, _, occupancy = cell_list(conf, origin, cell_size, grid_shape, 1, box)
+        cell_capacity = int(onp.ceil(int(occupancy)*padding))
+
+    if max_neighbors is None:
+        _, num_neighbors, _ = _neighbor_list_jit(conf, cutoff, origin, cell_size, grid_shape, cell_capacity, 1, block_size, box)
+        max_neighbors = max(int(onp.ceil(int(num_neighbors)*padding)), 1)
+
+    nblist, num_neighbors, occupancy = _neighbor_list_jit(conf, cutoff, origin, cell_size, grid_shape, cell_capacity, max_neighbors, block_size, box)
+
+    if occupancy > cell_capacity:
+        raise ValueError("Cell capacity exceeded: " + str(int(occupancy)) + " > " + str(cell_capacity))
+    if num_neighbors > max_neighbors:
+        raise ValueError("Neighbor list capacity exceeded: " + str(int(num_neighbors)) + " > " + str(max_neighbors))
+
+    return nblist
+
+
+def gather_neighbors(conf, nblist):
+    """
+    Gather the coordinates of each atom's neighbors.
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates
+
+    nblist: shape [num_atoms, max_neighbors] np.array
+        neighbor idxs padded with num_atoms
+
+    Returns
+    -------
+    (np.array [num_atoms, 1, D], np.array [num_atoms, max_neighbors, D], np.array [num_atoms, max_neighbors])
+        coordinates of i, coordinates of j, and a mask of the valid pairs.
+
+    """
+    N = conf.shape[0]
+    mask = nblist < N
+    # padded entries point at atom 0 and must be masked out by the caller
+    j_idxs = np.where(mask, nblist, 0)
+    ri = np.expand_dims(conf, 1)
+    rj = conf[j_idxs]
+    return ri, rj, mask
+
+
+class VerletNeighborList():
+
+    def __init__(self, cutoff, skin, box=None, padding=1.2, block_size=256):
+        """
+        Neighbor list with a Verlet skin that is reused across integration steps.
+
+        The list is built with cutoff + skin and is rebuilt only once some atom has moved
+        by more than skin/2 since the last build, before which no pair can have come
+        within the cutoff without being listed. Energies evaluated with the list must still
+        apply the cutoff, which the nblist variants in nonbonded.py do. Use a switching
+        function (see nonbonded.switch_fn()) for energy conserving dynamics.
+
+        The list capacity is kept across rebuilds so jitted functions of the list are not
+        recompiled, and is only grown when it overflows.
+
+        Parameters
+        ----------
+        cutoff: float
+            interaction cutoff
+
+        skin: float
+            buffer added to the cutoff
+
+        box: shape [3, 3] np.array or None
+            periodic box vectors, displacements use the minimum image convention.
+
+        padding: float
+            multiplicative headroom used when sizing the capacities.
+
+        block_size: int
+            see neighbor_list()
+
+        """
+        assert skin >= 0
+        self.cutoff = cutoff
+        self.skin = skin
+        self.box = box
+        self.padding = padding
+        self.block_size = block_size
+
+        self.max_neighbors = None
+        self.nblist = None
+        self.x_ref = None
+        self.num_builds = 0
+
+    def build(self, conf):
+        """
+        Rebuild the list around conf.
+        """
+        conf = onp.asarray(conf)
+        try:
+            nblist = build_neighbor_list(
+                conf,
+                self.cutoff + self.skin,
+                max_neighbors=self.max_neighbors,
+                padding=self.padding,
+                block_size=self.block_size,
+                box=self.box
+            )
+        except ValueError as e:
+            if self.max_neighbors is None:
+                raise e
+            # the list overflowed, size it again from scratch
+            self.max_neighbors = None
+            return self.build(conf)
+
+        self.max_neighbors = nblist.shape[1]
+
+        self.nblist = nblist
+        self.x_ref = conf[:, :3]
+        self.num_builds += 1
+
+        return nblist
+
+    def max_displacement(self, conf):
+        """
+        Largest displacement of any atom since the last build.
+        """
+        dx = delta_r(onp.asarray(conf)[:, :3], self.x_ref, self.box)
+        return float(onp.amax(onp.linalg.norm(onp.asarray(dx), axis=-1)))
+
+    def needs_rebuild(self, conf):
+        return self.nblist is None or self.max_displacement(conf) > self.skin/2
+
+    def update(self, conf):
+        """
+        Return a neighbor list that is valid for conf, rebuilding only if necessary.
+        """
+        if self.needs_rebuild(conf):
+            return self.build(conf)
+        return self.nblist
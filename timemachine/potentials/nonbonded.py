@@ -1,13 +1,105 @@
 import numpy as onp
+import jax
 import jax.numpy as np
 from jax.scipy.special import erf, erfc
 
 from timemachine.constants import ONE_4PI_EPS0
-from timemachine.potentials.jax_utils import delta_r, distance, lambda_to_w, convert_to_4d
+from timemachine.potentials.jax_utils import delta_r, group_delta_r, distance, safe_norm, lambda_to_w, convert_to_4d
+from timemachine.potentials.neighborlist import gather_neighbors
+from timemachine.potentials.pme import pme_reciprocal_energy
 
 
-def switch_fn(dij, cutoff):
-    return np.power(np.cos((np.pi*np.power(dij, 8))/(2*cutoff)), 2)
+def switch_fn(dij, cutoff, switch_distance):
+    """
+    Smooth switching function that is one below switch_distance, zero beyond the cutoff, and
+    1 - 10x^3 + 15x^4 - 6x^5 with x = (dij - switch_distance)/(cutoff - switch_distance) in
+    between. Its first and second derivatives vanish at both ends, so switched energies and
+    forces go continuously to zero at the cutoff. This is the same polynomial as OpenMM's
+    switching function.
+    """
+    x = (dij - switch_distance)/(cutoff - switch_distance)
+    x = np.clip(x, 0.0, 1.0)
+    return 1 - x*x*x*(10 + x*(-15 + 6*x))
+
+
+def _switch(dr, cutoff, switch_distance):
+    # switching function of the displacements dr, or 1 if switching is disabled
+    if switch_distance is None:
+        return 1.0
+    assert cutoff is not None and switch_distance < cutoff
+    return switch_fn(safe_norm(dr), cutoff, switch_distance)
+
+
+def _masked_d2(dr, keep):
+    d2 = np.sum(dr*dr, axis=-1)
+    return np.where(keep, d2, np.ones_like(d2))
+
+
+@jax.custom_jvp
+def lennard_jones_kernel(dr, sig_ij, eps_ij, keep):
+    """
+    Pairwise LJ612 energies 4*eps*((sig/d)^12 - (sig/d)^6) from displacements dr [..., D].
+    Pairs where keep is False contribute zero. Derivatives are given in closed form so
+    that autodiff never traces through the masking, and the rule is itself differentiable
+    so higher order derivatives are available.
+    """
+    d2 = _masked_d2(dr, keep)
+    eps_ij = np.where(keep, eps_ij, np.zeros_like(eps_ij))
+    sig2 = sig_ij*sig_ij/d2
+    sig6 = sig2*sig2*sig2
+    return 4*eps_ij*(sig6-1.0)*sig6
+
+
+@lennard_jones_kernel.defjvp
+def _lennard_jones_kernel_jvp(primals, tangents):
+    dr, sig_ij, eps_ij, keep = primals
+    dr_dot, sig_dot, eps_dot, _ = tangents
+
+    d2 = _masked_d2(dr, keep)
+    eps_ij = np.where(keep, eps_ij, np.zeros_like(eps_ij))
+    inv_d2 = 1/d2
+    sig2 = sig_ij*sig_ij*inv_d2
+    sig6 = sig2*sig2*sig2
+
+    nrg = 4*eps_ij*(sig6-1.0)*sig6
+    dE_dsig6 = 4*eps_ij*(2*sig6-1.0)
+    # d(sig6)/d(d2) = -3*sig6/d2, d(sig6)/d(sig) = 6*sig^5/d^6
+    dE_dd2 = -3*dE_dsig6*sig6*inv_d2
+    dE_dsig = dE_dsig6*6*sig2*sig2*sig_ij*inv_d2
+    dE_deps = 4*(sig6-1.0)*sig6
+
+    nrg_dot = 2*dE_dd2*np.sum(dr*dr_dot, axis=-1) + dE_dsig*sig_dot + dE_deps*np.where(keep, eps_dot, np.zeros_like(eps_dot))
+
+    return nrg, nrg_dot
+
+
+@jax.custom_jvp
+def coulomb_kernel(dr, qij, keep):
+    """
+    Pairwise electrostatic energies qij/d from displacements dr [..., D], see lennard_jones_kernel().
+    """
+    d2 = _masked_d2(dr, keep)
+    qij = np.where(keep, qij, np.zeros_like(qij))
+    return qij/np.sqrt(d2)
+
+
+@coulomb_kernel.defjvp
+def _coulomb_kernel_jvp(primals, tangents):
+    dr, qij, keep = primals
+    dr_dot, q_dot, _ = tangents
+
+    d2 = _masked_d2(dr, keep)
+    inv_d = 1/np.sqrt(d2)
+    qij = np.where(keep, qij, np.zeros_like(qij))
+
+    nrg = qij*inv_d
+    # d(1/d)/d(d2) = -1/(2*d^3)
+    dE_dd2 = -qij*inv_d*inv_d*inv_d/2
+    dE_dq = np.where(keep, inv_d, np.zeros_like(inv_d))
+
+    nrg_dot = 2*dE_dd2*np.sum(dr*dr_dot, axis=-1) + dE_dq*q_dot
+
+    return nrg, nrg_dot
 
 
 def nonbonded(
@@ -20,15 +112,53 @@ def nonbonded(
     lj_scales,
     cutoff,
     lambda_plane_idxs,
-    lambda_offset_idxs):
+    lambda_offset_idxs,
+    box=None,
+    nblist=None,
+    rf_dielectric=None,
+    switch_distance=None,
+    precision=None):
+    """
+    If rf_dielectric is not None, then the electrostatics use a reaction field with
+    this dielectric beyond the cutoff, see reaction_field_energy(). Otherwise the
+    Coulomb interactions are truncated at the cutoff.
+
+    If switch_distance is not None, then the Lennard-Jones and truncated Coulomb
+    interactions are smoothly switched off between switch_distance and the cutoff,
+    see switch_fn().
+
+    If precision is not None, then each pair is evaluated in this precision and the
+    energy and du_dx are accumulated in 64 bit fixed point as in the CUDA kernels, see
+    fixed_point.nonbonded_energy(). The pairs are taken from nblist, which is built from
+    conf if None, see fixed_point.default_neighbor_list().
+    """
 
-    # assert box is None
+    if box is not None:
+        assert cutoff is not None
 
     conf_4d = convert_to_4d(conf, lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff)
 
-    lj = lennard_jones(conf_4d, lj_params, cutoff)
-    lj_exc = lennard_jones_exclusion(conf_4d, lj_params, exclusion_idxs, lj_scales, cutoff)
-    es = simple_energy(conf_4d, charge_params, exclusion_idxs, charge_scales, cutoff)
+    if precision is not None:
+        # imported here since fixed_point depends on this module
+        from timemachine.potentials import fixed_point
+        if nblist is None:
+            nblist = fixed_point.default_neighbor_list(conf, cutoff, box)
+        pair_idxs, pair_charge_scales, pair_lj_scales = fixed_point.neighbor_pairs(nblist, exclusion_idxs, charge_scales, lj_scales)
+        nrg = fixed_point.nonbonded_energy(
+            conf_4d, charge_params, lj_params, pair_idxs, pair_charge_scales, pair_lj_scales, cutoff, box, precision,
+            rf_dielectric=rf_dielectric, switch_distance=switch_distance)
+        if rf_dielectric is not None:
+            nrg = nrg + reaction_field_self_energy(charge_params, cutoff, rf_dielectric)
+        return nrg
+
+    # the same neighbor list is shared by the lennard jones and electrostatic terms, exclusions
+    # are enumerated explicitly and subject to the same cutoff.
+    lj = lennard_jones(conf_4d, lj_params, cutoff, nblist=nblist, box=box, switch_distance=switch_distance)
+    lj_exc = lennard_jones_exclusion(conf_4d, lj_params, exclusion_idxs, lj_scales, cutoff, box=box, switch_distance=switch_distance)
+    if rf_dielectric is not None:
+        es = reaction_field_energy(conf_4d, charge_params, exclusion_idxs, charge_scales, cutoff, rf_dielectric, nblist=nblist, box=box)
+    else:
+        es = simple_energy(conf_4d, charge_params, exclusion_idxs, charge_scales, cutoff, nblist=nblist, box=box, switch_distance=switch_distance)
 
     return lj - lj_exc + es
 
@@ -41,13 +171,21 @@ def nongroup_electrostatics(
     charge_scales,
     cutoff,
     lambda_plane_idxs,
-    lambda_offset_idxs):
+    lambda_offset_idxs,
+    box=None,
+    nblist=None,
+    rf_dielectric=None,
+    switch_distance=None):
 
-    # assert box is None
+    if box is not None:
+        assert cutoff is not None
 
     conf_4d = convert_to_4d(conf, lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff)
 
-    return simple_energy(conf_4d, charge_params, exclusion_idxs, charge_scales, cutoff)
+    if rf_dielectric is not None:
+        return reaction_field_energy(conf_4d, charge_params, exclusion_idxs, charge_scales, cutoff, rf_dielectric, nblist=nblist, box=box)
+
+    return simple_energy(conf_4d, charge_params, exclusion_idxs, charge_scales, cutoff, nblist=nblist, box=box, switch_distance=switch_distance)
 
 
 def group_lennard_jones(
@@ -59,19 +197,25 @@ def group_lennard_jones(
     cutoff,
     lambda_plane_idxs,
     lambda_offset_idxs,
-    lambda_group_idxs):
+    lambda_group_idxs,
+    box=None,
+    nblist=None,
+    switch_distance=None):
+
+    if box is not None:
+        assert cutoff is not None
 
     conf_4d = convert_to_4d(conf, lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff)
 
-    lj = lennard_jones(conf_4d, lj_params, cutoff, lambda_group_idxs)
-    lj_exc = lennard_jones_exclusion(conf_4d, lj_params, exclusion_idxs, lj_scales, cutoff, lambda_group_idxs)
+    lj = lennard_jones(conf_4d, lj_params, cutoff, lambda_group_idxs, nblist=nblist, box=box, switch_distance=switch_distance)
+    lj_exc = lennard_jones_exclusion(conf_4d, lj_params, exclusion_idxs, lj_scales, cutoff, lambda_group_idxs, box=box, switch_distance=switch_distance)
 
     return lj - lj_exc
 
 
-def lennard_jones(conf, lj_params, cutoff, groups=None):
+def lennard_jones(conf, lj_params, cutoff, groups=None, nblist=None, box=None, switch_distance=None):
     """
-    Implements a non-periodic LJ612 potential using the Lorentz−Berthelot combining
+    Implements a LJ612 potential using the Lorentz−Berthelot combining
     rules, where sig_ij = (sig_i + sig_j)/2 and eps_ij = sqrt(eps_i * eps_j).
 
     Parameters
@@ -82,9 +226,6 @@ def lennard_jones(conf, lj_params, cutoff, groups=None):
     params: shape [num_params,] np.array
         unique parameters
 
-    box: shape [3, 3] np.array
-        periodic boundary vectors, if not None
-
     param_idxs: shape [num_atoms, 2] np.array
         each tuple (sig, eps) is used as part of the combining rules
 
@@ -96,64 +237,84 @@ def lennard_jones(conf, lj_params, cutoff, groups=None):
     cutoff: float
         Whether or not we apply cutoffs to the system. Any interactions
         greater than cutoff is fully discarded.
+
+    groups: shape [num_atoms] np.array
+        bitmask of lambda groups, pairs that share a group interact using
+        their 3D distance.
+
+    nblist: shape [num_atoms, max_neighbors] np.array
+        if not None, only the pairs in this neighbor list are evaluated. See
+        neighborlist.neighbor_list()
+
+    box: shape [3, 3] np.array
+        periodic boundary vectors in reduced form, if not None then the minimum
+        image convention is used. See jax_utils.delta_r()
+
+    switch_distance: float
+        if not None, the energy is smoothly switched off between switch_distance and
+        cutoff, see switch_fn()
     
     """
-    box = None
-    assert box is None
+    if nblist is not None:
+        return lennard_jones_nblist(conf, lj_params, cutoff, nblist, groups, box, switch_distance)
 
     sig = lj_params[:, 0]
     eps = lj_params[:, 1]
 
-    sig_i = np.expand_dims(sig, 0)
-    sig_j = np.expand_dims(sig, 1)
-    sig_ij = (sig_i + sig_j)/2
-    sig_ij_raw = sig_ij
-
-    eps_i = np.expand_dims(eps, 0)
-    eps_j = np.expand_dims(eps, 1)
-
-    eps_ij = np.sqrt(eps_i * eps_j)
-
-    eps_ij_raw = eps_ij
+    sig_ij = (np.expand_dims(sig, 0) + np.expand_dims(sig, 1))/2
+    eps_ij = np.sqrt(np.expand_dims(eps, 0) * np.expand_dims(eps, 1))
 
     ri = np.expand_dims(conf, 0)
     rj = np.expand_dims(conf, 1)
-    gi = np.expand_dims(groups, axis=0)
-    gj = np.expand_dims(groups, axis=1)
-    gij = np.bitwise_and(gi, gj) > 0
+    if groups is not None:
+        gi = np.expand_dims(groups, axis=0)
+        gj = np.expand_dims(groups, axis=1)
+        gij = np.bitwise_and(gi, gj) > 0
+    else:
+        gij = None
 
-    # print(gij)
-    dij = distance(ri, rj, box, gij)
+    dr = group_delta_r(ri, rj, box, gij)
 
+    N = conf.shape[0]
+    keep = np.logical_not(np.eye(N, dtype=bool))
     if cutoff is not None:
-        eps_ij = np.where(dij < cutoff, eps_ij, np.zeros_like(eps_ij))
+        keep = keep & (safe_norm(dr) < cutoff)
 
-    N = conf.shape[0]
-    keep_mask = np.ones((N,N)) - np.eye(N)
+    eij = lennard_jones_kernel(dr, sig_ij, eps_ij, keep)*_switch(dr, cutoff, switch_distance)
+    return np.sum(eij/2)
 
-    # (ytz): this avoids a nan in the gradient in both jax and tensorflow
-    sig_ij = np.where(keep_mask, sig_ij, np.zeros_like(sig_ij))
-    eps_ij = np.where(keep_mask, eps_ij, np.zeros_like(eps_ij))
 
-    sig2 = sig_ij/dij
-    sig2 *= sig2
-    sig6 = sig2*sig2*sig2
+def lennard_jones_nblist(conf, lj_params, cutoff, nblist, groups=None, box=None, switch_distance=None):
+    """
+    Neighbor list variant of lennard_jones(). Each pair in the half list is
+    visited exactly once, so the energy is not divided by two.
 
-    eij = 4*eps_ij*(sig6-1.0)*sig6
+    """
+    assert cutoff is not None
 
-    # if cutoff is not None:
-        # sw = switch_fn(dij, cutoff)
-        # eij = eij*sw
+    sig = np.asarray(lj_params[:, 0])
+    eps = np.asarray(lj_params[:, 1])
 
-    eij = np.where(keep_mask, eij, np.zeros_like(eij))
-    return np.sum(eij/2)
+    ri, rj, mask = gather_neighbors(conf, nblist)
+    j_idxs = np.where(mask, nblist, 0)
 
+    sig_ij = (np.expand_dims(sig, 1) + sig[j_idxs])/2
+    eps_ij = np.sqrt(np.expand_dims(eps, 1) * eps[j_idxs])
 
-# now we compute the exclusions
-def lennard_jones_exclusion(conf, lj_params, exclusion_idxs, lj_scales, cutoff, groups=None):
+    if groups is not None:
+        groups = np.asarray(groups)
+        gij = np.bitwise_and(np.expand_dims(groups, 1), groups[j_idxs]) > 0
+    else:
+        gij = None
+
+    dr = group_delta_r(ri, rj, box, gij)
+    keep = mask & (safe_norm(dr) < cutoff)
 
-    box = None
-    assert box is None
+    return np.sum(lennard_jones_kernel(dr, sig_ij, eps_ij, keep)*_switch(dr, cutoff, switch_distance))
+
+
+# now we compute the exclusions
+def lennard_jones_exclusion(conf, lj_params, exclusion_idxs, lj_scales, cutoff, groups=None, box=None, switch_distance=None):
 
     assert exclusion_idxs.shape[1] == 2
     # assert exclusion_idxs.shape[0] == conf.shape[0]
@@ -164,95 +325,271 @@ def lennard_jones_exclusion(conf, lj_params, exclusion_idxs, lj_scales, cutoff,
     ri = conf[src_idxs]
     rj = conf[dst_idxs]
 
-    gi = groups[src_idxs]
-    gj = groups[dst_idxs]
-    gij = np.bitwise_and(gi, gj) > 0
-    dij = distance(ri, rj, box, gij)
+    if groups is not None:
+        gi = groups[src_idxs]
+        gj = groups[dst_idxs]
+        gij = np.bitwise_and(gi, gj) > 0
+    else:
+        gij = None
+    dr = group_delta_r(ri, rj, box, gij)
 
-    sig_params = lj_params[:, 0] 
-    sig_i = sig_params[src_idxs]
-    sig_j = sig_params[dst_idxs]
-    sig_ij = (sig_i + sig_j)/2
+    sig_params = lj_params[:, 0]
+    sig_ij = (sig_params[src_idxs] + sig_params[dst_idxs])/2
 
-    eps_params = lj_params[:, 1] 
-    eps_i = eps_params[src_idxs]
-    eps_j = eps_params[dst_idxs]
-    eps_ij = np.sqrt(eps_i * eps_j)
+    eps_params = lj_params[:, 1]
+    eps_ij = np.sqrt(eps_params[src_idxs] * eps_params[dst_idxs])
 
+    keep = src_idxs != dst_idxs
     if cutoff is not None:
-        eps_ij = np.where(dij < cutoff, eps_ij, np.zeros_like(eps_ij))
-
-    sig2 = sig_ij/dij
-    sig2 *= sig2
-    sig6 = sig2*sig2*sig2
+        keep = keep & (safe_norm(dr) < cutoff)
 
-    scale_ij = lj_scales
-    eij_exc = scale_ij*4*eps_ij*(sig6-1.0)*sig6
-
-    if cutoff is not None:
-        # sw = switch_fn(dij, cutoff)
-        # eij_exc = eij_exc*sw
-        eij_exc = np.where(dij > cutoff, np.zeros_like(eij_exc), eij_exc)
-        eij_exc = np.where(src_idxs == dst_idxs, np.zeros_like(eij_exc), eij_exc)
+    eij_exc = lj_scales*lennard_jones_kernel(dr, sig_ij, eps_ij, keep)*_switch(dr, cutoff, switch_distance)
 
     # the exclusion energy is not divided by two.
     return np.sum(eij_exc)
 
 
-def simple_energy(conf, charge_params, exclusion_idxs, charge_scales, cutoff):
+def simple_energy(conf, charge_params, exclusion_idxs, charge_scales, cutoff, nblist=None, box=None, switch_distance=None):
     """
     Numerically stable implementation of the pairwise term:
     
     eij = qi*qj/dij
 
+    If nblist is not None, then only the pairs in the neighbor list are
+    evaluated. See neighborlist.neighbor_list()
+
+    If box is not None, then the minimum image convention is used and cutoff
+    must be less than half the smallest box width.
+
+    If switch_distance is not None, then the energy is smoothly switched off
+    between switch_distance and cutoff, see switch_fn().
+
     """
 
-    box = None
     # charges = params[param_idxs]
     charges = charge_params
-    qi = np.expand_dims(charges, 0) # (1, N)
-    qj = np.expand_dims(charges, 1) # (N, 1)
-    qij = np.multiply(qi, qj)
-    ri = np.expand_dims(conf, 0)
-    rj = np.expand_dims(conf, 1)
 
-    assert box is None
+    if nblist is not None:
+        assert cutoff is not None
+        ri, rj, mask = gather_neighbors(conf, nblist)
+        j_idxs = np.where(mask, nblist, 0)
+        charges = np.asarray(charges)
+        qij = np.expand_dims(charges, 1) * charges[j_idxs]
+        dr = delta_r(ri, rj, box)
+        keep = mask & (safe_norm(dr) <= cutoff)
+        # every pair is visited once
+        eij_direct = np.sum(coulomb_kernel(dr, qij, keep)*_switch(dr, cutoff, switch_distance))
+    else:
+        qij = np.outer(charges, charges)
+        ri = np.expand_dims(conf, 0)
+        rj = np.expand_dims(conf, 1)
 
-    dij = distance(ri, rj, box)
+        dr = delta_r(ri, rj, box)
 
-    # (ytz): trick used to avoid nans in the diagonal due to the 1/dij term.
-    keep_mask = 1 - np.eye(conf.shape[0])
-    qij = np.where(keep_mask, qij, np.zeros_like(qij))
-    dij = np.where(keep_mask, dij, np.zeros_like(dij))
-    eij = np.where(keep_mask, qij/dij, np.zeros_like(dij)) # zero out diagonals
+        # the diagonal is masked out inside the kernel, which avoids nans from the 1/dij term.
+        keep = np.logical_not(np.eye(conf.shape[0], dtype=bool))
+
+        if cutoff is not None:
+            keep = keep & (safe_norm(dr) <= cutoff)
+
+        eij_direct = np.sum(coulomb_kernel(dr, qij, keep)*_switch(dr, cutoff, switch_distance)/2)
+
+    src_idxs = exclusion_idxs[:, 0]
+    dst_idxs = exclusion_idxs[:, 1]
+    dr = delta_r(conf[src_idxs], conf[dst_idxs], box)
 
-    # print(dij)
+    qij = charges[src_idxs]*charges[dst_idxs]
 
+    keep = src_idxs != dst_idxs
     if cutoff is not None:
-        # sw = switch_fn(dij, cutoff)
-        # eij = eij*sw
-        eij = np.where(dij > cutoff, np.zeros_like(eij), eij)
+        keep = keep & (safe_norm(dr) <= cutoff)
+
+    eij_exc = charge_scales*coulomb_kernel(dr, qij, keep)*_switch(dr, cutoff, switch_distance)
+
+    return eij_direct - np.sum(eij_exc)
+
+
+def reaction_field_constants(cutoff, rf_dielectric):
+    """
+    (k_rf, c_rf) of the reaction field pair energy qij*(1/dij + k_rf*dij^2 - c_rf), chosen so
+    that the energy vanishes at the cutoff. Same convention as OpenMM's CutoffNonPeriodic and
+    CutoffPeriodic methods.
+    """
+    k_rf = (rf_dielectric - 1)/((2*rf_dielectric + 1)*cutoff**3)
+    c_rf = 1/cutoff + k_rf*cutoff*cutoff
+    return k_rf, c_rf
+
+
+def _reaction_field_term(dr, qij, keep, k_rf, c_rf):
+    # qij*(k_rf*dij^2 - c_rf), the part of the pair energy that excluded pairs keep
+    d2 = _masked_d2(dr, keep)
+    qij = np.where(keep, qij, np.zeros_like(qij))
+    return qij*(k_rf*d2 - c_rf)
+
+
+def reaction_field_kernel(dr, qij, keep, k_rf, c_rf):
+    """
+    Pairwise reaction field energies from displacements dr [..., D], see coulomb_kernel().
+    """
+    return coulomb_kernel(dr, qij, keep) + _reaction_field_term(dr, qij, keep, k_rf, c_rf)
+
+
+def reaction_field_self_energy(charge_params, cutoff, rf_dielectric):
+    """
+    Interaction of each charge with its own reaction field, -c_rf/2*sum_i qi^2.
+    """
+    _, c_rf = reaction_field_constants(cutoff, rf_dielectric)
+    charges = np.asarray(charge_params)
+    return -c_rf*np.sum(charges*charges)/2
+
+
+def reaction_field_energy(conf, charge_params, exclusion_idxs, charge_scales, cutoff, rf_dielectric, nblist=None, box=None):
+    """
+    Reaction field variant of simple_energy(), where each pair within the cutoff contributes
+
+    eij = qi*qj*(1/dij + k_rf*dij^2 - c_rf)
+
+    see reaction_field_constants(). The pair energy goes continuously to zero at the cutoff.
+    As in GROMACS, excluded pairs within the cutoff keep their reaction field term
+    qi*qj*(k_rf*dij^2 - c_rf), so exclusions only subtract charge_scales times the Coulomb
+    term, and each charge interacts with its own reaction field, see
+    reaction_field_self_energy(). The distances are taken on the 4D coordinates so that
+    lambda decoupling works as usual.
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates, typically 4D.
+
+    charge_params: shape [num_atoms] np.array
+        charges, pre-multiplied by sqrt(ONE_4PI_EPS0)
+
+    cutoff: float
+        reaction field cutoff, required.
+
+    rf_dielectric: float
+        dielectric constant of the continuum beyond the cutoff.
+
+    nblist: shape [num_atoms, max_neighbors] np.array
+        if not None, only the pairs in this neighbor list are evaluated.
+
+    box: shape [3, 3] np.array
+        periodic boundary vectors, see jax_utils.delta_r()
+
+    """
+    assert cutoff is not None
+    k_rf, c_rf = reaction_field_constants(cutoff, rf_dielectric)
+
+    charges = np.asarray(charge_params)
+
+    if nblist is not None:
+        ri, rj, mask = gather_neighbors(conf, nblist)
+        j_idxs = np.where(mask, nblist, 0)
+        qij = np.expand_dims(charges, 1) * charges[j_idxs]
+        dr = delta_r(ri, rj, box)
+        keep = mask & (safe_norm(dr) <= cutoff)
+        eij_direct = np.sum(reaction_field_kernel(dr, qij, keep, k_rf, c_rf))
+    else:
+        qij = np.outer(charges, charges)
+        dr = delta_r(np.expand_dims(conf, 0), np.expand_dims(conf, 1), box)
+        keep = np.logical_not(np.eye(conf.shape[0], dtype=bool)) & (safe_norm(dr) <= cutoff)
+        eij_direct = np.sum(reaction_field_kernel(dr, qij, keep, k_rf, c_rf)/2)
 
     src_idxs = exclusion_idxs[:, 0]
     dst_idxs = exclusion_idxs[:, 1]
-    ri = conf[src_idxs]
-    rj = conf[dst_idxs]
-    dij = distance(ri, rj, box)
+    dr = delta_r(conf[src_idxs], conf[dst_idxs], box)
+    qij = charges[src_idxs]*charges[dst_idxs]
+    keep = (src_idxs != dst_idxs) & (safe_norm(dr) <= cutoff)
 
-    qi = charges[src_idxs]
-    qj = charges[dst_idxs]
-    qij = np.multiply(qi, qj)
+    eij_exc = charge_scales*coulomb_kernel(dr, qij, keep)
+
+    return eij_direct - np.sum(eij_exc) + reaction_field_self_energy(charges, cutoff, rf_dielectric)
 
-    scale_ij = charge_scales
-    eij_exc = scale_ij*qij/dij
 
+def nonbonded_pair_energies(dr, qij, sig_ij, eps_ij, charge_scales, lj_scales, keep, cutoff, rf_dielectric=None, switch_distance=None):
+    """
+    Per pair Lennard-Jones and electrostatic energies from displacements dr [num_pairs, D],
+    using the same kernels and cutoff conventions as lennard_jones() and simple_energy(),
+    or reaction_field_energy() if rf_dielectric is not None. As in nonbonded(), switching
+    applies to the Lennard-Jones and truncated Coulomb energies but not to the reaction
+    field, and a negative charge scale subtracts an exclusion, which keeps its reaction
+    field term. Each energy only depends on its own displacement, so the gradient with
+    respect to dr is the per pair force.
+    """
+    keep_lj = keep
+    keep_es = keep
     if cutoff is not None:
-        # sw = switch_fn(dij, cutoff)
-        # eij_exc = eij_exc*sw
-        eij_exc = np.where(dij > cutoff, np.zeros_like(eij_exc), eij_exc)
-        eij_exc = np.where(src_idxs == dst_idxs, np.zeros_like(eij_exc), eij_exc)
+        keep_lj = keep & (safe_norm(dr) < cutoff)
+        keep_es = keep & (safe_norm(dr) <= cutoff)
+
+    sw = _switch(dr, cutoff, switch_distance)
 
-    return np.sum(eij/2) - np.sum(eij_exc)
+    lj = lennard_jones_kernel(dr, sig_ij, eps_ij, keep_lj)*sw
+    if rf_dielectric is not None:
+        assert cutoff is not None
+        k_rf, c_rf = reaction_field_constants(cutoff, rf_dielectric)
+        rf = _reaction_field_term(dr, qij, keep_es, k_rf, c_rf)
+        es = charge_scales*coulomb_kernel(dr, qij, keep_es) + np.maximum(charge_scales, 0)*rf
+    else:
+        es = charge_scales*coulomb_kernel(dr, qij, keep_es)*sw
+
+    return es + lj_scales*lj
+
+
+def nonbonded_pairs(conf, charge_params, lj_params, pair_idxs, charge_scales, lj_scales, cutoff, box=None, rf_dielectric=None, switch_distance=None):
+    """
+    Lennard-Jones and electrostatic energy of an explicit list of pairs, using
+    the same functional form and cutoff conventions as lennard_jones() and
+    simple_energy(). Negative scales subtract a pair, so exclusions can be
+    folded into the same list.
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates, typically 4D.
+
+    charge_params: shape [num_atoms] np.array
+        charges, pre-multiplied by sqrt(ONE_4PI_EPS0)
+
+    lj_params: shape [num_atoms, 2] np.array
+        (sig, eps) of each atom
+
+    pair_idxs: shape [num_pairs, 2] np.array
+        each pair (i, j) is visited once
+
+    charge_scales, lj_scales: shape [num_pairs] np.array
+        scale of the electrostatic and Lennard-Jones energy of each pair
+
+    cutoff: float or None
+        pairs further apart than this are discarded
+
+    box: shape [3, 3] np.array
+        periodic boundary vectors, see jax_utils.delta_r()
+
+    rf_dielectric: float or None
+        if not None, the electrostatics use a reaction field as in nonbonded(), see
+        reaction_field_energy(). Negative charge scales then only subtract the Coulomb
+        term, and the self energy of the reaction field is not included.
+
+    switch_distance: float or None
+        if not None, the energies are switched off between switch_distance and the
+        cutoff as in nonbonded(), see switch_fn().
+
+    """
+    src_idxs = pair_idxs[:, 0]
+    dst_idxs = pair_idxs[:, 1]
+
+    dr = delta_r(conf[src_idxs], conf[dst_idxs], box)
+
+    charge_params = np.asarray(charge_params)
+    qij = charge_params[src_idxs]*charge_params[dst_idxs]
+
+    sig_ij = (lj_params[src_idxs, 0] + lj_params[dst_idxs, 0])/2
+    eps_ij = np.sqrt(lj_params[src_idxs, 1]*lj_params[dst_idxs, 1])
+
+    eij = nonbonded_pair_energies(dr, qij, sig_ij, eps_ij, charge_scales, lj_scales, src_idxs != dst_idxs, cutoff, rf_dielectric, switch_distance)
+
+    return np.sum(eij)
 
 
 def pairwise_energy(conf, box, charges, cutoff):
@@ -280,7 +617,7 @@ def pairwise_energy(conf, box, charges, cutoff):
 
     return eij
 
-def electrostatics(conf, params, box, param_idxs, scale_matrix, cutoff=None, alpha=None, kmax=None):
+def electrostatics(conf, params, box, param_idxs, scale_matrix, cutoff=None, alpha=None, kmax=None, method="ewald", pme_grid=None, pme_order=5):
     """
     Compute the electrostatic potential: sum_ij qi*qj/dij
 
@@ -312,6 +649,16 @@ def electrostatics(conf, params, box, param_idxs, scale_matrix, cutoff=None, alp
     kmax: int
         number of images by which we tile out reciprocal space.
 
+    method: str
+        "ewald" sums reciprocal space explicitly up to kmax, "pme" uses smooth
+        particle mesh Ewald on a grid of pme_grid points.
+
+    pme_grid: int or tuple of int
+        number of PME grid points along each box vector.
+
+    pme_order: int
+        B-spline interpolation order used by PME.
+
     """
     charges = params[param_idxs]
 
@@ -335,18 +682,17 @@ def electrostatics(conf, params, box, param_idxs, scale_matrix, cutoff=None, alp
         box_lengths = np.linalg.norm(box, axis=-1)
         assert cutoff is not None and cutoff >= 0.00
         assert alpha is not None
-        assert kmax is not None
 
         # this is an implicit assumption in the Ewald calculation. If it were any larger
         # then there may be more than N^2 number of interactions.
         if np.any(box_lengths < 2*cutoff):
             raise ValueError("Box lengths cannot be smaller than twice the cutoff.")
 
-        return ewald_energy(conf, box, charges, scale_matrix, cutoff, alpha, kmax)
+        return ewald_energy(conf, box, charges, scale_matrix, cutoff, alpha, kmax, method, pme_grid, pme_order)
 
     else:    
         # non periodic electrostatics is straightforward.
-        # note that we do not support reaction field approximations.
+        # reaction field electrostatics are available through reaction_field_energy().
         eij = scale_matrix*pairwise_energy(conf, box, charges, cutoff)
         nrg = ONE_4PI_EPS0*eij
         # onp.save("energy.npy", onp.asarray(nrg))
@@ -359,52 +705,59 @@ def self_energy(conf, charges, alpha):
     return np.sum(ONE_4PI_EPS0 * np.power(charges, 2) * alpha/np.sqrt(np.pi))
 
 
-def ewald_energy(conf, box, charges, scale_matrix, cutoff, alpha, kmax):
-    eij = pairwise_energy(conf, box, charges, cutoff)
+def ewald_energy(conf, box, charges, scale_matrix, cutoff, alpha, kmax, method="ewald", pme_grid=None, pme_order=5):
 
     assert cutoff is not None
 
+    qi = np.expand_dims(charges, 0) # (1, N)
+    qj = np.expand_dims(charges, 1) # (N, 1)
+    qij = np.multiply(qi, qj)
+    ri = np.expand_dims(conf, 0)
+    rj = np.expand_dims(conf, 1)
+    dij = distance(ri, rj, box)
+
+    keep_mask = 1 - np.eye(conf.shape[0])
+    eij = np.where(keep_mask, qij/dij, np.zeros_like(dij))
+
     # 1. Assume scale matrix is not used at all (no exceptions, no exclusions)
-    # 1a. Direct Space
-    eij_direct = eij * erfc(alpha*eij)
+    # 1a. Direct Space, scaled interactions are subtracted in full from the direct
+    # space term and only their erf part is removed from reciprocal space.
+    eij_direct = scale_matrix * eij * erfc(alpha*dij)
+    eij_direct = np.where(dij > cutoff, np.zeros_like(eij_direct), eij_direct)
     eij_direct = ONE_4PI_EPS0*np.sum(eij_direct)/2
 
     # 1b. Reciprocal Space
-    eij_recip = reciprocal_energy(conf, box, charges, alpha, kmax)
+    if method == "ewald":
+        assert kmax is not None
+        eij_recip = reciprocal_energy(conf, box, charges, alpha, kmax)
+    elif method == "pme":
+        assert pme_grid is not None
+        eij_recip = pme_reciprocal_energy(conf, box, charges, alpha, pme_grid, pme_order)
+    else:
+        raise ValueError("Unknown reciprocal space method: " + str(method))
 
     # 2. Remove over estimated scale matrix contribution scaled by erf
-    eij_offset = (1-scale_matrix) * eij
-    eij_offset *= erf(alpha*eij_offset)
+    eij_offset = (1-scale_matrix) * eij * erf(alpha*dij)
     eij_offset = ONE_4PI_EPS0*np.sum(eij_offset)/2
 
     return eij_direct + eij_recip - eij_offset - self_energy(conf, charges, alpha)
 
+
 def reciprocal_energy(conf, box, charges, alpha, kmax):
 
     assert kmax > 0
     assert box is not None
     assert alpha > 0
 
-    recipBoxSize = (2*np.pi)/np.diag(box)
-
-    mg = []
-    lowry = 0
-    lowrz = 1
-
-    numRx, numRy, numRz = kmax, kmax, kmax
-
-    for rx in range(numRx):
-        for ry in range(lowry, numRy):
-            for rz in range(lowrz, numRz):
-                mg.append([rx, ry, rz])
-                lowrz = 1 - numRz
-            lowry = 1 - numRy
-
-    mg = np.array(onp.array(mg))
+    # half space of k vectors, (rx, ry, rz) and (-rx, -ry, -rz) contribute equally
+    r = onp.arange(1 - kmax, kmax)
+    mg = onp.stack(onp.meshgrid(r, r, r, indexing='ij'), axis=-1).reshape(-1, 3)
+    half = (mg[:, 0] > 0) | ((mg[:, 0] == 0) & (mg[:, 1] > 0)) | ((mg[:, 0] == 0) & (mg[:, 1] == 0) & (mg[:, 2] > 0))
+    mg = mg[half]
 
-    # lattice vectors
-    ki = np.expand_dims(recipBoxSize, axis=0) * mg # [nk, 3]
-    ri = np.expand_dims(conf, axis=0) # [1, N, 3]
+    # reciprocal lattice vectors, supports triclinic boxes
+    ki = 2*np.pi*np.matmul(mg, np.transpose(np.linalg.inv(box))) # [nk, 3]
+    ri = np.expand_dims(conf[:, :3], axis=0) # [1, N, 3]
     rik = np.sum(np.multiply(ri, np.expand_dims(ki, axis=1)), axis=-1) # [nk, N]
     real = np.cos(rik)
     imag = np.sin(rik)
@@ -416,8 +769,6 @@ def reciprocal_energy(conf, box, charges, alpha, kmax):
     factorEwald = -1/(4*alpha*alpha)
     ak = np.exp(k2*factorEwald)/k2 # [nk]
     nrg = np.sum(ak * n2Sk)
-    # the following volume calculation assumes the reduced PBC convention consistent
-    # with that of OpenMM
-    recipCoeff = (ONE_4PI_EPS0*4*np.pi)/(box[0][0]*box[1][1]*box[2][2]) 
+    recipCoeff = (ONE_4PI_EPS0*4*np.pi)/np.abs(np.linalg.det(box))
 
     return recipCoeff * nrg
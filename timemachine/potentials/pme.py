@@ -0,0 +1,194 @@
+import numpy as onp
+import jax
+import jax.numpy as np
+
+from timemachine.constants import ONE_4PI_EPS0
+
+
+def bspline_weights(w, order):
+    """
+    Evaluate the cardinal B-spline M_n at w + k for k = 0, ..., n-1.
+
+    Parameters
+    ----------
+    w: np.array [...]
+        fractional offset of each point within its grid cell, in [0, 1).
+
+    order: int
+        order n of the B-spline, the interpolation is C^(n-2) continuous.
+
+    Returns
+    -------
+    np.array [..., order]
+        B-spline weights, these sum to one.
+
+    """
+    assert order >= 2
+
+    w = np.expand_dims(w, -1)
+    zeros = np.zeros_like(w)
+
+    # M_2(w) = w and M_2(w+1) = 1 - w
+    Mk = np.concatenate([w, 1 - w] + [zeros]*(order - 2), axis=-1)
+    ks = np.arange(order)
+
+    for j in range(3, order + 1):
+        # M_j(x) = (x M_{j-1}(x) + (j - x) M_{j-1}(x - 1))/(j - 1), with x = w + k
+        Mk_shift = np.concatenate([zeros, Mk[..., :-1]], axis=-1) # M_{j-1}(w + k - 1)
+        x = w + ks
+        Mk = (x*Mk + (j - x)*Mk_shift)/(j - 1)
+
+    return Mk
+
+
+def bspline_moduli(grid_size, order):
+    """
+    Compute |b(m)|^2 of Essmann et al. for each frequency of a single grid dimension.
+    This depends only on the grid size and the order so it is computed on the host.
+    """
+    # M_n evaluated at the integers 1, ..., n-1, same recursion as bspline_weights() with w = 0
+    Mn = onp.zeros(order)
+    Mn[1] = 1.0
+    ks = onp.arange(order)
+    for j in range(3, order + 1):
+        Mn_shift = onp.concatenate([[0.0], Mn[:-1]])
+        Mn = (ks*Mn + (j - ks)*Mn_shift)/(j - 1)
+    Mn_int = onp.zeros(order)
+    Mn_int[:order-1] = Mn[1:]
+
+    ms = onp.arange(grid_size)
+    ks = onp.arange(order)
+    arg = 2*onp.pi*onp.outer(ms, ks)/grid_size
+    denom = onp.abs(onp.sum(Mn_int*onp.exp(1j*arg), axis=-1))**2
+
+    # (Essmann et al.) the denominator vanishes at the nyquist frequency for odd orders,
+    # interpolate from its neighbors.
+    for m in range(grid_size):
+        if denom[m] < 1e-7:
+            denom[m] = (denom[(m - 1) % grid_size] + denom[(m + 1) % grid_size])/2
+
+    return 1.0/denom
+
+
+def spread_charges(conf, box, charges, grid_size, order):
+    """
+    Spread charges onto a periodic grid using B-splines of the given order.
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, 3] np.array
+        atomic coordinates
+
+    box: shape [3, 3] np.array
+        periodic box vectors
+
+    charges: shape [num_atoms] np.array
+        charge of each atom
+
+    grid_size: tuple of int
+        number of grid points along each box vector
+
+    order: int
+        B-spline interpolation order
+
+    Returns
+    -------
+    np.array [K1, K2, K3]
+        charge grid
+
+    """
+    K = onp.array(grid_size, dtype=onp.int32)
+
+    # fractional coordinates scaled to the grid, r = s @ box
+    u = np.matmul(conf[:, :3], np.linalg.inv(box))*K
+    u_floor = np.floor(u)
+    w = u - u_floor
+    theta = bspline_weights(w, order) # [N, 3, n]
+
+    # grid point receiving weight k is floor(u) - k
+    ks = np.arange(order)
+    grid_idxs = np.mod(np.expand_dims(u_floor.astype(np.int32), -1) - ks, np.expand_dims(K, -1)) # [N, 3, n]
+
+    flat_idxs = (
+        grid_idxs[:, 0, :, None, None]*(K[1]*K[2]) +
+        grid_idxs[:, 1, None, :, None]*K[2] +
+        grid_idxs[:, 2, None, None, :]
+    ) # [N, n, n, n]
+
+    weights = theta[:, 0, :, None, None]*theta[:, 1, None, :, None]*theta[:, 2, None, None, :]
+    weights = weights*charges[:, None, None, None]
+
+    Q = jax.ops.segment_sum(weights.reshape(-1), flat_idxs.reshape(-1), int(onp.prod(K)))
+
+    return Q.reshape(tuple(K))
+
+
+def pme_reciprocal_energy(conf, box, charges, alpha, grid_size, order=5):
+    """
+    Smooth particle mesh Ewald approximation of the reciprocal space energy.
+    Cost scales as O(N n^3 + K log K) as opposed to O(N kmax^3) for the
+    explicit Ewald sum in reciprocal_energy().
+
+    Essmann et al., J. Chem. Phys. 103, 8577 (1995)
+
+    Parameters
+    ----------
+    conf: shape [num_atoms, 3] np.array
+        atomic coordinates
+
+    box: shape [3, 3] np.array
+        periodic box vectors, triclinic boxes are supported.
+
+    charges: shape [num_atoms] np.array
+        charge of each atom
+
+    alpha: float
+        Ewald splitting parameter
+
+    grid_size: tuple of int or int
+        number of grid points along each box vector
+
+    order: int
+        B-spline interpolation order, OpenMM uses 5.
+
+    """
+    assert box is not None
+    assert alpha > 0
+
+    if isinstance(grid_size, int):
+        grid_size = (grid_size, grid_size, grid_size)
+    grid_size = tuple(int(k) for k in grid_size)
+
+    Q = spread_charges(conf, box, charges, grid_size, order)
+
+    # use the real fft, every frequency in the last dimension except 0
+    # and the nyquist frequency stands for itself and its conjugate.
+    FQ = np.fft.rfftn(Q)
+    n2FQ = np.real(FQ)**2 + np.imag(FQ)**2
+
+    K1, K2, K3 = grid_size
+    m1 = onp.fft.fftfreq(K1)*K1
+    m2 = onp.fft.fftfreq(K2)*K2
+    m3 = onp.arange(K3//2 + 1)
+
+    multiplicity = onp.where((m3 == 0) | (2*m3 == K3), 1.0, 2.0)
+
+    B = (
+        bspline_moduli(K1, order)[:, None, None] *
+        bspline_moduli(K2, order)[None, :, None] *
+        bspline_moduli(K3, order)[:K3//2 + 1][None, None, :]
+    )
+
+    mg = onp.stack(onp.meshgrid(m1, m2, m3, indexing='ij'), axis=-1) # [K1, K2, K3//2+1, 3]
+    recip_box = np.transpose(np.linalg.inv(box))
+    mk = np.matmul(mg, recip_box) # reciprocal lattice vectors
+    m2k = np.sum(mk*mk, axis=-1)
+
+    is_zero = onp.all(mg == 0, axis=-1)
+    m2k_safe = np.where(is_zero, 1.0, m2k)
+    ak = np.where(is_zero, 0.0, np.exp(-np.pi*np.pi*m2k_safe/(alpha*alpha))/m2k_safe)
+
+    volume = np.abs(np.linalg.det(box))
+    nrg = np.sum(multiplicity*B*ak*n2FQ)
+
+    return ONE_4PI_EPS0*nrg/(2*np.pi*volume)
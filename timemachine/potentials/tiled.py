@@ -0,0 +1,294 @@
+import functools
+
+import numpy as onp
+import jax
+import jax.numpy as np
+from jax import lax
+
+from timemachine.potentials.jax_utils import distance, convert_to_4d
+from timemachine.potentials.nonbonded import nonbonded_pairs
+from timemachine.potentials.gbsa import born_integral, born_radii, born_self_energy
+
+
+def tile_pairs(num_tiles):
+    """
+    Upper triangle (a <= b) of tile pairs, each unordered pair of atoms falls into exactly one.
+    """
+    a_idxs, b_idxs = onp.triu_indices(num_tiles)
+    return onp.stack([a_idxs, b_idxs], axis=1).astype(onp.int32)
+
+
+def _pad_tiles(x, tile_size):
+    # pad by repeating the last element so padded parameters stay physical,
+    # and reshape to [num_tiles, tile_size, ...]
+    N = x.shape[0]
+    num_tiles = (N + tile_size - 1)//tile_size
+    pad = num_tiles*tile_size - N
+    x = np.concatenate([x, np.repeat(x[-1:], pad, axis=0)])
+    return x.reshape((num_tiles, tile_size) + x.shape[1:])
+
+
+def _tile_mask(a, b, tile_size, N):
+    i_idxs = a*tile_size + np.arange(tile_size)
+    j_idxs = b*tile_size + np.arange(tile_size)
+    return (np.expand_dims(i_idxs, 1) < np.expand_dims(j_idxs, 0)) & (np.expand_dims(j_idxs, 0) < N)
+
+
+def _tile_reduce(pair_fn, xi, xj, pi, pj, mask, consts):
+    acc_i, acc_j = pair_fn(xi, xj, pi, pj, mask, consts)
+    acc_i = np.where(mask, acc_i, np.zeros_like(acc_i))
+    acc_j = np.where(mask, acc_j, np.zeros_like(acc_j))
+    return np.sum(acc_i, axis=1), np.sum(acc_j, axis=0)
+
+
+@functools.partial(jax.custom_vjp, nondiff_argnums=(0, 4))
+def tiled_pair_reduce(pair_fn, conf, params, consts, tile_size=128):
+    """
+    Accumulate per-atom sums over every unordered pair i < j, walking tiles of
+    tile_size x tile_size atoms with lax.scan. Only the upper triangle of tiles is
+    visited so every pair is evaluated once, and peak memory is O(tile_size^2)
+    rather than O(N^2).
+
+    Reverse mode is implemented with a custom VJP that recomputes each tile, so
+    no per-tile intermediates are stored either.
+
+    Parameters
+    ----------
+    pair_fn: callable
+        pair_fn(xi, xj, pi, pj, mask, consts) -> (acc_i, acc_j), where xi [T, D] and xj [T, D]
+        are the coordinates of a tile of atoms, pi and pj the matching slices of params, and
+        acc_i, acc_j [T, T] the contributions of each pair to atom i and atom j respectively.
+        mask [T, T] marks the valid pairs, pair_fn should sanitize the others (eg. i == j) so
+        that they are finite, they are discarded afterwards.
+
+    conf: shape [num_atoms, D] np.array
+        atomic coordinates
+
+    params: pytree of [num_atoms, ...] np.array
+        per atom floating point parameters, differentiable.
+
+    consts: pytree
+        constants passed to pair_fn, eg. the cutoff and box. These are not differentiated.
+
+    tile_size: int
+        number of atoms per tile.
+
+    Returns
+    -------
+    np.array [num_atoms]
+        sum over all pairs of the contributions to each atom
+
+    """
+    return _tiled_pair_reduce_fwd(pair_fn, conf, params, consts, tile_size)[0]
+
+
+def _tiled_pair_reduce_fwd(pair_fn, conf, params, consts, tile_size):
+    N = conf.shape[0]
+    x_tiles = _pad_tiles(conf, tile_size)
+    p_tiles = jax.tree_util.tree_map(lambda p: _pad_tiles(p, tile_size), params)
+    num_tiles = x_tiles.shape[0]
+
+    def body(acc, ab):
+        a, b = ab[0], ab[1]
+        pi = jax.tree_util.tree_map(lambda p: p[a], p_tiles)
+        pj = jax.tree_util.tree_map(lambda p: p[b], p_tiles)
+        mask = _tile_mask(a, b, tile_size, N)
+        sum_i, sum_j = _tile_reduce(pair_fn, x_tiles[a], x_tiles[b], pi, pj, mask, consts)
+        acc = acc.at[a].add(sum_i)
+        acc = acc.at[b].add(sum_j)
+        return acc, None
+
+    acc = np.zeros((num_tiles, tile_size), dtype=conf.dtype)
+    acc, _ = lax.scan(body, acc, tile_pairs(num_tiles))
+
+    return acc.reshape(-1)[:N], (conf, params, consts)
+
+
+def _tiled_pair_reduce_bwd(pair_fn, tile_size, res, g):
+    conf, params, consts = res
+    N = conf.shape[0]
+    x_tiles = _pad_tiles(conf, tile_size)
+    p_tiles = jax.tree_util.tree_map(lambda p: _pad_tiles(p, tile_size), params)
+    num_tiles = x_tiles.shape[0]
+    g_tiles = np.concatenate([g, np.zeros(num_tiles*tile_size - N, dtype=g.dtype)]).reshape(num_tiles, tile_size)
+
+    def body(carry, ab):
+        dx, dp = carry
+        a, b = ab[0], ab[1]
+        mask = _tile_mask(a, b, tile_size, N)
+
+        def tile_obj(xi, xj, pi, pj):
+            sum_i, sum_j = _tile_reduce(pair_fn, xi, xj, pi, pj, mask, consts)
+            return np.sum(sum_i*g_tiles[a]) + np.sum(sum_j*g_tiles[b])
+
+        pi = jax.tree_util.tree_map(lambda p: p[a], p_tiles)
+        pj = jax.tree_util.tree_map(lambda p: p[b], p_tiles)
+        dxi, dxj, dpi, dpj = jax.grad(tile_obj, argnums=(0, 1, 2, 3))(x_tiles[a], x_tiles[b], pi, pj)
+
+        dx = dx.at[a].add(dxi).at[b].add(dxj)
+        dp = jax.tree_util.tree_map(lambda d, di, dj: d.at[a].add(di).at[b].add(dj), dp, dpi, dpj)
+        return (dx, dp), None
+
+    dx = np.zeros_like(x_tiles)
+    dp = jax.tree_util.tree_map(np.zeros_like, p_tiles)
+    (dx, dp), _ = lax.scan(body, (dx, dp), tile_pairs(num_tiles))
+
+    # gradients of the padded atoms are dropped, they are copies of the last atom but never
+    # form a valid pair so their contributions are zero.
+    def unpad(d):
+        return d.reshape((num_tiles*tile_size,) + d.shape[2:])[:N]
+
+    dconsts = jax.tree_util.tree_map(np.zeros_like, consts)
+
+    return unpad(dx), jax.tree_util.tree_map(unpad, dp), dconsts
+
+
+tiled_pair_reduce.defvjp(_tiled_pair_reduce_fwd, _tiled_pair_reduce_bwd)
+
+
+def tiled_pair_energy(pair_fn, conf, params, consts, tile_size=128):
+    """
+    Sum of a symmetric pair energy over every unordered pair, see tiled_pair_reduce().
+
+    pair_fn(xi, xj, pi, pj, mask, consts) -> eij [T, T]
+    """
+    def reduce_fn(xi, xj, pi, pj, mask, consts):
+        eij = pair_fn(xi, xj, pi, pj, mask, consts)
+        return eij, np.zeros_like(eij)
+
+    return np.sum(tiled_pair_reduce(reduce_fn, conf, params, consts, tile_size))
+
+
+def _tile_distance(xi, xj, mask, box):
+    dij = distance(np.expand_dims(xi, 1), np.expand_dims(xj, 0), box)
+    # (ytz): trick used to avoid nans in the masked out pairs
+    return np.where(mask, dij, np.ones_like(dij))
+
+
+def _nonbonded_tile(xi, xj, pi, pj, mask, consts):
+    qi, lj_i = pi
+    qj, lj_j = pj
+    cutoff, box = consts
+
+    dij = _tile_distance(xi, xj, mask, box)
+
+    qij = np.expand_dims(qi, 1)*np.expand_dims(qj, 0)
+    sig_ij = (np.expand_dims(lj_i[:, 0], 1) + np.expand_dims(lj_j[:, 0], 0))/2
+    eps_ij = np.sqrt(np.expand_dims(lj_i[:, 1], 1)*np.expand_dims(lj_j[:, 1], 0))
+
+    es = qij/dij
+    if cutoff is not None:
+        eps_ij = np.where(dij < cutoff, eps_ij, np.zeros_like(eps_ij))
+        es = np.where(dij > cutoff, np.zeros_like(es), es)
+
+    sig2 = sig_ij/dij
+    sig2 *= sig2
+    sig6 = sig2*sig2*sig2
+
+    return es + 4*eps_ij*(sig6-1.0)*sig6
+
+
+def nonbonded_tiled(
+    conf,
+    lamb,
+    charge_params,
+    lj_params,
+    exclusion_idxs,
+    charge_scales,
+    lj_scales,
+    cutoff,
+    lambda_plane_idxs,
+    lambda_offset_idxs,
+    box=None,
+    tile_size=128):
+    """
+    Memory bounded variant of nonbonded.nonbonded() with identical energies and
+    derivatives, see tiled_pair_reduce(). Exclusions are evaluated explicitly.
+    """
+    if box is not None:
+        assert cutoff is not None
+
+    conf_4d = convert_to_4d(conf, lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff)
+
+    params = (np.asarray(charge_params), np.asarray(lj_params))
+    nrg = tiled_pair_energy(_nonbonded_tile, conf_4d, params, (cutoff, box), tile_size)
+
+    exc_nrg = nonbonded_pairs(conf_4d, params[0], params[1], exclusion_idxs, charge_scales, lj_scales, cutoff, box)
+
+    return nrg - exc_nrg
+
+
+def _born_tile(xi, xj, pi, pj, mask, consts):
+    or_i, sr_i = pi
+    or_j, sr_j = pj
+    cutoff_radii = consts
+
+    dij = _tile_distance(xi, xj, mask, None)
+
+    # descreening of i by j, and of j by i
+    I_ij = born_integral(dij, np.expand_dims(or_i, 1), np.expand_dims(sr_j, 0))
+    I_ji = born_integral(dij, np.expand_dims(or_j, 0), np.expand_dims(sr_i, 1))
+
+    I_ij = np.where(dij > cutoff_radii, np.zeros_like(I_ij), I_ij)
+    I_ji = np.where(dij > cutoff_radii, np.zeros_like(I_ji), I_ji)
+
+    return I_ij, I_ji
+
+
+def _gb_pair_tile(xi, xj, pi, pj, mask, consts):
+    qi, Bi = pi
+    qj, Bj = pj
+    cutoff_force, prefactor = consts
+
+    dij = _tile_distance(xi, xj, mask, None)
+
+    BB = np.expand_dims(Bi, 1)*np.expand_dims(Bj, 0)
+    f = np.sqrt(dij ** 2 + BB * np.exp(-dij ** 2 / (4 * BB)))
+    ixns = - prefactor * np.expand_dims(qi, 1) * np.expand_dims(qj, 0) / f
+
+    return np.where(dij > cutoff_force, np.zeros_like(ixns), ixns)
+
+
+def gbsa_obc_tiled(
+    coords,
+    lamb,
+    charge_params,
+    gb_params,
+    alpha,
+    beta,
+    gamma,
+    cutoff_radii,
+    cutoff_force,
+    lambda_plane_idxs,
+    lambda_offset_idxs,
+    dielectric_offset=0.009,
+    surface_tension=28.3919551,
+    solute_dielectric=1.0,
+    solvent_dielectric=78.5,
+    probe_radius=0.14,
+    tile_size=128):
+    """
+    Memory bounded variant of gbsa.gbsa_obc() with identical energies and derivatives.
+    Born radii and the pair terms are computed in two tiled passes, see tiled_pair_reduce().
+    """
+    assert cutoff_radii == cutoff_force
+
+    coords_4d = convert_to_4d(coords, lamb, lambda_plane_idxs, lambda_offset_idxs, cutoff_radii)
+
+    charges = np.asarray(charge_params)
+    radii = gb_params[:, 0]
+    scales = gb_params[:, 1]
+
+    offset_radii = radii - dielectric_offset
+    scaled_radii = scales * offset_radii
+
+    I = tiled_pair_reduce(_born_tile, coords_4d, (offset_radii, scaled_radii), cutoff_radii, tile_size)
+
+    B = born_radii(I, radii, dielectric_offset, alpha, beta, gamma)
+
+    E = born_self_energy(charges, radii, B, surface_tension, solute_dielectric, solvent_dielectric, probe_radius)
+
+    prefactor = 1 / solute_dielectric - 1 / solvent_dielectric
+    E += tiled_pair_energy(_gb_pair_tile, coords_4d, (charges, B), (cutoff_force, prefactor), tile_size)
+
+    return E
@@ -126,6 +126,20 @@ if __name__ == "__main__":
     for k, v in config['learning_rates'].items():
         learning_rates[k] = np.array([float(x) for x in v.split(',')])
 
+    du_dl_stats = None
+    if 'du_dl_block_size' in general_cfg:
+        du_dl_stats = {
+            'block_size': int(general_cfg['du_dl_block_size']),
+            'decimation': int(general_cfg['du_dl_decimation']) if 'du_dl_decimation' in general_cfg else None
+        }
+
+    minimizer = None
+    if 'minimizer' in intg_cfg:
+        minimizer = {
+            'method': intg_cfg['minimizer'],
+            'tolerance': float(intg_cfg.get('minimizer_tolerance', 10.0))
+        }
+
     engine = trainer.Trainer(
         host_pdbfile, 
         stubs,
@@ -141,7 +155,11 @@ if __name__ == "__main__":
         float(intg_cfg['temperature']),
         float(intg_cfg['friction']),
         learning_rates,
-        general_cfg['precision']
+        general_cfg['precision'],
+        memory_budget=int(intg_cfg['memory_budget']) if 'memory_budget' in intg_cfg else None,
+        du_dl_stats=du_dl_stats,
+        minimizer=minimizer,
+        respa_interval=int(intg_cfg.get('respa_interval', 1))
     )
 
     for epoch in range(100):
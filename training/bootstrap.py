@@ -80,6 +80,29 @@ def ti_ci(all_du_dls, ssc, stage_lambdas, du_dl_cutoff):
         avg_du_dls = np.concatenate([avg_du_dls])
         multi_stage_avg_du_dls.append(avg_du_dls)
 
+    return ti_ci_from_avg_du_dls(multi_stage_avg_du_dls, ssc, stage_lambdas)
+
+def ti_ci_from_avg_du_dls(multi_stage_avg_du_dls, ssc, stage_lambdas):
+    """
+    Same as ti_ci() but from the mean du_dl of each lambda window, eg. from the
+    du_dl summaries of an inference run.
+
+    Parameters
+    ----------
+    multi_stage_avg_du_dls: list of np.array [S, L]
+        mean total du_dl of each lambda window
+
+    stage_lambdas: list of np.array [S, L]
+        Lambda schedule for each stage
+
+    ssc: float
+        Standard state correction
+
+    Returns
+    -------
+    mean, [lower 95 CI, upper 95 CI]
+
+    """
     # sample from triples
     triples = []
     for stage_idx, (stage_du_dls, lambdas) in enumerate(zip(multi_stage_avg_du_dls, stage_lambdas)):
@@ -11,6 +11,7 @@ from timemachine.potentials import jax_utils
 from timemachine.potentials import bonded as bonded_utils
 
 from fe import standard_state
+from fe import reorder
 
 
 def find_protein_pocket_atoms(conf, nha, search_radius):
@@ -325,3 +326,53 @@ def create_system(
     )
 
     return x0, combined_masses, ssc, final_gradients, handler_vjp_fns
+
+
+# handlers whose vjp_fn takes adjoints of per atom parameters
+_PER_ATOM_HANDLERS = (
+    nonbonded.LennardJonesHandler,
+    nonbonded.SimpleChargeHandler,
+    nonbonded.GBSAHandler,
+    nonbonded.AM1BCCHandler,
+    nonbonded.AM1CCCHandler
+)
+
+
+def reorder_system(x0, masses, final_gradients, handler_vjp_fns, perm=None):
+    """
+    Reorder every per atom quantity and atom index of a system returned by create_system(),
+    by default along a Hilbert curve so that atoms close in space are close in memory.
+
+    Parameters
+    ----------
+    x0, masses, final_gradients, handler_vjp_fns:
+        see create_system()
+
+    perm: np.array [N]
+        the i-th atom of the reordered system is atom perm[i]. If None, then
+        reorder.hilbert_permutation(x0) is used.
+
+    Returns
+    -------
+    x0, masses, final_gradients, handler_vjp_fns, reorder.Reordering
+        the reordered system. The vjp_fns of per atom parameters accept adjoints in the
+        reordered order, so parameter derivatives are returned in the original order.
+        Frames and du_dx are mapped back with Reordering.restore_atoms(), du_dls are
+        unaffected.
+
+    """
+    if perm is None:
+        perm = reorder.hilbert_permutation(x0)
+
+    r = reorder.Reordering(perm)
+
+    new_gradients = [reorder.reorder_gradient(r, name, args) for name, args in final_gradients]
+
+    new_vjp_fns = {}
+    for handle, vjp_fn in handler_vjp_fns.items():
+        if isinstance(handle, _PER_ATOM_HANDLERS):
+            new_vjp_fns[handle] = r.restore_vjp_fn(vjp_fn)
+        else:
+            new_vjp_fns[handle] = vjp_fn
+
+    return r.permute_atoms(x0), r.permute_atoms(masses), new_gradients, new_vjp_fns, r
@@ -36,13 +36,19 @@ class Timer():
         print("total", time.time() - start_time)
 
 def compute_dGs(all_du_dls, lambda_schedules, du_dl_cutoff):
-    stage_dGs = []
-    for stage_du_dls, ti_lambdas in zip(all_du_dls, lambda_schedules):
+    all_avg_du_dls = []
+    for stage_du_dls in all_du_dls:
         du_dls = []
         for lamb_full_du_dls in stage_du_dls:
             du_dls.append(jnp.mean(jnp.sum(lamb_full_du_dls[:, du_dl_cutoff:], axis=0)))
-        du_dls = jnp.concatenate([du_dls])
-        dG = math_utils.trapz(du_dls, ti_lambdas)
+        all_avg_du_dls.append(jnp.concatenate([du_dls]))
+
+    return compute_dGs_from_avg_du_dls(all_avg_du_dls, lambda_schedules)
+
+def compute_dGs_from_avg_du_dls(all_avg_du_dls, lambda_schedules):
+    stage_dGs = []
+    for avg_du_dls, ti_lambdas in zip(all_avg_du_dls, lambda_schedules):
+        dG = math_utils.trapz(avg_du_dls, ti_lambdas)
         stage_dGs.append(dG)
 
     return stage_dGs
@@ -99,7 +105,11 @@ class Trainer():
             intg_temperature,
             intg_friction,
             learning_rates,
-            precision):
+            precision,
+            memory_budget=None,
+            du_dl_stats=None,
+            minimizer=None,
+            respa_interval=1):
         """
         Parameters
         ----------
@@ -149,6 +159,24 @@ class Trainer():
         precision: str
             allowed values are "single" or "double", (typical=single)
 
+        memory_budget: int or None
+            bytes of snapshots each worker keeps for the backward pass, frames in between
+            are recomputed. If None, every frame is stored. Only used by CPU workers.
+
+        du_dl_stats: dict or None
+            block_size and decimation of the DuDlStatistics accumulated by the workers
+            after du_dl_cutoff. If set, inference runs only receive these summaries
+            instead of the full du_dls.
+
+        minimizer: dict or None
+            kwargs of timemachine.minimizer.minimize(), eg. {"method": "fire", "tolerance": 10.0}.
+            If set, workers minimize x0 at each lambda window and the dt ramp at the start
+            of the integrator is dropped.
+
+        respa_interval: int
+            number of steps between evaluations of the nonbonded terms, the bonded terms
+            are evaluated every step. Only supported by CPU workers.
+
         """
 
 
@@ -167,6 +195,10 @@ class Trainer():
         self.intg_friction = intg_friction
         self.learning_rates = learning_rates
         self.precision = precision
+        self.memory_budget = memory_budget
+        self.du_dl_stats = du_dl_stats
+        self.minimizer = minimizer
+        self.respa_interval = respa_interval
 
 
         futures = []
@@ -213,11 +245,19 @@ class Trainer():
         stubs = self.stubs
         du_dl_cutoff = self.du_dl_cutoff
 
+        # workers only send back du_dl summaries, derivatives need the full du_dls
+        streaming = inference and self.du_dl_stats is not None
+        if streaming:
+            du_dl_stats = dict(burn_in=du_dl_cutoff, **self.du_dl_stats)
+        else:
+            du_dl_stats = None
+
         host_pdb = PDBFile(host_pdbfile)
         combined_pdb = Chem.CombineMols(Chem.MolFromPDBFile(host_pdbfile, removeHs=False), mol)
 
         stage_forward_futures = []
         stage_state_keys = []
+        stage_reorderings = {}
 
         stub_idx = 0
 
@@ -241,6 +281,16 @@ class Trainer():
                 stage
             )
 
+            # sort the atoms spatially, frames are mapped back to the original order below and the
+            # vjp_fns of per atom parameters accept adjoints in the sorted order.
+            x0, combined_masses, final_gradients, handler_vjp_fns, reordering = setup_system.reorder_system(
+                x0,
+                combined_masses,
+                final_gradients,
+                handler_vjp_fns
+            )
+            stage_reorderings[stage] = reordering
+
             forward_futures = []
             state_keys = []
 
@@ -253,14 +303,19 @@ class Trainer():
                     friction=self.intg_friction,  
                     masses=combined_masses,
                     lamb=lamb,
-                    seed=np.random.randint(np.iinfo(np.int32).max)
+                    seed=np.random.randint(np.iinfo(np.int32).max),
+                    minimization_steps=0 if self.minimizer is not None else 2000,
+                    respa_interval=self.respa_interval
                 )
 
                 complex_system = system.System(
                     x0,
                     np.zeros_like(x0),
                     final_gradients,
-                    intg
+                    intg,
+                    memory_budget=self.memory_budget,
+                    du_dl_stats=du_dl_stats,
+                    minimizer=self.minimizer
                 )
 
                 # this key is used for us to chase down the forward-mode coordinates
@@ -288,6 +343,7 @@ class Trainer():
 
         # step 2. Run forward mode on the jobs
         all_du_dls = []
+        all_avg_du_dls = []
         all_lambdas = []
 
         for stage, stage_futures in stage_forward_futures:
@@ -298,6 +354,31 @@ class Trainer():
             for lamb_idx, (future, lamb) in enumerate(zip(stage_futures, lambda_schedule[stage])):
 
                 response = future.result()
+                full_energies = pickle.loads(response.energies)
+
+                if self.n_frames > 0:
+                    frames = stage_reorderings[stage].restore_atoms(pickle.loads(response.frames), axis=1)
+                    out_file = os.path.join(stage_dir, "frames_"+str(lamb_idx)+".pdb")
+                    # make sure we do StringIO here as it's single-pass.
+                    combined_pdb_str = StringIO(Chem.MolToPDBBlock(combined_pdb))
+                    pdb_writer = PDBWriter(combined_pdb_str, out_file)
+                    pdb_writer.write_header()
+                    for frame_idx, x in enumerate(frames):
+                        pdb_writer.write(x*10)
+                    pdb_writer.close()
+
+                if streaming:
+                    # only the steps after du_dl_cutoff were accumulated by the worker
+                    du_dl_summary = pickle.loads(response.du_dls)
+                    for f, mean, var in zip(final_gradients, du_dl_summary["means"], du_dl_summary["variances"]):
+                        if mean != 0 or var > 0:
+                            fname = f[0]
+                            print("mol", mol.GetProp("_Name"), "stage:", stage, "lambda:", "{:.3f}".format(lamb), "\t mean", "{:8.2f}".format(mean), "+-", "{:7.2f}".format(np.sqrt(var)), "\t <-", fname)
+
+                    total_block_du_dls = np.sum(du_dl_summary["block_averages"], axis=0) # [B]
+                    print("mol", mol.GetProp("_Name"), "stage:", stage, "lambda:", "{:.3f}".format(lamb), "\t mean", "{:8.2f}".format(np.sum(du_dl_summary["means"])), "+-", "{:7.2f}".format(np.std(total_block_du_dls)), "\t <- Total (block std)")
+                    stage_du_dls.append(du_dl_summary)
+                    continue
 
                 stripped_du_dls = pickle.loads(response.du_dls)
 
@@ -311,20 +392,6 @@ class Trainer():
                         full_du_dls.append(du_dls)
 
                 full_du_dls = np.array(full_du_dls)
-                full_energies = pickle.loads(response.energies)
-
-                if self.n_frames > 0:
-                    frames = pickle.loads(response.frames)
-                    out_file = os.path.join(stage_dir, "frames_"+str(lamb_idx)+".pdb")
-                    # make sure we do StringIO here as it's single-pass.
-                    combined_pdb_str = StringIO(Chem.MolToPDBBlock(combined_pdb))
-                    pdb_writer = PDBWriter(combined_pdb_str, out_file)
-                    pdb_writer.write_header()
-                    for frame_idx, x in enumerate(frames):
-                        pdb_writer.write(x*10)
-                    pdb_writer.close()
-
-                    assert full_du_dls is not None
 
                 # we don't really want to save this full buffer
                 # np.save(os.path.join(stage_dir, "lambda_"+str(lamb_idx)+"_full_du_dls"), full_du_dls)
@@ -360,15 +427,22 @@ class Trainer():
                 print("mol", mol.GetProp("_Name"), "stage:", stage, "lambda:", "{:.3f}".format(lamb), "\t mean", "{:8.2f}".format(np.mean(total_equil_du_dls)), "+-", "{:7.2f}".format(np.std(total_equil_du_dls)), "\t <- Total")
                 stage_du_dls.append(full_du_dls)
 
-            sum_du_dls = np.sum(stage_du_dls, axis=1) # [L,F,T], lambda windows, num forces, num frames
-
             ti_lambdas = lambda_schedule[stage]
-            plt.boxplot(sum_du_dls[:, du_dl_cutoff:].tolist(), positions=ti_lambdas)
+
+            if streaming:
+                # block averages stand in for the samples of each window
+                block_du_dls = [np.sum(s["block_averages"], axis=0).tolist() for s in stage_du_dls]
+                plt.boxplot(block_du_dls, positions=ti_lambdas)
+                avg_du_dls = np.array([np.sum(s["means"]) for s in stage_du_dls])
+            else:
+                sum_du_dls = np.sum(stage_du_dls, axis=1) # [L,F,T], lambda windows, num forces, num frames
+                plt.boxplot(sum_du_dls[:, du_dl_cutoff:].tolist(), positions=ti_lambdas)
+                avg_du_dls = np.mean(sum_du_dls[:, du_dl_cutoff:], axis=1)
+
             plt.ylabel("du_dlambda")
             plt.savefig(os.path.join(stage_dir, "boxplot_du_dls"))
             plt.clf()
 
-            avg_du_dls = np.mean(sum_du_dls[:, du_dl_cutoff:], axis=1)
             np.save(os.path.join(stage_dir, "avg_du_dls"), avg_du_dls)
             plt.plot(ti_lambdas, avg_du_dls)
             plt.ylabel("du_dlambda")
@@ -376,14 +450,21 @@ class Trainer():
             plt.clf()
 
             all_du_dls.append(stage_du_dls)
+            all_avg_du_dls.append(avg_du_dls)
             all_lambdas.append(ti_lambdas)
 
-
-        pred_dG = dG_TI(all_du_dls, ssc, all_lambdas, du_dl_cutoff)
-        ci = bootstrap.ti_ci(all_du_dls, ssc, all_lambdas, du_dl_cutoff)
-        loss = loss_fn(all_du_dls, ssc, all_lambdas, experiment_dG, du_dl_cutoff)
-
-        print("mol", mol.GetProp("_Name"), "stage dGs:", compute_dGs(all_du_dls, all_lambdas, du_dl_cutoff), "ssc:", ssc)
+        if streaming:
+            stage_dGs = compute_dGs_from_avg_du_dls(all_avg_du_dls, all_lambdas)
+            pred_dG = jnp.sum(stage_dGs) + ssc
+            ci = bootstrap.ti_ci_from_avg_du_dls(all_avg_du_dls, ssc, all_lambdas)
+            loss = jnp.abs(pred_dG - experiment_dG)
+        else:
+            stage_dGs = compute_dGs(all_du_dls, all_lambdas, du_dl_cutoff)
+            pred_dG = dG_TI(all_du_dls, ssc, all_lambdas, du_dl_cutoff)
+            ci = bootstrap.ti_ci(all_du_dls, ssc, all_lambdas, du_dl_cutoff)
+            loss = loss_fn(all_du_dls, ssc, all_lambdas, experiment_dG, du_dl_cutoff)
+
+        print("mol", mol.GetProp("_Name"), "stage dGs:", stage_dGs, "ssc:", ssc)
 
         if not inference:
 
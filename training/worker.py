@@ -15,14 +15,28 @@ import service_pb2_grpc
 
 from threading import Lock
 
-from timemachine.lib import custom_ops, ops
+from timemachine.lib import reference
+from timemachine.observables.du_dl import DuDlStatistics
+from timemachine import minimizer
+from timemachine.integrator import respa_intervals
 
 class Worker(service_pb2_grpc.WorkerServicer):
 
-    def __init__(self):
+    def __init__(self, platform='gpu'):
         self.states = {}
         self.mutex = Lock()
 
+        # the reference engine has the same interface as ops and custom_ops
+        if platform == 'gpu':
+            from timemachine.lib import custom_ops, ops
+            self.ops = ops
+            self.engine = custom_ops
+        elif platform == 'cpu':
+            self.ops = reference
+            self.engine = reference
+        else:
+            raise Exception("Unknown platform")
+
     def ResetState(self, request, context):
         with self.mutex:
             self.states.clear()
@@ -46,20 +60,50 @@ class Worker(service_pb2_grpc.WorkerServicer):
 
         for grad_name, grad_args in system.gradients:
             force_names.append(grad_name)
-            op_fn = getattr(ops, grad_name)
+            op_fn = getattr(self.ops, grad_name)
             grad = op_fn(*grad_args, precision=precision)
             gradients.append(grad)
 
         integrator = system.integrator
 
-        stepper = custom_ops.AlchemicalStepper_f64(
-            gradients,
-            integrator.lambs
-        )
+        x0 = system.x0
+        minimizer_args = getattr(system, 'minimizer', None)
+        if minimizer_args is not None:
+            # relax the starting coordinates at the lambda of the first step
+            energy_fn = minimizer.gradients_energy_fn(gradients, integrator.lambs[0])
+            with self.mutex:
+                x0, min_summary = minimizer.minimize(energy_fn, system.x0, **minimizer_args)
+            print("minimized", request.key, min_summary)
+
+        # in inference mode only summaries of the du_dls are sent back if requested
+        du_dl_stats = getattr(system, 'du_dl_stats', None)
+        if request.inference and du_dl_stats is not None:
+            statistics = DuDlStatistics(len(gradients), **du_dl_stats)
+        else:
+            statistics = None
+
+        respa_interval = getattr(integrator, 'respa_interval', 1)
+
+        if self.engine is reference:
+            # with statistics the reference context streams the du_dls in chunks and keeps
+            # only the sampled frames, see ReversibleContext(chunk_size)
+            stepper = reference.AlchemicalStepper_f64(
+                gradients,
+                integrator.lambs,
+                statistics=statistics,
+                intervals=respa_intervals(force_names, respa_interval)
+            )
+        elif respa_interval != 1:
+            raise Exception("Multiple time steps are only supported on the cpu platform")
+        else:
+            stepper = self.engine.AlchemicalStepper_f64(
+                gradients,
+                integrator.lambs
+            )
 
-        ctxt = custom_ops.ReversibleContext_f64(
+        ctxt_args = (
             stepper,
-            system.x0,
+            x0,
             system.v0,
             integrator.cas,
             integrator.cbs,
@@ -68,33 +112,53 @@ class Worker(service_pb2_grpc.WorkerServicer):
             integrator.seed
         )
 
+        # frames are sampled at this interval below
+        frame_interval = max(1, (len(integrator.dts) + 1)//max(1, request.n_frames))
+
+        if self.engine is reference:
+            # the sampled frames count against the memory_budget
+            memory_budget = getattr(system, 'memory_budget', None)
+            ctxt = reference.ReversibleContext_f64(*ctxt_args, memory_budget=memory_budget, frame_interval=frame_interval)
+            if memory_budget is not None:
+                print("checkpoint schedule for", request.key, ctxt.get_schedule_summary())
+        else:
+            ctxt = self.engine.ReversibleContext_f64(*ctxt_args)
+
         start = time.time()
 
-        # ensure only one GPU can be running at given time.
+        # ensure only one GPU (or CPU engine) can be running at given time.
         total_size = 0 
 
         with self.mutex:
 
             ctxt.forward_mode()
-            full_du_dls = stepper.get_du_dl() # [FxT]
-            stripped_du_dls = []
             energies = stepper.get_energies()
 
-            for force_du_dls in full_du_dls:
-                # zero out 
-                if np.all(force_du_dls) == 0:
-                    stripped_du_dls.append(None)
-                else:
-                    stripped_du_dls.append(force_du_dls)
-                    total_size += len(force_du_dls)
+            if statistics is not None:
+                if self.engine is not reference:
+                    statistics.update(stepper.get_du_dl())
+                reply_du_dls = statistics.summary()
+            else:
+                full_du_dls = stepper.get_du_dl() # [FxT]
+                stripped_du_dls = []
+                for force_du_dls in full_du_dls:
+                    # zero out 
+                    if np.all(force_du_dls) == 0:
+                        stripped_du_dls.append(None)
+                    else:
+                        stripped_du_dls.append(force_du_dls)
+                        total_size += len(force_du_dls)
+                reply_du_dls = stripped_du_dls
 
             keep_idxs = []
 
-            if request.n_frames > 0:
+            if request.n_frames > 0 and self.engine is reference:
+                # every frame may not be stored when checkpointing
+                frames = ctxt.get_frames()
+            elif request.n_frames > 0:
                 xs = ctxt.get_all_coords()
-                interval = max(1, xs.shape[0]//request.n_frames)
                 for frame_idx in range(xs.shape[0]):
-                    if frame_idx % interval == 0:
+                    if frame_idx % frame_interval == 0:
                         keep_idxs.append(frame_idx)
                 frames = xs[keep_idxs]
             else:
@@ -106,7 +170,7 @@ class Worker(service_pb2_grpc.WorkerServicer):
                 self.states[request.key] = (ctxt, gradients, force_names, stepper, system)
 
             return service_pb2.ForwardReply(
-                du_dls=pickle.dumps(stripped_du_dls), # tbd strip zeros
+                du_dls=pickle.dumps(reply_du_dls), # tbd strip zeros
                 energies=pickle.dumps(energies),
                 frames=pickle.dumps(frames),
             )
@@ -165,7 +229,7 @@ def serve(args):
             ('grpc.max_receive_message_length', 50 * 1024 * 1024)
         ]
     )
-    service_pb2_grpc.add_WorkerServicer_to_server(Worker(), server)
+    service_pb2_grpc.add_WorkerServicer_to_server(Worker(args.platform), server)
     server.add_insecure_port('[::]:'+str(args.port))
     server.start()
     server.wait_for_termination()
@@ -173,11 +237,15 @@ def serve(args):
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description='Worker Server')
-    parser.add_argument('--gpu_idx', type=int, required=True, help='Location of all output files')
+    parser.add_argument('--gpu_idx', type=int, default=0, help='Index of the GPU to run on')
     parser.add_argument('--port', type=int, required=True, help='Either single or double precision. Double is 8x slower.')
+    parser.add_argument('--platform', type=str, default='gpu', choices=['gpu', 'cpu'], help='gpu runs custom_ops, cpu runs the JAX reference engine.')
     args = parser.parse_args()
 
-    os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu_idx)
+    if args.platform == 'gpu':
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(args.gpu_idx)
+    else:
+        from jax.config import config; config.update("jax_enable_x64", True)
 
     logging.basicConfig()
     serve(args)